@@ -2,11 +2,10 @@ from __future__ import unicode_literals
 
 from dateutil.relativedelta import relativedelta
 
-import numpy
+from django.db import connection
 
 from tracpro.charts.formatters import format_series, format_x_axis
-from tracpro.polls.utils import (
-    get_numeric_values, summarize_by_pollrun, overall_mean, overall_stdev)
+from tracpro.polls.utils import summarize_by_pollrun, overall_mean, overall_stdev
 
 
 def chart_baseline(baseline_term, filter_form, region, include_subregions):
@@ -83,12 +82,19 @@ def get_baseline_data(baseline_term, **kwargs):
     # The sum of the first answer from each contact.
     answers = answers.order_by('response__contact', 'submitted_on')
     answers = answers.distinct('response__contact')
-    numeric_values = get_numeric_values(answers.values_list('value', flat=True))
 
-    baseline = numpy.sum(numeric_values)
-
-    responses = responses.distinct('contact')
-    response_rate = round(100.0 * len(answers) / len(responses), 1) if responses else 0.0
+    # Total the first answers in the database; Django can't aggregate over
+    # a DISTINCT ON query.
+    sql, params = answers.values('numeric_value').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT SUM(numeric_value), COUNT(*) FROM ({}) AS first_answers'.format(sql),
+            params)
+        baseline, answer_count = cursor.fetchone()
+    baseline = baseline or 0.0
+
+    response_count = responses.distinct('contact').count()
+    response_rate = round(100.0 * answer_count / response_count, 1) if response_count else 0.0
 
     return baseline, response_rate
 
@@ -16,7 +16,8 @@ from smartmin.views import (
     SmartCRUDL, SmartCreateView, SmartDeleteView, SmartFormView,
     SmartListView, SmartReadView, SmartUpdateView, SmartView)
 
-from tracpro.polls.models import Answer, PollRun, Response
+from tracpro.polls.charts import clear_chart_data
+from tracpro.polls.models import Answer, AnswerSummary, PollRun, Response, WordCount
 
 from .models import BaselineTerm
 from .forms import BaselineTermForm, SpoofDataForm, BaselineTermFilterForm
@@ -130,6 +131,8 @@ class BaselineTermCRUDL(SmartCRUDL):
                     value=random_answer,
                     submitted_on=baseline_datetime,
                     category='')
+            AnswerSummary.objects.add_responses(baseline_pollrun.responses.all())
+            WordCount.objects.add_responses(baseline_pollrun.responses.all())
 
         def form_valid(self, form):
             baseline_question = self.form.cleaned_data['baseline_question']
@@ -168,8 +171,11 @@ class BaselineTermCRUDL(SmartCRUDL):
                         value=random_answer,
                         submitted_on=follow_up_datetime,
                         category='')
+                AnswerSummary.objects.add_responses(follow_up_pollrun.responses.all())
+                WordCount.objects.add_responses(follow_up_pollrun.responses.all())
                 loop_count += 1
 
+            clear_chart_data(self.request.org)
             return redirect(self.get_success_url())
 
     class ClearSpoof(OrgPermsMixin, SmartView, View):
@@ -188,5 +194,6 @@ class BaselineTermCRUDL(SmartCRUDL):
             # This will create a cascading delete to clear out all Spoofed Poll data
             # from PollRun, Answer and Response
             pollruns.delete()
+            clear_chart_data(self.request.org)
 
             return redirect('baseline.baselineterm_list')
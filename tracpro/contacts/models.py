@@ -1,14 +1,16 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import defaultdict, OrderedDict
 import datetime
 from decimal import Decimal, InvalidOperation
 import logging
+import threading
 from uuid import uuid4
 
 from django import forms
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.utils.encoding import python_2_unicode_compatible
@@ -23,12 +25,104 @@ from temba_client.types import Contact as TembaContact
 from tracpro.groups.models import Region, Group
 from tracpro.orgs_ext.constants import TaskType
 
-from .tasks import push_contact_change
+from .tasks import queue_contact_push
 
 
 logger = logging.getLogger(__name__)
 
 
+_sync_contexts = threading.local()
+
+
+class ContactSyncContext(object):
+    """The org's active Regions and Groups, by uuid.
+
+    Resolves the groups of contacts from RapidPro in memory. While used as a
+    context manager (as `Contact.objects.sync()` does), the same maps are
+    used for every contact from the org rather than querying per contact.
+    """
+
+    # Number of contacts whose DataField values are written, or whose alerts
+    # are evaluated, at once.
+    BATCH_SIZE = 500
+
+    def __init__(self, org):
+        self.org = org
+        self.regions = {r.uuid: r for r in Region.get_all(org)}
+        self.groups = {g.uuid: g for g in Group.get_all(org)}
+        self.data_fields = None
+        self.field_values = OrderedDict()
+        self.alert_contact_ids = set()
+
+    def __enter__(self):
+        self._previous = getattr(_sync_contexts, 'current', None)
+        _sync_contexts.current = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _sync_contexts.current = self._previous
+        # Contacts saved before an error are already in the database, so
+        # their values and alerts are written even if the sync fails.
+        try:
+            self.flush_field_values()
+        finally:
+            self.flush_alert_events()
+
+    @classmethod
+    def get_current(cls, org):
+        """Return the active context for the org, if any."""
+        current = getattr(_sync_contexts, 'current', None)
+        if current is not None and current.org.pk == org.pk:
+            return current
+        return None
+
+    @classmethod
+    def get(cls, org):
+        """Return the active context for the org, or load a new one."""
+        return cls.get_current(org) or cls(org)
+
+    def add_field_values(self, contact, values):
+        """Queue a saved contact's DataField values to be written in a batch."""
+        contact, queued = self.field_values.get(contact.pk, (contact, {}))
+        queued.update(values)
+        self.field_values[contact.pk] = (contact, queued)
+        if len(self.field_values) >= self.BATCH_SIZE:
+            self.flush_field_values()
+
+    def flush_field_values(self):
+        """Write the queued DataField values."""
+        if self.field_values:
+            if self.data_fields is None:
+                self.data_fields = {f.key: f for f in self.org.datafield_set.all()}
+            ContactField.objects.set_values(
+                self.org, self.field_values.values(), self.data_fields)
+            self.field_values.clear()
+
+    def add_alert_events(self, contact_ids):
+        """Queue alert evaluation for contacts whose group membership changed."""
+        self.alert_contact_ids.update(contact_ids)
+        if len(self.alert_contact_ids) >= self.BATCH_SIZE:
+            self.flush_alert_events()
+
+    def flush_alert_events(self):
+        """Send one alert evaluation task for the queued contacts."""
+        if self.alert_contact_ids:
+            Contact.trigger_alerts(self.org, sorted(self.alert_contact_ids))
+            self.alert_contact_ids.clear()
+
+    def get_region(self, uuids):
+        """Return the Region for the first of the uuids that matches one."""
+        return next((self.regions[uuid] for uuid in uuids if uuid in self.regions), None)
+
+    def get_group(self, uuids):
+        """Return the Group for the first of the uuids that matches one."""
+        return next((self.groups[uuid] for uuid in uuids if uuid in self.groups), None)
+
+    def get_groups(self, uuids):
+        """Return the Groups for each of the uuids that matches one."""
+        return [self.groups[uuid] for uuid in uuids if uuid in self.groups]
+
+
 class ContactQuerySet(models.QuerySet):
 
     def active(self):
@@ -49,13 +143,13 @@ class ContactManager(models.Manager.from_queryset(ContactQuerySet)):
         recent_contacts = recent_contacts.order_by('-temba_modified_on')
 
         most_recent = recent_contacts.first()
-        sync_regions = [r.uuid for r in Region.get_all(org)]
-        sync_groups = [g.uuid for g in Group.get_all(org)]
 
-        created, updated, deleted, failed = sync_pull_contacts(
-            org=org, contact_class=Contact, fields=(), delete_blocked=True,
-            groups=sync_regions + sync_groups,
-            last_time=most_recent.temba_modified_on if most_recent else None)
+        # Resolve every contact's region and groups from the same maps.
+        with ContactSyncContext(org) as context:
+            created, updated, deleted, failed = sync_pull_contacts(
+                org=org, contact_class=Contact, fields=(), delete_blocked=True,
+                groups=list(context.regions) + list(context.groups),
+                last_time=most_recent.temba_modified_on if most_recent else None)
 
         org.set_task_result(TaskType.sync_contacts, {
             'time': datetime_to_ms(timezone.now()),
@@ -127,6 +221,48 @@ class Contact(models.Model):
     def __init__(self, *args, **kwargs):
         self._data_field_values = kwargs.pop('_data_field_values', None)
         super(Contact, self).__init__(*args, **kwargs)
+        self.reset_membership()
+        self._saved_summary_state = self.get_summary_state()
+
+    def get_membership(self):
+        """Return the ids of the contact's region and reporter group.
+
+        Reads the loaded values only, so that deferred fields aren't loaded.
+        """
+        return (self.__dict__.get('region_id'), self.__dict__.get('group_id'))
+
+    def get_summary_state(self):
+        """Return the contact's region id and whether they are active.
+
+        Answer summaries and word counts depend on both. Reads the loaded
+        values only, so that deferred fields aren't loaded.
+        """
+        return (self.__dict__.get('region_id'), self.__dict__.get('is_active'))
+
+    def reset_membership(self):
+        """Record the contact's membership as saved."""
+        self._saved_membership = self.get_membership()
+
+    def has_membership_changed(self):
+        return self.get_membership() != self._saved_membership
+
+    @classmethod
+    def record_membership_change(cls, org, contact_ids):
+        """Evaluate alerts for contacts whose group membership changed.
+
+        While contacts are synced, changes are collected and evaluated in
+        batches; otherwise they are evaluated right away.
+        """
+        context = ContactSyncContext.get_current(org)
+        if context is not None:
+            context.add_alert_events(contact_ids)
+        else:
+            cls.trigger_alerts(org, contact_ids)
+
+    @classmethod
+    def trigger_alerts(cls, org, contact_ids):
+        from tracpro.trackers.tasks import create_occurrence_trigger_the_alert_action
+        create_occurrence_trigger_the_alert_action.delay(org.pk, list(contact_ids))
 
     def __str__(self):
         return self.name or self.get_urn()[1]
@@ -178,16 +314,10 @@ class Contact(models.Model):
     @classmethod
     def kwargs_from_temba(cls, org, temba_contact):
         """Get data to create a Contact instance from a Temba object."""
-
-        def _get_first(model_class, temba_uuids):
-            """Return first obj from this org that matches one of the given uuids."""
-            queryset = model_class.get_all(org)
-            tracpro_uuids = queryset.values_list('uuid', flat=True)
-            uuid = next((uuid for uuid in temba_uuids if uuid in tracpro_uuids), None)
-            return queryset.get(uuid=uuid) if uuid else None
+        context = ContactSyncContext.get(org)
 
         # Use the first Temba group that matches one of the org's Regions.
-        region = _get_first(Region, temba_contact.groups)
+        region = context.get_region(temba_contact.groups)
         if not region:
             raise ValueError(
                 "Unable to save contact {c.uuid} ({c.name}) because none of "
@@ -197,8 +327,8 @@ class Contact(models.Model):
                     groups=', '.join(temba_contact.groups)))
 
         # Use the first Temba group that matches one of the org's Groups.
-        group = _get_first(Group, temba_contact.groups)
-        groups = [Group.objects.get(uuid=group_uuid) for group_uuid in temba_contact.groups]
+        group = context.get_group(temba_contact.groups)
+        groups = context.get_groups(temba_contact.groups)
         return {
             'org': org,
             'name': temba_contact.name or "",
@@ -213,7 +343,7 @@ class Contact(models.Model):
         }
 
     def push(self, change_type):
-        push_contact_change.delay(self.pk, change_type)
+        queue_contact_push(self.org_id, self.pk, change_type)
 
     def save(self, *args, **kwargs):
         if self.org.pk != self.region.org_id:
@@ -235,13 +365,34 @@ class Contact(models.Model):
         else:
             push_created = False
 
-        contact = super(Contact, self).save(*args, **kwargs)
+        # Answer summaries and word counts are kept by region, for active
+        # contacts only.
+        summary_changed = (
+            self.pk is not None and self.get_summary_state() != self._saved_summary_state)
+        with transaction.atomic():
+            if summary_changed:
+                self._update_answer_summaries(add=False)
+            contact = super(Contact, self).save(*args, **kwargs)
+            if summary_changed:
+                self._update_answer_summaries(add=True)
+        self._saved_summary_state = self.get_summary_state()
 
         if push_created:
             self.push(ChangeType.created)
 
         return contact
 
+    def _update_answer_summaries(self, add):
+        """Add the contact's responses to (or remove them from) the summaries."""
+        from tracpro.polls.models import AnswerSummary, WordCount
+        responses = self.responses.all()
+        if add:
+            AnswerSummary.objects.add_responses(responses)
+            WordCount.objects.add_responses(responses)
+        else:
+            AnswerSummary.objects.remove_responses(responses)
+            WordCount.objects.remove_responses(responses)
+
 
 class DataFieldQuerySet(models.QuerySet):
 
@@ -338,13 +489,63 @@ class ContactFieldQuerySet(models.QuerySet):
         return self.filter(field__show_on_tracpro=True)
 
 
+class ContactFieldManager(models.Manager.from_queryset(ContactFieldQuerySet)):
+
+    def set_values(self, org, contact_values, data_fields=None):
+        """Store the DataField values of a batch of the org's contacts.
+
+        `contact_values` is a list of (contact, {key: value}) pairs. Values
+        for keys that the org has no DataField for are ignored. The existing
+        values are fetched at once, then new values are bulk created and
+        changed values are updated with one query per distinct value.
+        """
+        if data_fields is None:
+            data_fields = {f.key: f for f in org.datafield_set.all()}
+
+        existing = defaultdict(list)
+        contact_fields = self.filter(
+            contact__in=[contact.pk for contact, _ in contact_values], field__org=org)
+        for contact_field in contact_fields.only('pk', 'contact', 'field', 'value'):
+            existing[(contact_field.contact_id, contact_field.field_id)].append(contact_field)
+
+        new_fields = OrderedDict()  # (contact id, field id) -> new ContactField
+        updates = {}  # ContactField id -> new value
+        for contact, values in contact_values:
+            for key, value in values.items():
+                if key not in data_fields:
+                    continue  # Don't update fields we don't have a record for.
+
+                # Remove empty strings for consistency with RapidPro.
+                contact_field = ContactField(contact=contact, field=data_fields[key])
+                contact_field.set_value(value or None)
+
+                current = existing.get((contact.pk, contact_field.field_id))
+                if current:
+                    for other in current:
+                        if other.value != contact_field.value:
+                            updates[other.pk] = contact_field.value
+                        else:
+                            updates.pop(other.pk, None)
+                else:
+                    new_fields[(contact.pk, contact_field.field_id)] = contact_field
+
+        if new_fields:
+            self.bulk_create(new_fields.values())
+
+        pks_by_value = defaultdict(list)
+        for pk, value in updates.items():
+            pks_by_value[value].append(pk)
+        for value, pks in pks_by_value.items():
+            self.filter(pk__in=pks).update(value=value)
+
+
 class ContactField(models.Model):
     """Many-to-many relationship to represent a Contact's value for a DataField."""
     contact = models.ForeignKey('contacts.Contact')
     field = models.ForeignKey('contacts.DataField')
     value = models.CharField(max_length=255, null=True)
 
-    objects = ContactFieldQuerySet.as_manager()
+    objects = ContactFieldManager()
 
     def __str__(self):
         return "{} {}: {}".format(self.contact, self.field, self.get_value())
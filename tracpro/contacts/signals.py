@@ -1,10 +1,9 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 
-from tracpro.trackers.tasks import create_occurrence_trigger_the_alert_action
-from .models import Contact, ContactField
+from .models import Contact, ContactField, ContactSyncContext
 
 
 @receiver(post_save, sender=Contact)
@@ -13,30 +12,45 @@ def set_data_field_values(sender, instance, **kwargs):
 
     Stores all values, even for DataFields that are not visible.
     By doing this, we can quickly show meaningful data when DataField
-    visibility is toggled.
+    visibility is toggled. While contacts are synced, values are queued and
+    written for a batch of contacts at once.
     """
     if not hasattr(instance, '_data_field_values'):
         return
 
     if instance._data_field_values is not None:
-        data_fields = {f.key: f for f in instance.org.datafield_set.all()}
-        for key, value in instance._data_field_values.items():
-            if key not in data_fields:
-                continue  # Don't update fields we don't have a record for.
-
-            # Remove empty strings for consistency with RapidPro.
-            value = value or None
-
-            contact_field, _ = ContactField.objects.get_or_create(
-                contact=instance, field=data_fields[key])
-            contact_field.set_value(value)
-            contact_field.save()
+        context = ContactSyncContext.get_current(instance.org)
+        if context is not None:
+            context.add_field_values(instance, instance._data_field_values)
+        else:
+            ContactField.objects.set_values(
+                instance.org, [(instance, instance._data_field_values)])
 
     del instance._data_field_values
 
 
 @receiver(post_save, sender=Contact)
-def trigger_the_alert_actions(sender, instance, **kwargs):
-    # If group membership has changed, and we have an alert related to this particular change,
-    # then create an Occurence & trigger the alert action
-    create_occurrence_trigger_the_alert_action.delay(instance)
+def trigger_the_alert_actions(sender, instance, created, **kwargs):
+    """Evaluate alerts if the contact's region or reporter group changed."""
+    if created or instance.has_membership_changed():
+        Contact.record_membership_change(instance.org, [instance.pk])
+    instance.reset_membership()
+
+
+@receiver(m2m_changed, sender=Contact.groups.through)
+def trigger_the_alert_actions_for_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    """Evaluate alerts for contacts that were added to or removed from groups."""
+    if action in ('post_add', 'post_remove'):
+        if pk_set:
+            contact_ids = pk_set if reverse else [instance.pk]
+            Contact.record_membership_change(instance.org, contact_ids)
+    elif action == 'pre_clear':
+        # The cleared contacts aren't known after the fact.
+        if reverse:
+            instance._cleared_contact_ids = list(instance.all_contacts.values_list('pk', flat=True))
+        else:
+            instance._cleared_contact_ids = [instance.pk] if instance.groups.exists() else []
+    elif action == 'post_clear':
+        contact_ids = getattr(instance, '_cleared_contact_ids', None)
+        if contact_ids:
+            Contact.record_membership_change(instance.org, contact_ids)
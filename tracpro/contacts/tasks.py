@@ -1,11 +1,14 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import Counter
+
 from django.apps import apps
 
 from celery.utils.log import get_task_logger
 from djcelery_transactions import task
+from django_redis import get_redis_connection
 
-from dash.utils.sync import sync_push_contact
+from dash.utils.sync import ChangeType, sync_push_contact
 
 from tracpro.orgs_ext.tasks import OrgTask
 
@@ -13,10 +16,138 @@ from tracpro.orgs_ext.tasks import OrgTask
 logger = get_task_logger(__name__)
 
 
+CONTACT_PUSH_QUEUE_KEY = 'org:%d:contact_push_queue'
+
+CONTACT_PUSH_SCHEDULED_KEY = 'org:%d:contact_push_scheduled'
+
+CONTACT_PUSH_FAILURES_KEY = 'org:%d:contact_push_failures'
+
+# Seconds to wait for further changes before pushing an org's queued changes.
+CONTACT_PUSH_DELAY = 10
+
+# Number of queued contacts to load at once.
+CONTACT_PUSH_BATCH_SIZE = 100
+
+# Number of times to try pushing a contact's change.
+CONTACT_PUSH_MAX_ATTEMPTS = 3
+
+# If a contact changes again before it is pushed, the more significant of
+# the two changes is pushed.
+CHANGE_PRIORITY = {
+    ChangeType.updated: 0,
+    ChangeType.created: 1,
+    ChangeType.deleted: 2,
+}
+
+
+def queue_contact_push(org_id, contact_id, change_type):
+    """Queue a local contact change to be pushed with the org's other changes.
+
+    The change is queued once the current transaction commits, so that it is
+    neither pushed before the contact can be loaded nor pushed at all if the
+    transaction is rolled back.
+    """
+    add_contact_push.delay(org_id, contact_id, change_type)
+
+
+@task
+def add_contact_push(org_id, contact_id, change_type):
+    """
+    Task to add a contact change to the org's queue. Changes are collapsed
+    per contact, and pushed once no push has been scheduled for the org for
+    `CONTACT_PUSH_DELAY` seconds.
+    """
+    redis_connection = get_redis_connection()
+    queue_key = CONTACT_PUSH_QUEUE_KEY % org_id
+
+    def update_queue(pipe):
+        # Watched, so the change is retried if another process queues a
+        # change (or the queue is taken) before it is set.
+        queued = pipe.hget(queue_key, contact_id)
+        if queued is None or CHANGE_PRIORITY[ChangeType[queued]] < CHANGE_PRIORITY[change_type]:
+            pipe.multi()
+            pipe.hset(queue_key, contact_id, change_type.name)
+
+    redis_connection.transaction(update_queue, queue_key)
+
+    # Expire the flag in case the scheduled task is lost.
+    scheduled_key = CONTACT_PUSH_SCHEDULED_KEY % org_id
+    if redis_connection.set(scheduled_key, 1, nx=True, ex=CONTACT_PUSH_DELAY * 10):
+        push_org_contact_changes.apply_async((org_id,), countdown=CONTACT_PUSH_DELAY)
+
+
+@task
+def push_org_contact_changes(org_id):
+    """
+    Task to push an org's queued contact changes to RapidPro, a batch at a
+    time. Changes that fail are queued again, up to
+    `CONTACT_PUSH_MAX_ATTEMPTS` times.
+    """
+    from tracpro.groups.models import Group, Region
+    from .models import Contact
+
+    redis_connection = get_redis_connection()
+    redis_connection.delete(CONTACT_PUSH_SCHEDULED_KEY % org_id)
+
+    # Take every queued change, so that changes queued from now on are
+    # pushed by the next task.
+    queue_key = CONTACT_PUSH_QUEUE_KEY % org_id
+    pipe = redis_connection.pipeline()
+    pipe.hgetall(queue_key)
+    pipe.delete(queue_key)
+    changes = pipe.execute()[0]
+    if not changes:
+        return
+
+    org = apps.get_model('orgs', 'Org').objects.get(pk=org_id)
+    region_uuids = set(Region.get_all(org).values_list('uuid', flat=True))
+    group_uuids = set(Group.get_all(org).values_list('uuid', flat=True))
+    failures_key = CONTACT_PUSH_FAILURES_KEY % org_id
+
+    def retry(contact_id, change_type):
+        counts['failed'] += 1
+        attempts = redis_connection.hincrby(failures_key, contact_id, 1)
+        if attempts < CONTACT_PUSH_MAX_ATTEMPTS:
+            add_contact_push(org_id, contact_id, change_type)
+        else:
+            redis_connection.hdel(failures_key, contact_id)
+
+    counts = Counter()
+    contact_ids = sorted(int(contact_id) for contact_id in changes)
+    for i in range(0, len(contact_ids), CONTACT_PUSH_BATCH_SIZE):
+        batch = contact_ids[i:i + CONTACT_PUSH_BATCH_SIZE]
+        contacts = Contact.objects.filter(org=org, pk__in=batch).select_related('region', 'group')
+        for contact in contacts:
+            contact.org = org
+            change_type = ChangeType[changes.pop(str(contact.pk))]
+            try:
+                sync_push_contact(org, contact, change_type, [region_uuids, group_uuids])
+            except Exception:
+                logger.exception("Unable to push %s change to contact %s"
+                                 % (change_type.name.upper(), contact.uuid))
+                retry(contact.pk, change_type)
+            else:
+                counts['pushed'] += 1
+                redis_connection.hdel(failures_key, contact.pk)
+
+    # Contacts that couldn't be loaded (e.g. because they were saved in a
+    # transaction that hadn't committed yet) are tried again later.
+    for contact_id, change_type in changes.items():
+        logger.warning("Unable to load contact #%s to push its %s change"
+                       % (contact_id, change_type.upper()))
+        retry(int(contact_id), ChangeType[change_type])
+
+    logger.info("Pushed %d contact changes for org #%d (%d failed)"
+                % (counts['pushed'], org_id, counts['failed']))
+
+
 @task
 def push_contact_change(contact_id, change_type):
     """
     Task to push a local contact change to RapidPro
+
+    Contacts now queue their changes with `queue_contact_push`; this task
+    remains for changes that were sent before that.
     """
     from tracpro.groups.models import Group, Region
     from .models import Contact
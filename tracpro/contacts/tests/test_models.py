@@ -3,6 +3,8 @@ from __future__ import absolute_import, unicode_literals
 import datetime
 from decimal import Decimal
 
+import mock
+
 import pytz
 
 from temba_client.types import Contact as TembaContact
@@ -100,6 +102,7 @@ class ContactTest(TracProDataTest):
             'urn': 'tel:123',
             'region': self.region1,
             'group': self.group3,
+            'groups': [self.group3],
             'language': 'eng',
             'temba_modified_on': modified_date,
             '_data_field_values': {
@@ -108,8 +111,34 @@ class ContactTest(TracProDataTest):
         })
 
         # try creating contact from them
+        kwargs.pop('groups')
         models.Contact.objects.create(**kwargs)
 
+    def test_kwargs_from_temba__sync_context(self):
+        """Contacts are resolved in memory while a sync context is active."""
+        temba_contacts = [
+            TembaContact.create(
+                uuid='C-10%d' % i, name="Jan", urns=['tel:123'], groups=groups,
+                fields={}, language='eng', modified_on=timezone.now())
+            for i, groups in enumerate([['G-002', 'G-005'], ['G-006', 'G-003']])
+        ]
+
+        with models.ContactSyncContext(self.unicef):
+            with self.assertNumQueries(0):
+                kwargs = [models.Contact.kwargs_from_temba(self.unicef, c) for c in temba_contacts]
+        self.assertEqual(kwargs[0]['region'], self.region2)
+        self.assertEqual(kwargs[0]['groups'], [self.group1])
+        self.assertEqual(kwargs[1]['region'], self.region3)
+        self.assertEqual(kwargs[1]['group'], self.group2)
+
+    def test_kwargs_from_temba__no_region(self):
+        """A contact must belong to one of the org's active Regions."""
+        temba_contact = TembaContact.create(
+            uuid='C-007', name="Jan", urns=['tel:123'], groups=['G-004', 'G-005'],
+            fields={}, language='eng', modified_on=timezone.now())
+        with self.assertRaisesRegexp(ValueError, "none of their groups match an active Region"):
+            models.Contact.kwargs_from_temba(self.unicef, temba_contact)
+
     def test_as_temba(self):
         temba_contact = self.contact1.as_temba()
         self.assertEqual(temba_contact.name, "Ann")
@@ -263,3 +292,83 @@ class TestContactField(TracProTest):
             value="hello",
         )
         self.assertEqual(str(contact_field), "Sam Data Field: hello")
+
+
+class TestContactFieldManager(TracProDataTest):
+
+    def setUp(self):
+        super(TestContactFieldManager, self).setUp()
+        self.gender = factories.DataField(org=self.unicef, key='gender')
+        self.age = factories.DataField(
+            org=self.unicef, key='age', value_type=models.DataField.TYPE_NUMERIC)
+        factories.ContactField(contact=self.contact1, field=self.gender, value="F")
+        factories.ContactField(contact=self.contact1, field=self.age, value="30")
+
+    def get_values(self, contact):
+        return dict(contact.contactfield_set.values_list('field__key', 'value'))
+
+    def test_set_values(self):
+        models.ContactField.objects.set_values(self.unicef, [
+            (self.contact1, {'gender': "F", 'age': 31, 'unknown': "x"}),
+            (self.contact2, {'gender': "", 'age': 40}),
+        ])
+        self.assertEqual(self.get_values(self.contact1), {'gender': "F", 'age': "31"})
+        self.assertEqual(self.get_values(self.contact2), {'gender': None, 'age': "40"})
+        self.assertEqual(models.ContactField.objects.count(), 4)
+
+    def test_set_values__sync_context(self):
+        """Values saved while contacts are synced are written when the batch is flushed."""
+        with models.ContactSyncContext(self.unicef):
+            self.contact2._data_field_values = {'gender': "M"}
+            self.contact2.save()
+            self.contact2._data_field_values = {'age': "25"}
+            self.contact2.save()
+            self.assertEqual(self.get_values(self.contact2), {})
+        self.assertEqual(self.get_values(self.contact2), {'gender': "M", 'age': "25"})
+
+    def test_set_values__sync_context_error(self):
+        """Values queued before an error in a sync are still written."""
+        with self.assertRaises(ValueError):
+            with models.ContactSyncContext(self.unicef):
+                self.contact2._data_field_values = {'gender': "M"}
+                self.contact2.save()
+                raise ValueError()
+        self.assertEqual(self.get_values(self.contact2), {'gender': "M"})
+
+
+@mock.patch('tracpro.trackers.tasks.create_occurrence_trigger_the_alert_action.delay')
+class TestAlertEvents(TracProDataTest):
+
+    def test_membership_changed(self, mock_delay):
+        """Alerts are only evaluated when the contact's membership changes."""
+        self.contact1.name = "Renamed"
+        self.contact1.save()
+        self.assertFalse(mock_delay.called)
+
+        self.contact1.group = self.group2
+        self.contact1.save()
+        mock_delay.assert_called_once_with(self.unicef.pk, [self.contact1.pk])
+
+        mock_delay.reset_mock()
+        self.contact1.groups.add(self.group3)
+        mock_delay.assert_called_once_with(self.unicef.pk, [self.contact1.pk])
+
+    def test_sync_context(self, mock_delay):
+        """Changes within a sync context are sent as one batch of contact ids."""
+        with models.ContactSyncContext(self.unicef):
+            self.contact1.group = self.group2
+            self.contact1.save()
+            self.contact2.groups.add(self.group3)
+            self.group3.all_contacts.add(self.contact2, self.contact3)
+            self.assertFalse(mock_delay.called)
+        mock_delay.assert_called_once_with(
+            self.unicef.pk, sorted([self.contact1.pk, self.contact2.pk, self.contact3.pk]))
+
+    def test_sync_context_error(self, mock_delay):
+        """Changes saved before an error in a sync are still sent."""
+        with self.assertRaises(ValueError):
+            with models.ContactSyncContext(self.unicef):
+                self.contact1.group = self.group2
+                self.contact1.save()
+                raise ValueError()
+        mock_delay.assert_called_once_with(self.unicef.pk, [self.contact1.pk])
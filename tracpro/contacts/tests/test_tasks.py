@@ -0,0 +1,104 @@
+from __future__ import absolute_import, unicode_literals
+
+import mock
+
+from django_redis import get_redis_connection
+
+from dash.utils.sync import ChangeType
+
+from tracpro.test.cases import TracProDataTest
+
+from .. import tasks
+
+
+class TestPushContactChanges(TracProDataTest):
+
+    def setUp(self):
+        super(TestPushContactChanges, self).setUp()
+        self.redis = get_redis_connection()
+        self.queue_key = tasks.CONTACT_PUSH_QUEUE_KEY % self.unicef.pk
+        self.failures_key = tasks.CONTACT_PUSH_FAILURES_KEY % self.unicef.pk
+
+    @mock.patch.object(tasks.push_org_contact_changes, 'apply_async')
+    def test_queue_contact_push(self, mock_apply_async):
+        """Changes to a contact are collapsed, and the org's push is scheduled once."""
+        self.contact1.push(ChangeType.updated)
+        self.contact1.push(ChangeType.created)
+        self.contact1.push(ChangeType.updated)
+        self.contact2.push(ChangeType.updated)
+
+        self.assertEqual(self.redis.hgetall(self.queue_key), {
+            str(self.contact1.pk): 'created',
+            str(self.contact2.pk): 'updated',
+        })
+        mock_apply_async.assert_called_once_with(
+            (self.unicef.pk,), countdown=tasks.CONTACT_PUSH_DELAY)
+
+    @mock.patch.object(tasks.push_org_contact_changes, 'apply_async')
+    def test_queue_contact_push__concurrent(self, mock_apply_async):
+        """A more significant change queued by another process is kept."""
+        self.contact1.push(ChangeType.updated)
+
+        priority = dict(tasks.CHANGE_PRIORITY)
+        compared = []
+
+        def get_priority(change_type):
+            if not compared:
+                # Another process queues a deletion during the comparison.
+                self.redis.hset(self.queue_key, self.contact1.pk, 'deleted')
+            compared.append(change_type)
+            return priority[change_type]
+        mock_priority = mock.MagicMock()
+        mock_priority.__getitem__.side_effect = get_priority
+
+        with mock.patch.object(tasks, 'CHANGE_PRIORITY', mock_priority):
+            self.contact1.push(ChangeType.created)
+
+        self.assertEqual(self.redis.hgetall(self.queue_key), {str(self.contact1.pk): 'deleted'})
+
+    @mock.patch.object(tasks.push_org_contact_changes, 'apply_async')
+    @mock.patch.object(tasks, 'sync_push_contact')
+    def test_push_org_contact_changes(self, mock_sync_push_contact, mock_apply_async):
+        """Queued changes are pushed, and failed changes are queued again."""
+        self.contact1.push(ChangeType.updated)
+        self.contact2.push(ChangeType.deleted)
+
+        def sync_push_contact(org, contact, change_type, groups):
+            if contact == self.contact2:
+                raise Exception("RapidPro is down")
+        mock_sync_push_contact.side_effect = sync_push_contact
+
+        tasks.push_org_contact_changes(self.unicef.pk)
+
+        pushed = [(c[0][1], c[0][2]) for c in mock_sync_push_contact.call_args_list]
+        self.assertEqual(pushed, [
+            (self.contact1, ChangeType.updated),
+            (self.contact2, ChangeType.deleted),
+        ])
+        region_uuids, group_uuids = mock_sync_push_contact.call_args[0][3]
+        self.assertEqual(region_uuids, {'G-001', 'G-002', 'G-003'})
+
+        # The failed change is queued to be tried again.
+        self.assertEqual(self.redis.hgetall(self.queue_key), {str(self.contact2.pk): 'deleted'})
+        self.assertEqual(self.redis.hget(self.failures_key, self.contact2.pk), '1')
+        self.assertEqual(mock_apply_async.call_count, 2)
+
+    @mock.patch.object(tasks.push_org_contact_changes, 'apply_async')
+    @mock.patch.object(tasks, 'sync_push_contact')
+    def test_push_org_contact_changes__missing_contact(self, mock_sync_push_contact, mock_apply_async):
+        """Changes to contacts that can't be loaded yet are queued again."""
+        self.contact1.push(ChangeType.updated)
+        self.redis.hset(self.queue_key, 999999, 'created')
+
+        tasks.push_org_contact_changes(self.unicef.pk)
+
+        pushed = [(c[0][1], c[0][2]) for c in mock_sync_push_contact.call_args_list]
+        self.assertEqual(pushed, [(self.contact1, ChangeType.updated)])
+        self.assertEqual(self.redis.hgetall(self.queue_key), {'999999': 'created'})
+        self.assertEqual(self.redis.hget(self.failures_key, 999999), '1')
+
+        # The change is dropped once it has been tried enough times.
+        for i in range(tasks.CONTACT_PUSH_MAX_ATTEMPTS - 1):
+            tasks.push_org_contact_changes(self.unicef.pk)
+        self.assertEqual(self.redis.hgetall(self.queue_key), {})
+        self.assertIsNone(self.redis.hget(self.failures_key, 999999))
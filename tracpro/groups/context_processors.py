@@ -4,7 +4,8 @@ from __future__ import unicode_literals
 def show_subregions_toggle_form(request):
     show = False
     if request.region:
-        if any(c in request.user_regions for c in request.region.get_descendants()):
+        user_region_ids = set(region.pk for region in request.user_regions)
+        if any(pk in user_region_ids for pk in request.region.get_descendant_ids()):
             show = True
     return {
         'show_subregions_toggle_form': show,
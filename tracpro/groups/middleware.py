@@ -1,5 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
+from .models import Region
+
 
 class UserRegionsMiddleware(object):
 
@@ -26,10 +28,13 @@ class UserRegionsMiddleware(object):
         if request.org and request.user.is_authenticated():
             region_id = request.session.get(
                 '{org}:region_id'.format(org=request.org.pk))
-            region = request.user_regions.filter(pk=region_id).first()
-            if not region and not request.user.is_admin_for(request.org):
+            # The user's region access is cached, so this needs no queries.
+            access = request.user.get_region_access(request.org)
+            regions = access['regions']
+            region = next((r for r in regions if r.pk == region_id), None)
+            if not region and not access['is_admin']:
                 # Only org admins may see "All Regions".
-                region = request.user_regions.first()
+                region = regions[0] if regions else None
             request.region = region
         else:
             request.region = None
@@ -38,8 +43,10 @@ class UserRegionsMiddleware(object):
         # Calculate which org regions to retrieve data for.
         if request.region:
             if request.include_subregions:
-                request.data_regions = request.region.get_descendants(include_self=True)
-                request.data_regions = request.data_regions.filter(pk__in=request.user_regions)
+                user_region_ids = set(request.user.get_all_region_ids(request.org))
+                region_ids = request.region.get_descendant_ids(include_self=True)
+                request.data_regions = Region.objects.filter(
+                    pk__in=[pk for pk in region_ids if pk in user_region_ids])
             else:
                 request.data_regions = [request.region]
         else:
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0008_uuid_is_unique_to_org'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boundary',
+            name='geometry_hash',
+            field=models.CharField(help_text='Hash of the geometry, used to skip unchanged geometries when syncing.', max_length=32, verbose_name='geometry hash', blank=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+from tracpro.groups.utils import simplify_geometry
+
+
+DETAIL_TOLERANCES = {
+    'geometry_low': 0.01,
+    'geometry_medium': 0.001,
+}
+
+
+def simplify_geometries(apps, schema_editor):
+    """Simplify the geometries of existing boundaries."""
+    Boundary = apps.get_model('groups', 'Boundary')
+    for boundary in Boundary.objects.exclude(geometry=''):
+        geometry = json.loads(boundary.geometry)
+        for field, tolerance in DETAIL_TOLERANCES.items():
+            setattr(boundary, field, json.dumps(simplify_geometry(geometry, tolerance)))
+        boundary.save(update_fields=DETAIL_TOLERANCES.keys())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0009_boundary_geometry_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='boundary',
+            name='geometry_low',
+            field=models.TextField(help_text='The geometry simplified for drawing at low detail.', verbose_name='low detail geojson', blank=True),
+        ),
+        migrations.AddField(
+            model_name='boundary',
+            name='geometry_medium',
+            field=models.TextField(help_text='The geometry simplified for drawing at medium detail.', verbose_name='medium detail geojson', blank=True),
+        ),
+        migrations.RunPython(simplify_geometries, migrations.RunPython.noop),
+    ]
@@ -1,20 +1,29 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import defaultdict
+import hashlib
+from itertools import groupby
 import json
 from operator import attrgetter
+import time
 
 from dateutil.relativedelta import relativedelta
 
 from mptt import models as mptt
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models, transaction
-from django.db.models import Count
+from django.db.models import Case, Count, F, Q, Value, When
 from django.utils import timezone
-from django.utils.encoding import python_2_unicode_compatible
+from django.utils.encoding import force_bytes, python_2_unicode_compatible
+from django.utils.text import compress_string
 from django.utils.translation import ugettext_lazy as _
 
 from tracpro.contacts.tasks import SyncOrgContacts
+from tracpro.orgs_ext.utils import clear_cache_version, clear_cache_version_on_commit, get_cache_version
+
+from .utils import simplify_geometry
 
 
 @python_2_unicode_compatible
@@ -46,32 +55,50 @@ class AbstractGroup(models.Model):
 
     @classmethod
     def sync_with_temba(cls, org, uuids):
-        """Sync org groups with the selected UUIDs."""
-        # De-activate any groups that are not specified.
-        other_groups = cls.objects.filter(org=org, is_active=True)
-        other_groups = other_groups.exclude(uuid__in=uuids)
-        for group in other_groups:
-            group.deactivate()
+        """Sync org groups with the selected UUIDs.
 
+        Groups are deactivated, created and updated a set at a time rather
+        than one at a time.
+        """
         # Fetch group details at once.
         temba_groups = org.get_temba_client().get_groups()
         temba_groups = {g.uuid: g.name for g in temba_groups}
 
-        for uuid in uuids:
-            if uuid in temba_groups:
-                # Create a new item or update an existing one.
-                obj, _ = cls.objects.get_or_create(org=org, uuid=uuid)
-                obj.is_active = True
-                obj.name = temba_groups.get(uuid)
-                obj.save()
-            else:
-                # The group was removed remotely and should be removed locally.
-                obj = cls.objects.filter(org=org, uuid=uuid).first()
-                if obj:
-                    obj.deactivate()
+        # De-activate any groups that are not specified, and any that were
+        # removed remotely.
+        selected = set(uuid for uuid in uuids if uuid in temba_groups)
+        removed = set(uuids) - selected
+        unselected = cls.objects.filter(org=org).exclude(uuid__in=selected)
+        cls.deactivate_all(org, unselected.filter(Q(is_active=True) | Q(uuid__in=removed)))
+
+        # Create new items and update existing ones.
+        existing = {g.uuid: g for g in cls.objects.filter(org=org, uuid__in=selected)}
+        new_groups = [cls(org=org, uuid=uuid, name=temba_groups[uuid])
+                      for uuid in selected if uuid not in existing]
+        if new_groups:
+            cls.bulk_create_all(new_groups)
+
+        inactive = [g.pk for g in existing.values() if not g.is_active]
+        if inactive:
+            cls.objects.filter(pk__in=inactive).update(is_active=True)
+
+        renamed = [When(pk=g.pk, then=Value(temba_groups[g.uuid]))
+                   for g in existing.values() if g.name != temba_groups[g.uuid]]
+        if renamed:
+            cls.objects.filter(org=org, uuid__in=selected).update(
+                name=Case(*renamed, default=F('name'), output_field=models.CharField()))
 
         SyncOrgContacts().delay(org.pk)
 
+    @classmethod
+    def deactivate_all(cls, org, groups):
+        """Deactivate each of the org's groups in the queryset at once."""
+        groups.update(is_active=False)
+
+    @classmethod
+    def bulk_create_all(cls, groups):
+        cls.objects.bulk_create(groups)
+
     @classmethod
     def get_all(cls, org):
         return cls.objects.filter(org=org, is_active=True)
@@ -110,6 +137,58 @@ class AbstractGroup(models.Model):
         return self.contacts.filter(is_active=True)
 
 
+REGION_TREE_VERSION_KEY = 'org:%d:region_tree_version'
+
+REGION_TREE_KEY = 'org:%d:region_tree:%s'
+
+REGION_TREE_TTL = 60 * 60 * 24  # 1 day
+
+# Region trees already loaded by this process, as org id -> (version, tree).
+_region_trees = {}
+
+
+class RegionTree(object):
+    """The parent of each of an org's regions, for lookups without queries.
+
+    Includes inactive regions, so that lookups return the same regions as
+    the MPTT queries they replace.
+    """
+
+    def __init__(self, parents):
+        # (region id, parent id) pairs, in tree order.
+        self.parents = dict(parents)
+        self.children = defaultdict(list)
+        for region_id, parent_id in parents:
+            self.children[parent_id].append(region_id)
+
+    def __contains__(self, region_id):
+        return region_id in self.parents
+
+    def get_ancestor_ids(self, region_id, include_self=False):
+        """Return ids of the region's ancestors, starting from the root."""
+        ancestor_ids = [region_id] if include_self else []
+        parent_id = self.parents.get(region_id)
+        while parent_id is not None:
+            ancestor_ids.append(parent_id)
+            parent_id = self.parents.get(parent_id)
+        return ancestor_ids[::-1]
+
+    def get_descendant_ids(self, region_id, include_self=False):
+        """Return ids of the region's descendants, in tree order."""
+        descendant_ids = [region_id] if include_self else []
+        stack = list(reversed(self.children[region_id]))
+        while stack:
+            child_id = stack.pop()
+            descendant_ids.append(child_id)
+            stack.extend(reversed(self.children[child_id]))
+        return descendant_ids
+
+    def get_family_ids(self, region_id):
+        """Return ids of the region's ancestors, the region and its descendants."""
+        return (self.get_ancestor_ids(region_id, include_self=True) +
+                self.get_descendant_ids(region_id))
+
+
 class Region(mptt.MPTTModel, AbstractGroup):
     """A geographical region modelled as a group."""
     users = models.ManyToManyField(
@@ -127,6 +206,55 @@ class Region(mptt.MPTTModel, AbstractGroup):
     class MPTTMeta:
         order_insertion_by = ['name']
 
+    def save(self, *args, **kwargs):
+        super(Region, self).save(*args, **kwargs)
+        Region.clear_tree_cache(self.org_id)
+
+    def delete(self, *args, **kwargs):
+        org_id = self.org_id
+        super(Region, self).delete(*args, **kwargs)
+        Region.clear_tree_cache(org_id)
+
+    @classmethod
+    def get_tree(cls, org_id):
+        """Return the org's RegionTree, from memory or Redis if possible."""
+        version = get_cache_version(REGION_TREE_VERSION_KEY % org_id)
+        loaded_version, tree = _region_trees.get(org_id, (None, None))
+        if loaded_version == version:
+            return tree
+
+        parents = cache.get(REGION_TREE_KEY % (org_id, version))
+        if parents is None:
+            parents = list(cls.objects.filter(org=org_id).order_by(
+                'tree_id', 'lft').values_list('pk', 'parent'))
+            cache.set(REGION_TREE_KEY % (org_id, version), parents, REGION_TREE_TTL)
+
+        tree = RegionTree(parents)
+        _region_trees[org_id] = (version, tree)
+        return tree
+
+    @classmethod
+    def clear_tree_cache(cls, org_id):
+        """Make get_tree() reload the org's regions, now and after the current transaction."""
+        clear_cache_version_on_commit(REGION_TREE_VERSION_KEY % org_id)
+
+    def _get_tree(self):
+        tree = Region.get_tree(self.org_id)
+        if self.pk not in tree:
+            # The region was added without the cache being cleared.
+            Region.clear_tree_cache(self.org_id)
+            tree = Region.get_tree(self.org_id)
+        return tree
+
+    def get_ancestor_ids(self, include_self=False):
+        return self._get_tree().get_ancestor_ids(self.pk, include_self)
+
+    def get_descendant_ids(self, include_self=False):
+        return self._get_tree().get_descendant_ids(self.pk, include_self)
+
+    def get_family_ids(self):
+        return self._get_tree().get_family_ids(self.pk)
+
     @transaction.atomic
     def deactivate(self):
         # Make this region's parent the parent of all of its children.
@@ -135,6 +263,7 @@ class Region(mptt.MPTTModel, AbstractGroup):
                 child.parent = self.parent
                 child.save()
         Region.objects.rebuild()
+        Region.clear_tree_cache(self.org_id)
 
         # Move this node out of the tree.
         # If this region is re-activated, it will appear at the top level.
@@ -147,9 +276,44 @@ class Region(mptt.MPTTModel, AbstractGroup):
 
     @classmethod
     def sync_with_temba(cls, org, uuids):
-        """Rebuild the tree hierarchy after new nodes are added."""
+        """Rebuild the tree hierarchy once after all nodes are synced."""
         super(Region, cls).sync_with_temba(org, uuids)
         Region.objects.rebuild()
+        Region.clear_tree_cache(org.pk)
+
+    @classmethod
+    def deactivate_all(cls, org, regions):
+        """Deactivate each of the org's regions in the queryset at once.
+
+        As with `deactivate()`, each child of a deactivated region is moved
+        to its nearest ancestor that is not being deactivated, and the
+        deactivated regions are moved out of the tree. The tree must be
+        rebuilt afterwards.
+        """
+        deactivated = set(regions.values_list('pk', flat=True))
+        if not deactivated:
+            return
+
+        parents = dict(cls.objects.filter(org=org).values_list('pk', 'parent'))
+        moves = defaultdict(list)  # new parent id -> ids of children to move
+        for region_id, parent_id in parents.items():
+            if region_id not in deactivated and parent_id in deactivated:
+                while parent_id in deactivated:
+                    parent_id = parents[parent_id]
+                moves[parent_id].append(region_id)
+
+        # Update the parents directly; the tree is rebuilt afterwards.
+        for parent_id, region_ids in moves.items():
+            cls.objects.filter(pk__in=region_ids).update(parent=parent_id)
+        cls.objects.filter(pk__in=deactivated).update(is_active=False, parent=None)
+        Region.clear_tree_cache(org.pk)
+
+    @classmethod
+    def bulk_create_all(cls, regions):
+        # The tree fields are set when the tree is rebuilt.
+        for region in regions:
+            region.lft = region.rght = region.tree_id = region.level = 0
+        cls.objects.bulk_create(regions)
 
 
 class Group(AbstractGroup):
@@ -160,6 +324,13 @@ class Group(AbstractGroup):
 # === Boundaries === #
 
 
+BOUNDARY_GEOJSON_VERSION_KEY = 'org:%d:boundary_geojson_version'
+
+BOUNDARY_GEOJSON_KEY = 'org:%d:boundary_geojson:%s:%s'
+
+BOUNDARY_GEOJSON_TTL = 60 * 60 * 24  # 1 day
+
+
 class BoundaryQuerySet(models.QuerySet):
 
     def by_org(self, org):
@@ -176,13 +347,19 @@ class BoundaryManager(models.Manager.from_queryset(BoundaryQuerySet)):
         boundary, _ = self.get_or_create(org=org, rapidpro_uuid=temba_boundary.boundary)
         boundary.name = temba_boundary.name
         boundary.level = temba_boundary.level
-        boundary.geometry = json.dumps(temba_boundary.geometry.serialize())
+        boundary.set_geometry(temba_boundary.geometry.serialize())
         boundary.parent = self.filter(org=org, rapidpro_uuid=temba_boundary.parent).first()
         boundary.save()
         return boundary
 
     def sync(self, org):
-        """Update org Boundaries from RapidPro and delete ones that were removed."""
+        """Update org Boundaries from RapidPro and delete ones that were removed.
+
+        Existing boundaries are loaded once and parents are resolved in
+        memory. Only boundaries that have changed are written, and a
+        boundary's geometry is only rewritten (and simplified) if its hash
+        has changed.
+        """
         # Retrieve current Boundaries known to RapidPro.
         temba_boundaries = org.get_temba_client().get_boundaries()
 
@@ -190,14 +367,54 @@ class BoundaryManager(models.Manager.from_queryset(BoundaryQuerySet)):
         uuids = [b.boundary for b in temba_boundaries]
         Boundary.objects.by_org(org).exclude(rapidpro_uuid__in=uuids).delete()
 
+        existing = self._get_sync_map(org)
+
         # Order boundaries from the highest level (country) to the lowest
-        # (district). This ensures that each boundary's parent (if any)
-        # has been  created before it is updated.
+        # (district). Boundaries are created a level at a time so that each
+        # boundary's parent (if any) has been created before it is saved.
         temba_boundaries.sort(key=attrgetter('level'))
 
-        # Create new or update existing Polls to match RapidPro data.
-        for temba_boundary in temba_boundaries:
-            Boundary.objects.from_temba(org, temba_boundary)
+        with transaction.atomic():
+            for level, level_boundaries in groupby(temba_boundaries, attrgetter('level')):
+                new_boundaries = []
+                for temba_boundary in level_boundaries:
+                    geometry = temba_boundary.geometry.serialize()
+                    parent = existing.get(temba_boundary.parent)
+                    fields = {
+                        'name': temba_boundary.name,
+                        'level': temba_boundary.level,
+                        'parent_id': parent.pk if parent else None,
+                    }
+
+                    boundary = existing.get(temba_boundary.boundary)
+                    if boundary is None:
+                        boundary = Boundary(org=org, rapidpro_uuid=temba_boundary.boundary, **fields)
+                        boundary.set_geometry(geometry)
+                        new_boundaries.append(boundary)
+                        continue
+
+                    changed = {f: v for f, v in fields.items() if getattr(boundary, f) != v}
+                    geometry_hash = Boundary.get_geometry_hash(json.dumps(geometry))
+                    if boundary.geometry_hash != geometry_hash:
+                        changed.update(Boundary.get_geometry_fields(geometry))
+                    if changed:
+                        self.filter(pk=boundary.pk).update(**changed)
+
+                if new_boundaries:
+                    self.bulk_create(new_boundaries)
+                    existing.update(self._get_sync_map(
+                        org, [b.rapidpro_uuid for b in new_boundaries]))
+
+        Boundary.clear_geojson_cache(org.pk)
+
+    def _get_sync_map(self, org, uuids=None):
+        """Map RapidPro uuid to each of the org's Boundaries, without geometry."""
+        boundaries = self.by_org(org)
+        if uuids is not None:
+            boundaries = boundaries.filter(rapidpro_uuid__in=uuids)
+        boundaries = boundaries.only(
+            'pk', 'rapidpro_uuid', 'name', 'level', 'parent', 'geometry_hash')
+        return {b.rapidpro_uuid: b for b in boundaries}
 
 
 class Boundary(models.Model):
@@ -212,6 +429,23 @@ class Boundary(models.Model):
         (LEVEL_DISTRICT, _("District")),
     )
 
+    # Levels of detail at which the geometry can be drawn.
+    DETAIL_LOW = 'low'
+    DETAIL_MEDIUM = 'medium'
+    DETAIL_HIGH = 'high'
+    DETAIL_FIELDS = {
+        DETAIL_LOW: 'geometry_low',
+        DETAIL_MEDIUM: 'geometry_medium',
+        DETAIL_HIGH: 'geometry',
+    }
+
+    # Tolerance (in degrees) used to simplify the geometry for each lower
+    # level of detail. The high detail geometry is not simplified.
+    DETAIL_TOLERANCES = {
+        DETAIL_LOW: 0.01,
+        DETAIL_MEDIUM: 0.001,
+    }
+
     org = models.ForeignKey(
         'orgs.Org',
         verbose_name=_("org"))
@@ -236,6 +470,18 @@ class Boundary(models.Model):
     geometry = models.TextField(
         help_text=_("The GeoJSON geometry of this boundary."),
         verbose_name=_("geojson"))
+    geometry_hash = models.CharField(
+        max_length=32, blank=True,
+        help_text=_("Hash of the geometry, used to skip unchanged geometries when syncing."),
+        verbose_name=_("geometry hash"))
+    geometry_low = models.TextField(
+        blank=True,
+        help_text=_("The geometry simplified for drawing at low detail."),
+        verbose_name=_("low detail geojson"))
+    geometry_medium = models.TextField(
+        blank=True,
+        help_text=_("The geometry simplified for drawing at medium detail."),
+        verbose_name=_("medium detail geojson"))
 
     objects = BoundaryManager()
 
@@ -247,15 +493,71 @@ class Boundary(models.Model):
     def __str__(self):
         return self.name
 
-    def as_geojson(self):
+    @staticmethod
+    def get_geometry_hash(geometry):
+        return hashlib.md5(force_bytes(geometry)).hexdigest()
+
+    @classmethod
+    def get_geometry_fields(cls, geometry):
+        """Return the value of each geometry field for a GeoJSON geometry dict.
+
+        Includes a simplified copy of the geometry for each lower detail.
+        """
+        fields = {'geometry': json.dumps(geometry)}
+        fields['geometry_hash'] = cls.get_geometry_hash(fields['geometry'])
+        for detail, tolerance in cls.DETAIL_TOLERANCES.items():
+            fields[cls.DETAIL_FIELDS[detail]] = json.dumps(simplify_geometry(geometry, tolerance))
+        return fields
+
+    def set_geometry(self, geometry):
+        for field, value in self.get_geometry_fields(geometry).items():
+            setattr(self, field, value)
+        if hasattr(self, '_geojson'):
+            del self._geojson
+
+    @classmethod
+    def get_geojson_payload(cls, org_id, detail=DETAIL_HIGH):
+        """Return the org's boundaries as a serialized GeoJSON payload.
+
+        The payload is cached until the boundaries are next synced. Returns a
+        dict of the gzipped `content`, an `etag` of the uncompressed content,
+        and the timestamp when it was `last_modified`.
+        """
+        version = get_cache_version(BOUNDARY_GEOJSON_VERSION_KEY % org_id)
+        key = BOUNDARY_GEOJSON_KEY % (org_id, version, detail)
+        payload = cache.get(key)
+        if payload is None:
+            # Don't load the geometries for the other levels of detail.
+            unused = [field for other, field in cls.DETAIL_FIELDS.items() if other != detail]
+            boundaries = cls.objects.filter(org=org_id).defer(*unused).order_by('-level')
+            content = json.dumps({
+                'results': {b.pk: b.as_geojson(detail) for b in boundaries},
+            })
+            payload = {
+                'content': compress_string(content),
+                'etag': hashlib.md5(content).hexdigest(),
+                'last_modified': int(time.time()),
+            }
+            cache.set(key, payload, BOUNDARY_GEOJSON_TTL)
+        return payload
+
+    @classmethod
+    def clear_geojson_cache(cls, org_id):
+        """Make the next get_geojson_payload() call reserialize the org's boundaries."""
+        clear_cache_version(BOUNDARY_GEOJSON_VERSION_KEY % org_id)
+
+    def as_geojson(self, detail=DETAIL_HIGH):
         if not hasattr(self, '_geojson'):
-            self._geojson = {
+            self._geojson = {}
+        if detail not in self._geojson:
+            geometry = getattr(self, self.DETAIL_FIELDS[detail]) or self.geometry
+            self._geojson[detail] = {
                 'type': "Feature",
-                'geometry': json.loads(self.geometry),
+                'geometry': json.loads(geometry),
                 'properties': {
                     'id': self.id,
                     'level': self.level,
                     'name': self.name,
                 },
             }
-        return self._geojson
+        return self._geojson[detail]
@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
 from django.test import RequestFactory
 
 from tracpro.test import factories
@@ -17,6 +17,7 @@ class TestUserRegionsMiddleware(TracProTest):
         self.middleware = UserRegionsMiddleware()
         self.org = factories.Org()
         self.user = factories.User()
+        self.session_key = '{}:region_id'.format(self.org.pk)
 
     def get_request(self, **kwargs):
         request_kwargs = {'HTTP_HOST': "{}.testserver".format(self.org.subdomain)}
@@ -106,24 +107,20 @@ class TestUserRegionsMiddleware(TracProTest):
     def test_data_regions__include_subregions(self):
         """Include all subregions user has access to if include_subregions is True."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
+        self.region_kenya.users.add(self.user)
         request = self.get_request(
-            user=self.user, region=self.region_kenya, include_subregions=True,
-            user_regions=user_regions)
+            user=self.user, org=self.org, region=self.region_kenya, include_subregions=True)
         self.middleware.set_data_regions(request)
         self.assertEqual(
             set(request.data_regions),
-            set([self.region_kenya, self.region_nairobi]))
+            set([self.region_kenya, self.region_nairobi, self.region_mombasa]))
 
     def test_data_regions__exclude_subregions(self):
         """Include only the current region if include_subregions is False."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
+        self.region_kenya.users.add(self.user)
         request = self.get_request(
-            user=self.user, region=self.region_kenya, include_subregions=False,
-            user_regions=user_regions)
+            user=self.user, org=self.org, region=self.region_kenya, include_subregions=False)
         self.middleware.set_data_regions(request)
         self.assertEqual(
             set(request.data_regions),
@@ -145,37 +142,49 @@ class TestUserRegionsMiddleware(TracProTest):
         """If region_id is not in the session, admin will see All Regions."""
         self.make_regions()
         self.org.administrators.add(self.user)
-        user_regions = Region.objects.filter(pk__in=(
-            self.region_uganda.pk, self.region_kenya.pk, self.region_nairobi.pk))
-        request = self.get_request(
-            user=self.user, org=self.org, session={}, user_regions=user_regions)
+        request = self.get_request(user=self.user, org=self.org, session={})
         self.middleware.set_region(request)
         self.assertIsNone(request.region)
 
     def test_region__not_set(self):
         """If region_id is not in the session, user will see first of their regions."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
-        request = self.get_request(
-            user=self.user, org=self.org, session={}, user_regions=user_regions)
+        self.region_kenya.users.add(self.user)
+        request = self.get_request(user=self.user, org=self.org, session={})
         self.middleware.set_region(request)
         self.assertEqual(request.region, self.region_kenya)
 
     def test_region__not_in_user_regions(self):
         """If region is not in user regions, return the first of the user's regions."""
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
+        self.region_kenya.users.add(self.user)
         request = self.get_request(
-            user=self.user, org=self.org, session={'region_id': self.region_nairobi.pk},
-            user_regions=user_regions)
+            user=self.user, org=self.org, session={self.session_key: self.region_uganda.pk})
         self.middleware.set_region(request)
         self.assertEqual(request.region, self.region_kenya)
 
     def test_region(self):
         self.make_regions()
-        user_regions = Region.objects.filter(pk=self.region_kenya.pk)
+        self.region_kenya.users.add(self.user)
         request = self.get_request(
-            user=self.user, org=self.org, session={'region_id': self.region_kenya.pk},
-            user_regions=user_regions)
+            user=self.user, org=self.org, session={self.session_key: self.region_nairobi.pk})
         self.middleware.set_region(request)
+        self.assertEqual(request.region, self.region_nairobi)
+
+    def test_process_request__cached(self):
+        """Once the user's region access is cached, regions are set without queries."""
+        self.make_regions()
+        self.region_kenya.users.add(self.user)
+        session = {self.session_key: self.region_kenya.pk}
+        self.middleware.process_request(
+            self.get_request(user=self.user, org=self.org, session=session))
+
+        # A later request loads its own user.
+        request = self.get_request(
+            user=User.objects.get(pk=self.user.pk), org=self.org, session=session)
+        with self.assertNumQueries(0):
+            self.middleware.process_request(request)
         self.assertEqual(request.region, self.region_kenya)
+        self.assertEqual(
+            set(request.data_regions),
+            set([self.region_kenya, self.region_nairobi, self.region_mombasa]))
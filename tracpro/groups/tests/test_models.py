@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 
+import mock
+
 from django.contrib.auth.models import User
+from django.db import connection, transaction
 from django.test.utils import override_settings
 
 from temba_client.types import Group as TembaGroup
@@ -72,6 +75,45 @@ class TestRegion(TracProTest):
             self.makerere,
         ]))
 
+    def test_tree_ids(self):
+        """Cached tree lookups match the MPTT queries."""
+        for region in (self.uganda, self.kampala, self.entebbe, self.makerere,
+                       self.inactive):
+            region.refresh_from_db()
+            self.assertEqual(
+                region.get_ancestor_ids(include_self=True),
+                [r.pk for r in region.get_ancestors(include_self=True)])
+            self.assertEqual(
+                region.get_descendant_ids(),
+                [r.pk for r in region.get_descendants()])
+            self.assertEqual(
+                region.get_family_ids(),
+                [r.pk for r in region.get_family()])
+
+    def test_tree_ids__cleared(self):
+        """The cached tree is reloaded after regions change."""
+        self.assertIn(self.makerere.pk, self.uganda.get_descendant_ids())
+        self.kampala.deactivate()
+        self.assertEqual(
+            set(self.uganda.get_descendant_ids()),
+            set([self.entebbe.pk, self.makerere.pk, self.inactive.pk]))
+
+        kasese = factories.Region(org=self.org, name="Kasese", parent=self.uganda)
+        self.assertIn(kasese.pk, self.uganda.get_descendant_ids())
+        self.assertEqual(kasese.get_ancestor_ids(), [self.uganda.pk])
+
+    def test_tree_ids__cleared_after_commit(self):
+        """A tree cached while regions change is reloaded once the changes commit."""
+        self.kampala.deactivate()
+        # Another process may load and cache the tree before the commit.
+        tree = models.Region.get_tree(self.org.pk)
+        self.assertIs(models.Region.get_tree(self.org.pk), tree)
+
+        # The test case's transaction is still open, so simulate the commit.
+        with mock.patch.object(connection, 'in_atomic_block', False):
+            transaction.signals.post_commit.send(None)
+        self.assertIsNot(models.Region.get_tree(self.org.pk), tree)
+
     def test_deactivate_no_children(self):
         """Deactivation workflow when region has no children."""
         self.makerere.deactivate()
@@ -198,6 +240,24 @@ class TestRegion(TracProTest):
         self.assertEqual(self.mock_temba_client.get_groups.call_count, 1)
         self.assertEqual(self.mock_temba_client.get_contacts.call_count, 2)
 
+    def test_sync_deactivate_nested(self):
+        """Children of deactivated regions move to their nearest remaining ancestor."""
+        self.mock_temba_client.get_groups.return_value = self.temba_groups.values()
+        uuids = ['1', '3']  # no Kampala or Makerere
+        models.Region.sync_with_temba(self.org, uuids)
+        self.refresh_regions()
+
+        self.assertEqual(set(models.Region.get_all(self.org)), set([
+            self.uganda,
+            self.entebbe,
+        ]))
+        self.assertIsNone(self.kampala.parent)
+        self.assertIsNone(self.makerere.parent)
+        self.assertEqual(self.inactive.parent, self.uganda)
+        self.assertEqual(
+            set(self.uganda.get_descendant_ids()),
+            set([self.entebbe.pk, self.inactive.pk]))
+
 
 class TestGroup(TracProDataTest):
 
@@ -345,3 +405,33 @@ class TestBoundary(TracProTest):
         """Smoke test for string representation."""
         boundary = factories.Boundary(name="hello")
         self.assertEqual(str(boundary), "hello")
+
+    def test_sync(self):
+        """Sync should create new Boundaries with parents and update changed ones."""
+        self.temba.name = "new name"
+        child = factories.TembaBoundary(
+            boundary="child", parent=self.boundary.rapidpro_uuid,
+            level=models.Boundary.LEVEL_DISTRICT)
+        self.mock_temba_client.get_boundaries.return_value = [child, self.temba]
+        models.Boundary.objects.sync(self.org)
+
+        self.boundary.refresh_from_db()
+        self.assertEqual(self.boundary.name, "new name")
+        self.assertEqual(
+            self.boundary.geometry_hash,
+            models.Boundary.get_geometry_hash(self.boundary.geometry))
+
+        new_boundary = models.Boundary.objects.get(org=self.org, rapidpro_uuid="child")
+        self.assertEqual(new_boundary.parent, self.boundary)
+        self.assertEqual(new_boundary.level, models.Boundary.LEVEL_DISTRICT)
+        self.assertEqual(new_boundary.name, child.name)
+
+    def test_sync__unchanged_geometry(self):
+        """Sync shouldn't rewrite a geometry whose hash hasn't changed."""
+        self.mock_temba_client.get_boundaries.return_value = [self.temba]
+        models.Boundary.objects.sync(self.org)
+        models.Boundary.objects.filter(pk=self.boundary.pk).update(geometry="unchanged")
+
+        models.Boundary.objects.sync(self.org)
+        self.boundary.refresh_from_db()
+        self.assertEqual(self.boundary.geometry, "unchanged")
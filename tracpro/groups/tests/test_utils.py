@@ -0,0 +1,43 @@
+from __future__ import unicode_literals
+
+from tracpro.test.cases import TracProTest
+
+from .. import utils
+
+
+class TestSimplifyGeometry(TracProTest):
+
+    def test_line(self):
+        """Points close to the line between the points kept are dropped."""
+        points = [[0, 0], [1, 0.001], [2, 0], [2.001, 1], [2, 2]]
+        self.assertEqual(
+            utils.simplify_line(points, 0.01),
+            [[0, 0], [2, 0], [2, 2]])
+        self.assertEqual(utils.simplify_line(points, 0.0001), points)
+
+    def test_polygon(self):
+        ring = [[0, 0], [1, 0.001], [2, 0], [2, 2], [0, 2], [0, 0]]
+        hole = [[1, 1], [1.001, 1], [1, 1.001], [1, 1]]
+        geometry = {'type': "Polygon", 'coordinates': [ring, hole]}
+        self.assertEqual(utils.simplify_geometry(geometry, 0.01), {
+            'type': "Polygon",
+            # The hole is too small to keep.
+            'coordinates': [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]],
+        })
+
+    def test_multipolygon(self):
+        """Polygons that collapse are dropped, unless all of them would be."""
+        square = [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]]
+        speck = [[[5, 5], [5.001, 5], [5, 5.001], [5, 5]]]
+        geometry = {'type': "MultiPolygon", 'coordinates': [square, speck]}
+        self.assertEqual(utils.simplify_geometry(geometry, 0.01), {
+            'type': "MultiPolygon",
+            'coordinates': [square],
+        })
+
+        geometry = {'type': "MultiPolygon", 'coordinates': [speck]}
+        self.assertEqual(utils.simplify_geometry(geometry, 0.01), geometry)
+
+    def test_other_types(self):
+        geometry = {'type': "Point", 'coordinates': [1, 2]}
+        self.assertEqual(utils.simplify_geometry(geometry, 0.01), geometry)
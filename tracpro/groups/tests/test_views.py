@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+from io import BytesIO
+import gzip
 import json
 
 from dateutil.relativedelta import relativedelta
@@ -587,3 +589,72 @@ class TestGroupMostActive(TracProDataTest):
         self.assertEqual(results[1]['id'], self.group2.pk)
         self.assertEqual(results[1]['name'], self.group2.name)
         self.assertEqual(results[1]['response_count'], 1)
+
+
+class TestBoundaryList(TracProDataTest):
+    url_name = "groups.boundary_list"
+
+    def setUp(self):
+        super(TestBoundaryList, self).setUp()
+        self.boundary = factories.Boundary(org=self.unicef)
+        self.boundary.set_geometry({
+            'type': "LineString",
+            'coordinates': [[0, 0], [1, 0.0001], [2, 0]],
+        })
+        self.boundary.save()
+        self.login(self.admin)
+
+    def test_list(self):
+        response = self.url_get('unicef', reverse(self.url_name))
+        results = json.loads(response.content)['results']
+        self.assertEqual(len(results), 1)
+        geometry = results[str(self.boundary.pk)]['geometry']
+        self.assertEqual(len(geometry['coordinates']), 3)
+
+    def test_list__low_detail(self):
+        response = self.url_get('unicef', reverse(self.url_name), {'detail': 'low'})
+        results = json.loads(response.content)['results']
+        geometry = results[str(self.boundary.pk)]['geometry']
+        self.assertEqual(geometry['coordinates'], [[0, 0], [2, 0]])
+
+    def test_list__invalid_detail(self):
+        response = self.url_get('unicef', reverse(self.url_name), {'detail': 'extreme'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_list__gzip(self):
+        response = self.url_get(
+            'unicef', reverse(self.url_name), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        content = gzip.GzipFile(fileobj=BytesIO(response.content)).read()
+        self.assertIn(str(self.boundary.pk), json.loads(content)['results'])
+
+    def test_list__not_modified(self):
+        response = self.url_get('unicef', reverse(self.url_name))
+        etag = response['ETag']
+
+        response = self.url_get('unicef', reverse(self.url_name), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Each level of detail has its own ETag.
+        response = self.url_get(
+            'unicef', reverse(self.url_name), {'detail': 'low'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.url_get(
+            'unicef', reverse(self.url_name), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_list__cleared_by_sync(self):
+        self.url_get('unicef', reverse(self.url_name))
+
+        self.boundary.name = "Renamed"
+        self.boundary.save()
+        response = self.url_get('unicef', reverse(self.url_name))
+        results = json.loads(response.content)['results']
+        self.assertNotEqual(results[str(self.boundary.pk)]['properties']['name'], "Renamed")
+
+        self.mock_temba_client.get_boundaries.return_value = []
+        models.Boundary.objects.sync(self.unicef)
+        response = self.url_get('unicef', reverse(self.url_name))
+        self.assertEqual(json.loads(response.content)['results'], {})
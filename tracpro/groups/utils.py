@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+
+import numpy
+
+
+# Number of decimal places kept in simplified coordinates (about 10cm).
+SIMPLIFIED_DECIMALS = 6
+
+
+def simplify_line(points, tolerance):
+    """Simplify a list of coordinates with the Douglas-Peucker algorithm.
+
+    Keeps the first and last points, and any point that is more than
+    `tolerance` (in coordinate units) from the line through the points that
+    are kept on either side of it.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64)
+    if len(points) < 3:
+        return numpy.round(points, SIMPLIFIED_DECIMALS).tolist()
+
+    keep = numpy.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start = points[first, :2]
+        dx, dy = points[last, :2] - start
+        offsets = points[first + 1:last, :2] - start
+        length = numpy.hypot(dx, dy)
+        if length:
+            distances = numpy.abs(dx * offsets[:, 1] - dy * offsets[:, 0]) / length
+        else:
+            # The ends are the same point, as in a closed ring.
+            distances = numpy.hypot(offsets[:, 0], offsets[:, 1])
+
+        farthest = distances.argmax()
+        if distances[farthest] > tolerance:
+            farthest += first + 1
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return numpy.round(points[keep], SIMPLIFIED_DECIMALS).tolist()
+
+
+def _simplify_polygon(rings, tolerance):
+    """Simplify the rings of a polygon.
+
+    Returns None if the outer ring collapses. Holes that collapse are dropped.
+    """
+    simplified = []
+    for ring in rings:
+        ring = simplify_line(ring, tolerance)
+        if len(ring) >= 4:  # A valid ring is closed and has at least 3 sides.
+            simplified.append(ring)
+        elif not simplified:
+            return None
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance):
+    """Return a simplified copy of a GeoJSON geometry dict.
+
+    Polygons that become too small to draw are dropped, unless all of a
+    geometry's polygons would be. Geometry types that can't be simplified
+    are returned unchanged.
+    """
+    geometry_type = geometry.get('type')
+    coordinates = geometry.get('coordinates')
+    if geometry_type == 'LineString':
+        coordinates = simplify_line(coordinates, tolerance)
+    elif geometry_type == 'MultiLineString':
+        coordinates = [simplify_line(line, tolerance) for line in coordinates]
+    elif geometry_type == 'Polygon':
+        coordinates = _simplify_polygon(coordinates, tolerance)
+    elif geometry_type == 'MultiPolygon':
+        coordinates = [_simplify_polygon(polygon, tolerance) for polygon in coordinates]
+        coordinates = [polygon for polygon in coordinates if polygon] or None
+    else:
+        return geometry
+
+    if coordinates is None:
+        return geometry
+    return dict(geometry, coordinates=coordinates)
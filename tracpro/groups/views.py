@@ -1,5 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
+from io import BytesIO
+import gzip
 import logging
 import json
 
@@ -11,10 +13,13 @@ from django.core.urlresolvers import reverse
 from django.db import transaction
 from django.db.models import Prefetch
 from django.http import (
-    HttpResponseBadRequest, HttpResponseRedirect, JsonResponse)
+    HttpResponse, HttpResponseBadRequest, HttpResponseNotModified,
+    HttpResponseRedirect, JsonResponse)
 from django.shortcuts import redirect
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.utils.decorators import method_decorator
-from django.utils.http import is_safe_url
+from django.utils.http import (
+    http_date, is_safe_url, parse_etags, parse_http_date_safe, quote_etag)
 from django.utils.translation import ugettext_lazy as _
 from django.views.generic import View
 
@@ -242,6 +247,7 @@ class RegionCRUDL(SmartCRUDL):
                     if changed:
                         region.save()
             Region.objects.rebuild()
+            Region.clear_tree_cache(request.org.pk)
 
             return self.success("{} regions have been updated.".format(request.org))
 
@@ -323,10 +329,44 @@ class BoundaryCRUDL(SmartCRUDL):
     actions = ('list',)
 
     class List(OrgPermsMixin, SmartListView):
+        """GeoJSON for each of the org's boundaries.
 
-        def get_queryset(self):
-            return Boundary.objects.by_org(self.request.org).order_by('-level')
+        The `detail` parameter picks how detailed the geometries are
+        (low, medium or high), so that maps can load coarse shapes first.
+        The serialized GeoJSON is cached until boundaries are next synced,
+        and browsers can revalidate it with If-None-Match/If-Modified-Since.
+        """
 
-        def render_to_response(self, context, **response_kwargs):
-            results = {b.pk: b.as_geojson() for b in context['object_list']}
-            return JsonResponse({'results': results})
+        def get(self, request, *args, **kwargs):
+            detail = request.GET.get('detail', Boundary.DETAIL_HIGH)
+            if detail not in Boundary.DETAIL_FIELDS:
+                return HttpResponseBadRequest("Invalid level of detail.")
+
+            payload = Boundary.get_geojson_payload(request.org.pk, detail)
+            if self.is_not_modified(request, payload['etag'], payload['last_modified']):
+                response = HttpResponseNotModified()
+            else:
+                content = payload['content']
+                accepts_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+                if not accepts_gzip:
+                    content = gzip.GzipFile(fileobj=BytesIO(content)).read()
+                response = HttpResponse(content, content_type='application/json')
+                if accepts_gzip:
+                    response['Content-Encoding'] = 'gzip'
+
+            response['ETag'] = quote_etag(payload['etag'])
+            response['Last-Modified'] = http_date(payload['last_modified'])
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+
+        def is_not_modified(self, request, etag, last_modified):
+            if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+            if if_none_match:
+                etags = parse_etags(if_none_match)
+                return '*' in etags or etag in etags
+            if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+            if if_modified_since:
+                if_modified_since = parse_http_date_safe(if_modified_since)
+                return if_modified_since is not None and last_modified <= if_modified_since
+            return False
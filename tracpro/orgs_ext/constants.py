@@ -6,3 +6,4 @@ from enum import Enum
 class TaskType(Enum):
     sync_contacts = 1
     fetch_runs = 2
+    recategorize_answers = 3
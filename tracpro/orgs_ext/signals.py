@@ -1,11 +1,13 @@
 from __future__ import unicode_literals
 
-from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed, post_save
 from django.dispatch import receiver
 
 from dash.orgs.models import Org
 
 from tracpro.contacts.models import DataField
+from tracpro.groups.models import Region
+from tracpro.profiles import clear_region_access_cache
 
 
 @receiver(post_save, sender=Org)
@@ -14,3 +16,23 @@ def set_visible_data_fields(sender, instance, **kwargs):
     if hasattr(instance, '_visible_data_fields'):
         keys = instance._visible_data_fields.values_list('key', flat=True)
         DataField.objects.set_active_for_org(instance, keys)
+
+
+@receiver(m2m_changed, sender=Org.administrators.through)
+def clear_admin_region_access(sender, instance, action, reverse, **kwargs):
+    """Invalidate cached region access when an org's admins change."""
+    if action.startswith('post_'):
+        if reverse:
+            clear_region_access_cache(user=instance)
+        else:
+            clear_region_access_cache(org=instance)
+
+
+@receiver(m2m_changed, sender=Region.users.through)
+def clear_user_region_access(sender, instance, action, reverse, **kwargs):
+    """Invalidate cached region access when a user's regions change."""
+    if action.startswith('post_'):
+        if reverse:
+            clear_region_access_cache(user=instance)
+        else:
+            clear_region_access_cache(org=instance.org)
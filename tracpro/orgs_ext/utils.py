@@ -1,10 +1,23 @@
 from __future__ import unicode_literals
 
+import threading
+import uuid
+
 from requests import HTTPError
 
+from django.core.cache import cache
+from django.db import transaction
+
+# Adds the post_commit and post_rollback signals to `transaction.signals`.
+import djcelery_transactions.transaction_signals  # noqa
+
 from temba_client.base import TembaAPIError
 
 
+# Cache version keys to clear again when the current transaction ends.
+_pending_cache_versions = threading.local()
+
+
 class OrgConfigField(object):
     """
     Allows setting and retrieving of a config field as if it were a normal
@@ -54,3 +67,44 @@ def caused_by_bad_api_key(exception):
             if response is not None and response.status_code == 403:
                 return True
     return False
+
+
+def get_cache_version(key):
+    """Return the version stored in the cache under key, setting one if needed.
+
+    Include the version in the keys of cached data, then call
+    `clear_cache_version` to invalidate all of that data at once.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key)
+    return version
+
+
+def clear_cache_version(key):
+    """Replace the version stored under key, so that data cached with it is ignored."""
+    cache.set(key, uuid.uuid4().hex, None)
+
+
+def clear_cache_version_on_commit(key):
+    """Clear the cache version now, and again when the current transaction ends.
+
+    Until the transaction commits, other processes can only load the data
+    from before it, and may cache that data with the new version.
+    """
+    clear_cache_version(key)
+    if transaction.get_connection().in_atomic_block:
+        _pending_cache_versions.__dict__.setdefault('keys', set()).add(key)
+
+
+def _clear_pending_cache_versions(**kwargs):
+    # Savepoints send the signals too; wait for the outermost block.
+    if not transaction.get_connection().in_atomic_block:
+        for key in _pending_cache_versions.__dict__.pop('keys', ()):
+            clear_cache_version(key)
+
+
+transaction.signals.post_commit.connect(_clear_pending_cache_versions)
+transaction.signals.post_rollback.connect(_clear_pending_cache_versions)
@@ -33,7 +33,7 @@ class OrgExtCRUDL(OrgCRUDL):
 
     class Home(OrgCRUDL.Home):
         fields = ('name', 'timezone', 'api_token', 'last_contact_sync',
-                  'last_flow_run_fetch')
+                  'last_flow_run_fetch', 'last_answer_recategorization')
         field_config = {
             'api_token': {
                 'label': _("RapidPro API Token"),
@@ -65,6 +65,18 @@ class OrgExtCRUDL(OrgCRUDL):
             else:
                 return None
 
+        def get_last_answer_recategorization(self, obj):
+            result = obj.get_task_result(constants.TaskType.recategorize_answers)
+            if result:
+                return "%s (%d changed of %d%s)" % (
+                    format_datetime(ms_to_datetime(result['time'])),
+                    result['counts']['changed'],
+                    result['counts']['processed'],
+                    "" if result.get('complete') else ", in progress",
+                )
+            else:
+                return None
+
     class Edit(InferOrgMixin, OrgPermsMixin, SmartUpdateView):
         fields = ('name', 'timezone', 'contact_fields', 'logo')
         form_class = forms.OrgExtForm
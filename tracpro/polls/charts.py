@@ -1,13 +1,61 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import Counter, defaultdict, namedtuple
+import hashlib
+from itertools import chain
+import json
+
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db.models import Count
+from django.utils.functional import cached_property
 from django.utils.http import urlencode
 
 from tracpro.charts.formatters import format_series, format_x_axis
 from tracpro.groups.models import Region
+from tracpro.orgs_ext.utils import clear_cache_version, get_cache_version
 
 from .models import Answer, Question
-from . import utils
+from .utils import natural_sort_key
+from . import maps, utils
+
+
+# Chart data is cached per question under the org's chart data version,
+# which is replaced whenever the org's responses or questions change.
+CHART_DATA_VERSION_KEY = 'org:%d:chart_data_version'
+
+CHART_DATA_KEY = 'org:%d:question:%d:chart_data:%s:%s'
+
+CHART_DATA_TTL = 60 * 60 * 24  # 1 day
+
+
+def clear_chart_data(org):
+    """Invalidate all cached chart data for the org."""
+    clear_cache_version(CHART_DATA_VERSION_KEY % org.pk)
+
+
+def get_cached_chart_data(org, questions, filters, calculate):
+    """Return a list of (question, chart data...) for each question.
+
+    `filters` is a dict of everything other than the question that the chart
+    data depends on, such as the cleaned filter form data and the current
+    regions. `calculate(questions)` returns a dict of question id to chart
+    data, and is only called with the questions that aren't cached already.
+    """
+    version = get_cache_version(CHART_DATA_VERSION_KEY % org.pk)
+    digest = hashlib.md5(json.dumps(filters, sort_keys=True, default=str)).hexdigest()
+    keys = [(question, CHART_DATA_KEY % (org.pk, question.pk, version, digest))
+            for question in questions]
+
+    cached = cache.get_many([key for _, key in keys])
+    missing = [(question, key) for question, key in keys if key not in cached]
+    if missing:
+        calculated = calculate([question for question, _ in missing])
+        missing = {key: calculated[question.pk] for question, key in missing}
+        cache.set_many(missing, CHART_DATA_TTL)
+        cached.update(missing)
+
+    return [(question,) + tuple(cached[key]) for question, key in keys]
 
 
 def _url(name, args=None, kwargs=None, params=None):
@@ -17,11 +65,22 @@ def _url(name, args=None, kwargs=None, params=None):
     return url
 
 
-def single_pollrun(pollrun, responses, question):
+def _summarize_by_pollrun(answers, responses, summaries=None):
+    if summaries is not None:
+        return summaries.summarize_by_pollrun()
+    return utils.summarize_by_pollrun(answers, responses)
+
+
+def single_pollrun(pollrun, responses, question, summaries=None, word_counts=None):
     """Chart data for a single pollrun.
 
     Will be a word cloud for open-ended questions, and pie chart of categories
     for everything else.
+
+    Pass `summaries` (AnswerSummary queryset matching the responses) to read
+    numeric totals from the precomputed summaries rather than the answers, and
+    `word_counts` (WordCount queryset matching the responses) to read word
+    clouds from the precomputed word counts.
     """
     chart_type = None
     chart_data = []
@@ -31,13 +90,15 @@ def single_pollrun(pollrun, responses, question):
     if answers:
         if question.question_type == Question.TYPE_OPEN:
             chart_type = 'open-ended'
-            chart_data = word_cloud_data(answers)
+            chart_data = word_cloud_data(answers, _for_question(word_counts, question))
         else:
             chart_type = 'bar'
             chart_data = single_pollrun_multiple_choice(answers, pollrun)
 
-            _, answer_avgs, answer_stdevs, response_rates = utils.summarize_by_pollrun(
-                answers, responses)
+            if summaries is not None:
+                summaries = summaries.filter(question=question)
+            _, answer_avgs, answer_stdevs, response_rates = _summarize_by_pollrun(
+                answers, responses, summaries)
             summary_table = [
                 ('Mean', answer_avgs.get(pollrun.pk, 0)),
                 ('Standard deviation', answer_stdevs.get(pollrun.pk, 0)),
@@ -60,13 +121,23 @@ def single_pollrun_multiple_choice(answers, pollrun):
     }
 
 
-def multiple_pollruns(pollruns, responses, question, split_regions, contact_filters):
+def multiple_pollruns(pollruns, responses, question, split_regions, contact_filters,
+                      summaries=None, word_counts=None):
+    """Chart data for all pollruns of a poll.
+
+    Pass `summaries` (AnswerSummary queryset matching the responses) to read
+    numeric totals from the precomputed summaries rather than the answers, and
+    `word_counts` (WordCount queryset matching the responses) to read word
+    clouds from the precomputed word counts.
+    """
     chart_type = None
     chart_data = None
     summary_table = None
 
     pollruns = pollruns.order_by('conducted_on')
     answers = Answer.objects.filter(response__in=responses, question=question)
+    if summaries is not None:
+        summaries = summaries.filter(question=question)
 
     # Save a bit of time with .exists();
     # queryset is re-evaluated later as a values set.
@@ -75,31 +146,50 @@ def multiple_pollruns(pollruns, responses, question, split_regions, contact_filt
             chart_type = 'numeric'
             if split_regions:
                 chart_data, summary_table = multiple_pollruns_numeric_split(
-                    pollruns, answers, responses, question, contact_filters)
+                    pollruns, answers, responses, question, contact_filters, summaries)
             else:
                 chart_data, summary_table = multiple_pollruns_numeric(
-                    pollruns, answers, responses, question, contact_filters)
+                    pollruns, answers, responses, question, contact_filters, summaries)
 
         elif question.question_type == Question.TYPE_OPEN:
             chart_type = 'open-ended'
-            chart_data = word_cloud_data(answers)
+            chart_data = word_cloud_data(answers, _for_question(word_counts, question))
 
         elif question.question_type == Question.TYPE_MULTIPLE_CHOICE:
             chart_type = 'multiple-choice'
             chart_data, summary_table = multiple_pollruns_multiple_choice(
-                pollruns, answers, responses, contact_filters)
+                pollruns, answers, responses, contact_filters, summaries)
 
     return chart_type, chart_data, summary_table
 
 
-def word_cloud_data(answers):
-    """Chart data for multiple pollruns of a poll."""
-    return [{'text': word, 'weight': count} for word, count in answers.word_counts()]
+def word_cloud_data(answers, word_counts=None):
+    """Chart data for multiple pollruns of a poll.
+
+    Pass `word_counts` (WordCount queryset matching the answers) to read the
+    most common words from the precomputed counts.
+    """
+    if word_counts is not None:
+        counts = word_counts.top_words()
+    else:
+        counts = answers.word_counts()
+    return [{'text': word, 'weight': count} for word, count in counts]
+
+
+def _for_question(queryset, question):
+    return queryset.filter(question=question) if queryset is not None else None
 
 
-def multiple_pollruns_multiple_choice(pollruns, answers, responses, contact_filters):
+def multiple_pollruns_multiple_choice(pollruns, answers, responses, contact_filters,
+                                      summaries=None):
+    return _multiple_choice_data(
+        pollruns, answers.category_counts_by_pollrun(),
+        _summarize_by_pollrun(answers, responses, summaries), contact_filters)
+
+
+def _multiple_choice_data(pollruns, category_counts, summary, contact_filters):
     series = []
-    for category, pollrun_counts in answers.category_counts_by_pollrun():
+    for category, pollrun_counts in category_counts:
         series.append(format_series(
             pollruns, pollrun_counts, 'id@polls.pollrun_read', params=contact_filters,
             name=category))
@@ -109,25 +199,28 @@ def multiple_pollruns_multiple_choice(pollruns, answers, responses, contact_filt
         'series': series,
     }
 
-    (answer_sums,
-     answer_avgs,
-     answer_stdevs,
-     response_rates) = utils.summarize_by_pollrun(answers, responses)
+    return chart_data, _summary_table(pollruns, summary)
 
-    summary_table = [
+
+def _summary_table(pollruns, summary):
+    """Summarize data for all pollruns from the data for each pollrun."""
+    answer_sums, answer_avgs, answer_stdevs, response_rates = summary
+    return [
         ('Mean', utils.overall_mean(pollruns, answer_avgs)),
         ('Standard deviation', utils.overall_stdev(pollruns, answer_avgs)),
         ('Response rate average (%)', utils.overall_mean(pollruns, response_rates)),
     ]
 
-    return chart_data, summary_table
+
+def multiple_pollruns_numeric(pollruns, answers, responses, question, contact_filters,
+                              summaries=None):
+    return _numeric_data(
+        pollruns, question, _summarize_by_pollrun(answers, responses, summaries),
+        contact_filters)
 
 
-def multiple_pollruns_numeric(pollruns, answers, responses, question, contact_filters):
-    (answer_sums,
-     answer_avgs,
-     answer_stdevs,
-     response_rates) = utils.summarize_by_pollrun(answers, responses)
+def _numeric_data(pollruns, question, summary, contact_filters):
+    answer_sums, answer_avgs, answer_stdevs, response_rates = summary
 
     sum_data = []
     avg_data = []
@@ -152,23 +245,28 @@ def multiple_pollruns_numeric(pollruns, answers, responses, question, contact_fi
         'participation-urls': participation_urls,
     }
 
-    summary_table = [
-        ('Mean', utils.overall_mean(pollruns, answer_avgs)),
-        ('Standard deviation', utils.overall_stdev(pollruns, answer_avgs)),
-        ('Response rate average (%)', utils.overall_mean(pollruns, response_rates)),
-    ]
+    return chart_data, _summary_table(pollruns, summary)
 
-    return chart_data, summary_table
 
-
-def multiple_pollruns_numeric_split(pollruns, answers, responses, question, contact_filters):
+def multiple_pollruns_numeric_split(pollruns, answers, responses, question, contact_filters,
+                                    summaries=None):
     """Return separate series for each contact region."""
-    data = utils.summarize_by_region_and_pollrun(answers, responses)
-
+    if summaries is not None:
+        data = summaries.summarize_by_region_and_pollrun()
+    else:
+        data = utils.summarize_by_region_and_pollrun(answers, responses)
+    regions = Region.objects.filter(pk__in=data.keys()).order_by('name')
+    return _numeric_split_data(
+        pollruns, regions, data, _summarize_by_pollrun(answers, responses, summaries),
+        contact_filters)
+
+
+def _numeric_split_data(pollruns, regions, data, summary, contact_filters):
+    """`regions` are those in `data`, ordered by name."""
     sum_data = []
     avg_data = []
     rate_data = []
-    for region in Region.objects.filter(pk__in=data.keys()).order_by('name'):
+    for region in regions:
         answer_sums, answer_avgs, answer_stdevs, response_rates = data.get(region.pk)
         region_answer_sums = []
         region_answer_avgs = []
@@ -197,14 +295,180 @@ def multiple_pollruns_numeric_split(pollruns, answers, responses, question, cont
         'participation-urls': participation_urls,
     }
 
-    (pollrun_answer_sums,
-     pollrun_answer_avgs,
-     pollrun_answer_stdevs,
-     pollrun_response_rates) = utils.summarize_by_pollrun(answers, responses)
-    summary_table = [
-        ('Mean', utils.overall_mean(pollruns, pollrun_answer_avgs)),
-        ('Standard deviation', utils.overall_stdev(pollruns, pollrun_answer_avgs)),
-        ('Response rate average (%)', utils.overall_mean(pollruns, pollrun_response_rates)),
-    ]
+    return chart_data, _summary_table(pollruns, summary)
+
+
+AnswerRow = namedtuple('AnswerRow', (
+    'question', 'pollrun', 'region', 'boundary', 'language', 'value',
+    'numeric_value', 'category', 'count'))
+
+
+def poll_questions(pollruns, responses, questions, split_regions, contact_filters,
+                   summaries=None, word_counts=None):
+    """Chart, map and summary data for each of a poll's questions.
+
+    Returns the same data as calling `multiple_pollruns` and
+    `maps.get_map_data` for each question, as a dict of question id to
+    (chart_type, chart_data, map_data, summary_table). The answers to all
+    of the questions are fetched with one query and partitioned in memory,
+    and responses are counted once for all questions.
+
+    If `word_counts` are given, word clouds are read from them, so the
+    answers to open-ended questions are only checked for existence. If
+    `summaries` are given too, numeric data is read from the summaries, and
+    the other answers are only counted by category (which the summaries
+    don't track) rather than fetched.
+    """
+    questions = list(questions)
+    pollruns = list(pollruns.order_by('conducted_on'))
+
+    answers = Answer.objects.filter(response__in=responses, question__in=questions)
+    open_question_ids = set()
+    if word_counts is not None:
+        open_questions = [q for q in questions if q.question_type == Question.TYPE_OPEN]
+        open_answers = answers.filter(question__in=open_questions).order_by()
+        open_question_ids = set(open_answers.values_list('question', flat=True).distinct())
+        answers = answers.exclude(question__in=open_questions)
+    answers_by_question = defaultdict(list)
+    if summaries is not None and word_counts is not None:
+        answers = answers.order_by().values_list(
+            'question', 'response__pollrun', 'response__contact__region__boundary', 'category')
+        answers = answers.annotate(Count('pk'))
+        for question_id, pollrun_id, boundary_id, category, count in answers.iterator():
+            answers_by_question[question_id].append(AnswerRow(
+                question_id, pollrun_id, None, boundary_id, None, None, None, category, count))
+    else:
+        answers = answers.values_list(
+            'question', 'response__pollrun', 'response__contact__region',
+            'response__contact__region__boundary', 'response__contact__language',
+            'value', 'numeric_value', 'category')
+        for row in answers.iterator():
+            answers_by_question[row[0]].append(AnswerRow(*(row + (1,))))
+
+    summarized = _PollSummaries(responses, answers_by_question, summaries)
+
+    data = {}
+    for question in questions:
+        answers = answers_by_question.get(question.pk)
+        chart_type = chart_data = summary_table = map_data = None
+        if question.pk in open_question_ids:
+            chart_type = 'open-ended'
+            chart_data = word_cloud_data(None, word_counts.filter(question=question))
+        elif answers:
+            if question.question_type == Question.TYPE_NUMERIC:
+                chart_type = 'numeric'
+                if split_regions:
+                    region_data = summarized.by_region_and_pollrun(question)
+                    chart_data, summary_table = _numeric_split_data(
+                        pollruns, summarized.get_regions(region_data), region_data,
+                        summarized.by_pollrun(question), contact_filters)
+                else:
+                    chart_data, summary_table = _numeric_data(
+                        pollruns, question, summarized.by_pollrun(question),
+                        contact_filters)
+
+            elif question.question_type == Question.TYPE_OPEN:
+                chart_type = 'open-ended'
+                counts = Counter(chain.from_iterable(utils.extract_words_many(
+                    [a.value for a in answers], [a.language for a in answers])))
+                chart_data = [
+                    {'text': word, 'weight': count}
+                    for word, count in counts.most_common(50)]
+
+            elif question.question_type == Question.TYPE_MULTIPLE_CHOICE:
+                chart_type = 'multiple-choice'
+                chart_data, summary_table = _multiple_choice_data(
+                    pollruns, _category_counts_by_pollrun(answers),
+                    summarized.by_pollrun(question), contact_filters)
+
+            map_data = maps.get_answer_map_data(
+                answers, question, summarized.boundary_averages(question))
+        data[question.pk] = (chart_type, chart_data, map_data, summary_table)
+    return data
+
+
+def _category_counts_by_pollrun(answers):
+    """Same as `AnswerQuerySet.category_counts_by_pollrun`, for answers in memory."""
+    counts = defaultdict(Counter)
+    for a in answers:
+        counts[a.category][a.pollrun] += a.count
+    # Order the data by the category name.
+    counts = sorted(counts.items(), key=lambda (category, _): (category is None, category))
+    counts.sort(key=lambda (category, _): natural_sort_key(category))
+    return counts
+
+
+class _PollSummaries(object):
+    """Numeric summaries of each question's answers, as returned by
+    `utils.summarize_by_pollrun` and `utils.summarize_by_region_and_pollrun`.
+
+    Responses (or answer summaries) are only counted for all questions once
+    each grouping is needed.
+    """
 
-    return chart_data, summary_table
+    def __init__(self, responses, answers_by_question, summaries=None):
+        self.responses = responses
+        self.answers_by_question = answers_by_question
+        self.summaries = summaries
+
+    @cached_property
+    def _by_question_and_pollrun(self):
+        if self.summaries is not None:
+            return self.summaries.summarize_by_question_and_pollrun()
+        response_counts = self.responses.group_counts('pollrun')
+        answer_stats = self._numeric_stats(lambda a: (a.question, a.pollrun))
+        return {
+            question_id: utils.summarize_stats_by_pollrun(stats, response_counts)
+            for question_id, stats in answer_stats.items()
+        }
+
+    @cached_property
+    def _by_question_region_and_pollrun(self):
+        if self.summaries is not None:
+            return self.summaries.summarize_by_question_region_and_pollrun()
+        response_counts = self.responses.group_counts('contact__region', 'pollrun')
+        answer_stats = self._numeric_stats(lambda a: (a.question, (a.region, a.pollrun)))
+        return {
+            question_id: utils.summarize_stats_by_region_and_pollrun(stats, response_counts)
+            for question_id, stats in answer_stats.items()
+        }
+
+    def _numeric_stats(self, key):
+        """Numeric stats of all questions' answers, grouped in one reduction.
+
+        `key(answer)` returns (question id, group). Returns a dict of
+        question id to the stats of each group.
+        """
+        answers = list(chain.from_iterable(self.answers_by_question.values()))
+        stats = utils.numeric_stats(
+            [key(a) for a in answers], [a.numeric_value for a in answers])
+        data = defaultdict(dict)
+        for (question_id, group), group_stats in stats.items():
+            data[question_id][group] = group_stats
+        return data
+
+    @cached_property
+    def _regions(self):
+        region_ids = set(chain.from_iterable(
+            self._by_question_region_and_pollrun.values()))
+        return list(Region.objects.filter(pk__in=region_ids).order_by('name'))
+
+    @cached_property
+    def _boundary_averages(self):
+        return self.summaries.average_by_question_and_boundary()
+
+    def boundary_averages(self, question):
+        """Average numeric answer in each boundary, or None without summaries."""
+        if self.summaries is None:
+            return None
+        return self._boundary_averages.get(question.pk, {})
+
+    def by_pollrun(self, question):
+        return self._by_question_and_pollrun.get(question.pk, ({}, {}, {}, {}))
+
+    def by_region_and_pollrun(self, question):
+        return self._by_question_region_and_pollrun.get(question.pk, {})
+
+    def get_regions(self, region_data):
+        """Return the regions in the data, ordered by name."""
+        return [region for region in self._regions if region.pk in region_data]
@@ -0,0 +1,87 @@
+from __future__ import absolute_import, unicode_literals
+
+import gzip
+import tempfile
+
+from django.core.files import File
+
+from smartmin.templatetags.smartmin import format_datetime
+
+import unicodecsv
+
+from .models import Answer, Response, ResponseExport
+
+
+# Number of responses to read, with their answers, per query.
+EXPORT_CHUNK_SIZE = 1000
+
+
+class Echo(object):
+    """File-like object that returns what is written, rather than storing it."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    """Yield each row formatted as a line of CSV."""
+    writer = unicodecsv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def iter_response_rows(responses, questions):
+    """Yield a header row, then a row for each response with its answers.
+
+    Only the ids of the responses are kept in memory. Responses and their
+    answers are read a chunk at a time, in the order of `responses`.
+    """
+    yield (['Date'] +
+           ['Name', 'URN', 'Region', 'Group'] +
+           [question.name for question in questions])
+
+    response_ids = list(responses.values_list('pk', flat=True))
+    for i in range(0, len(response_ids), EXPORT_CHUNK_SIZE):
+        chunk_ids = response_ids[i:i + EXPORT_CHUNK_SIZE]
+        chunk = Response.objects.filter(pk__in=chunk_ids)
+        chunk = chunk.select_related('contact__region', 'contact__group')
+        chunk = {response.pk: response for response in chunk}
+
+        answers = Answer.objects.filter(response__in=chunk_ids)
+        answers = answers.values_list('response', 'question', 'value')
+        values = {(response_id, question_id): value for response_id, question_id, value in answers}
+
+        for response_id in chunk_ids:
+            response = chunk.get(response_id)
+            if response is None:
+                continue  # Deleted since the export started.
+            contact = response.contact
+            yield ([format_datetime(response.updated_on)] +
+                   [contact.name, contact.urn, contact.region, contact.group] +
+                   [values.get((response_id, question.pk), '') for question in questions])
+
+
+def write_export(export):
+    """Write the export's responses to its file, recording progress as it goes."""
+    responses = export.get_responses()
+    questions = list(export.poll.questions.active())
+    export.total_count = responses.count()
+    export.row_count = 0
+    export.save(update_fields=('total_count', 'row_count'))
+
+    with tempfile.TemporaryFile() as temp:
+        out = gzip.GzipFile(fileobj=temp, mode='wb') if export.compress else temp
+
+        rows = iter_response_rows(responses, questions)
+        for row_count, line in enumerate(iter_csv(rows)):
+            out.write(line)
+            if row_count and row_count % EXPORT_CHUNK_SIZE == 0:
+                ResponseExport.objects.filter(pk=export.pk).update(row_count=row_count)
+
+        if export.compress:
+            out.close()  # writes the gzip trailer; leaves the temp file open
+
+        # The header isn't counted.
+        export.row_count = row_count
+        temp.seek(0)
+        export.file.save(export.get_filename(), File(temp), save=False)
@@ -88,3 +88,27 @@ class PollChartFilterForm(filters.DateRangeFilter, filters.DataFieldFilter,
 
 class PollRunChartFilterForm(filters.DataFieldFilter, filters.FilterForm):
     pass
+
+
+class ResponseExportForm(forms.ModelForm):
+
+    class Meta:
+        model = models.ResponseExport
+        fields = ('poll', 'start_date', 'end_date', 'compress')
+        widgets = {
+            'start_date': forms.widgets.DateInput(attrs={'class': 'datepicker'}),
+            'end_date': forms.widgets.DateInput(attrs={'class': 'datepicker'}),
+        }
+
+    def __init__(self, *args, **kwargs):
+        org = kwargs.pop('org')
+        super(ResponseExportForm, self).__init__(*args, **kwargs)
+        self.fields['poll'].queryset = models.Poll.objects.active().by_org(org).order_by('name')
+
+    def clean(self):
+        cleaned_data = super(ResponseExportForm, self).clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
+            raise forms.ValidationError(_("Start date should be before end date."))
+        return cleaned_data
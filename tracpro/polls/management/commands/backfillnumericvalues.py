@@ -0,0 +1,38 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db.models import Case, FloatField, Value, When
+
+from tracpro.polls.models import Answer
+from tracpro.polls.utils import get_numeric_value
+
+
+# Number of answers to read and update per query.
+BATCH_SIZE = 2000
+
+
+class Command(BaseCommand):
+    help = 'Sets the numeric value of answers that were saved before it was stored'
+
+    def handle(self, *args, **options):
+        answers = Answer.objects.filter(numeric_value=None).exclude(value=None)
+        answers = answers.order_by('pk')
+
+        last_pk = 0
+        updated = 0
+        while True:
+            batch = list(answers.filter(pk__gt=last_pk).values_list('pk', 'value')[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            numeric_values = [(pk, get_numeric_value(value)) for pk, value in batch]
+            numeric_values = [(pk, value) for pk, value in numeric_values if value is not None]
+            if numeric_values:
+                Answer.objects.filter(pk__in=[pk for pk, _ in numeric_values]).update(
+                    numeric_value=Case(
+                        *[When(pk=pk, then=Value(value)) for pk, value in numeric_values],
+                        output_field=FloatField()))
+                updated += len(numeric_values)
+
+        self.stdout.write("Set the numeric value of %d answers" % updated)
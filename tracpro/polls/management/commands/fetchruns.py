@@ -5,7 +5,8 @@ from dateutil.relativedelta import relativedelta
 from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from optparse import make_option
-from tracpro.polls.models import Poll, Response
+from tracpro.polls.models import Poll
+from tracpro.polls.tasks import save_runs
 
 
 class Command(BaseCommand):
@@ -59,22 +60,17 @@ class Command(BaseCommand):
 
         self.stdout.write("Fetched %d runs for org %s" % (len(runs), org.id))
 
+        # Group runs by Poll, ignoring runs for Polls not tracked for this org.
+        runs_by_poll = {}
+        for run in runs:
+            if run.flow in polls_by_flow_uuids:
+                runs_by_poll.setdefault(polls_by_flow_uuids[run.flow], []).append(run)
+
         created = 0
         updated = 0
-        for run in runs:
-            if run.flow not in polls_by_flow_uuids:
-                continue  # Response is for a Poll not tracked for this org.
-
-            poll = polls_by_flow_uuids[run.flow]
-            try:
-                response = Response.from_run(org, run, poll=poll)
-            except ValueError as e:
-                self.stderr.write("Unable to save run #%d due to error: %s" % (run.id, e.message))
-                continue
-
-            if getattr(response, 'is_new', False):
-                created += 1
-            else:
-                updated += 1
+        for poll, poll_runs in runs_by_poll.items():
+            poll_created, poll_updated = save_runs(org, poll, poll_runs)
+            created += poll_created
+            updated += poll_updated
 
         self.stdout.write("Created %d new responses and updated %d existing responses" % (created, updated))
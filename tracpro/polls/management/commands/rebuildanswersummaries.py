@@ -0,0 +1,26 @@
+from __future__ import absolute_import, unicode_literals
+
+from dash.orgs.models import Org
+from django.core.management.base import BaseCommand, CommandError
+from tracpro.polls.models import AnswerSummary, PollRun
+
+
+class Command(BaseCommand):
+    args = "[org_id]"
+    help = 'Recalculates the answer summaries used for numeric charts'
+
+    def handle(self, *args, **options):
+        pollruns = PollRun.objects.all()
+
+        if args:
+            try:
+                org = Org.objects.get(pk=int(args[0]))
+            except (ValueError, Org.DoesNotExist):
+                raise CommandError("No such org with id %s" % args[0])
+            pollruns = pollruns.by_org(org)
+
+        pollrun_ids = list(pollruns.values_list('pk', flat=True))
+        for pollrun_id in pollrun_ids:
+            AnswerSummary.objects.rebuild([pollrun_id])
+
+        self.stdout.write("Rebuilt answer summaries for %d pollruns" % len(pollrun_ids))
@@ -1,16 +1,13 @@
 from __future__ import unicode_literals
 
-from collections import Counter
+from collections import Counter, defaultdict
 from itertools import groupby
 from operator import itemgetter
 
-import numpy
-
-from django.db.models import F
+from django.db.models import Avg, F
 
 from tracpro.charts.formatters import format_number
 
-from .utils import get_numeric_values
 from . import rules
 
 
@@ -33,6 +30,49 @@ def get_map_data(responses, question):
         return None
 
 
+def get_answer_map_data(answers, question, averages=None):
+    """Same as `get_map_data`, for answers to the question already in memory.
+
+    Each answer has `boundary`, `numeric_value`, `category` and `count`
+    attributes, where `count` is the number of answers it stands for. Pass
+    `averages` (boundary id to average numeric answer) to use instead of
+    averaging the answers' numeric values.
+    """
+    answers = [a for a in answers if a.boundary is not None]
+
+    if question.question_type == question.TYPE_NUMERIC:
+        if averages is None:
+            values = defaultdict(list)
+            for a in answers:
+                if a.numeric_value is not None:
+                    values[a.boundary].append(a.numeric_value)
+            averages = {
+                boundary_id: sum(_values) / len(_values)
+                for boundary_id, _values in values.items()
+            }
+        map_data = _numeric_map_data(averages, question)
+    elif question.question_type == question.TYPE_MULTIPLE_CHOICE:
+        categories = defaultdict(Counter)
+        for a in answers:
+            if a.category:
+                categories[a.boundary][a.category] += a.count
+        map_data = {
+            boundary_id: {'category': counts.most_common(1)[0][0]}
+            for boundary_id, counts in categories.items()
+        }
+    else:
+        map_data = None
+
+    if map_data:
+        return {
+            'map-data': map_data,
+            'all-categories': rules.get_all_categories(
+                question, answer_categories=[a.category for a in answers]),
+        }
+    else:
+        return None
+
+
 def get_answers(responses, question):
     """Return answers to the question from the responses, annotated with `boundary`.
 
@@ -45,16 +85,30 @@ def get_answers(responses, question):
 
 
 def numeric_map_data(answers, question):
-    """For each boundary, display the category of the average answer value."""
-    map_data = {}
-    answer_data = answers.order_by('boundary').values('boundary', 'value')
-    for boundary_id, _answers in groupby(answer_data, itemgetter('boundary')):
-        average = round(numpy.mean(get_numeric_values(a['value'] for a in _answers)), 2)
-        map_data[boundary_id] = {
+    """For each boundary, display the category of the average answer value.
+
+    Boundaries without any numeric answers are left out.
+    """
+    answer_data = answers.exclude(numeric_value=None).order_by()
+    answer_data = answer_data.values('response__contact__region__boundary')
+    answer_data = answer_data.annotate(average=Avg('numeric_value'))
+    return _numeric_map_data({
+        a['response__contact__region__boundary']: a['average'] for a in answer_data
+    }, question)
+
+
+def _numeric_map_data(averages, question):
+    """Map each boundary to its rounded average value and that value's category."""
+    boundary_ids = list(averages)
+    rounded = [round(averages[boundary_id], 2) for boundary_id in boundary_ids]
+    categories = question.categorize_many(rounded)
+    return {
+        boundary_id: {
             'average': format_number(average, digits=2),
-            'category': question.categorize(average),
+            'category': category,
         }
-    return map_data
+        for boundary_id, average, category in zip(boundary_ids, rounded, categories)
+    }
 
 
 def multiple_choice_map_data(answers, question):
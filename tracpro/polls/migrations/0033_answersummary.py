@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0008_uuid_is_unique_to_org'),
+        ('polls', '0032_uuid_is_unique_to_pollrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnswerSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('response_count', models.IntegerField(default=0, help_text='Number of active responses')),
+                ('answer_count', models.IntegerField(default=0, help_text='Number of answers to the question')),
+                ('numeric_count', models.IntegerField(default=0, help_text='Number of answers with a numeric value')),
+                ('numeric_sum', models.FloatField(default=0, help_text='Sum of the numeric answer values')),
+                ('numeric_sum_squares', models.FloatField(default=0, help_text='Sum of the squares of the numeric answer values')),
+                ('pollrun', models.ForeignKey(related_name='answer_summaries', to='polls.PollRun')),
+                ('question', models.ForeignKey(related_name='answer_summaries', to='polls.Question')),
+                ('region', models.ForeignKey(related_name='answer_summaries', to='groups.Region')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='answersummary',
+            unique_together=set([('pollrun', 'question', 'region')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0033_answersummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='answer',
+            name='numeric_value',
+            field=models.FloatField(help_text='The value as a number, if it is numeric', null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('orgs', '0014_auto_20150722_1419'),
+        ('groups', '0008_uuid_is_unique_to_org'),
+        ('polls', '0034_answer_numeric_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseExport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('include_subregions', models.BooleanField(default=True)),
+                ('start_date', models.DateField(help_text='Only export pollruns conducted on or after this date', null=True, blank=True)),
+                ('end_date', models.DateField(help_text='Only export pollruns conducted before this date', null=True, blank=True)),
+                ('compress', models.BooleanField(default=False, help_text='Whether to gzip the file')),
+                ('status', models.CharField(default='P', max_length=1, verbose_name='Status', choices=[('P', 'Pending'), ('R', 'Running'), ('C', 'Complete'), ('F', 'Failed')])),
+                ('row_count', models.IntegerField(default=0, help_text='Number of responses written so far')),
+                ('total_count', models.IntegerField(help_text='Number of responses to write', null=True)),
+                ('file', models.FileField(null=True, upload_to='exports/responses')),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+                ('completed_on', models.DateTimeField(null=True)),
+                ('created_by', models.ForeignKey(related_name='response_exports', to=settings.AUTH_USER_MODEL)),
+                ('org', models.ForeignKey(related_name='response_exports', verbose_name='org', to='orgs.Org')),
+                ('poll', models.ForeignKey(related_name='response_exports', verbose_name='Poll', to='polls.Poll')),
+                ('region', models.ForeignKey(related_name='response_exports', blank=True, to='groups.Region', help_text='Only export responses from contacts in this region', null=True)),
+            ],
+        ),
+    ]
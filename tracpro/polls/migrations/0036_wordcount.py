@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('groups', '0008_uuid_is_unique_to_org'),
+        ('polls', '0035_responseexport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('word', models.CharField(max_length=640)),
+                ('count', models.IntegerField(default=0, help_text='Number of times the word appears in active answers')),
+                ('pollrun', models.ForeignKey(related_name='word_counts', to='polls.PollRun')),
+                ('question', models.ForeignKey(related_name='word_counts', to='polls.Question')),
+                ('region', models.ForeignKey(related_name='word_counts', to='groups.Region')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='wordcount',
+            unique_together=set([('pollrun', 'question', 'region', 'word')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hashlib
+import json
+
+from django.db import migrations, models
+
+
+def populate_categorized_rules_hash(apps, schema_editor):
+    """Existing answers were categorized with the question's current rules."""
+    Question = apps.get_model('polls', 'Question')
+    for question in Question.objects.all():
+        rules = json.loads(question.json_rules) if question.json_rules else []
+        # The same hash as `tracpro.polls.rules.get_rules_hash`.
+        question.categorized_rules_hash = hashlib.md5(json.dumps(rules, sort_keys=True)).hexdigest()
+        question.save(update_fields=['categorized_rules_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0036_wordcount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='categorized_rules_hash',
+            field=models.CharField(help_text='Hash of the rules that the answers were last categorized with', max_length=32, blank=True),
+        ),
+        migrations.RunPython(populate_categorized_rules_hash, migrations.RunPython.noop),
+    ]
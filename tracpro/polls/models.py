@@ -1,24 +1,37 @@
 from __future__ import absolute_import, unicode_literals
 
-from collections import Counter, OrderedDict
-from itertools import chain, groupby
+from collections import Counter, OrderedDict, defaultdict
+import datetime
+from itertools import chain, groupby, islice
 import json
 from operator import itemgetter
+import zlib
 
+import numpy
 import pytz
 
 from django.conf import settings
-from django.db import models, transaction
-from django.db.models import Count, Q
+from django.core.cache import cache
+from django.db import connection, models, transaction
+from django.db.models import Avg, Case, Count, F, Max, Q, StdDev, Sum, Value, When
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
+from dash.utils import datetime_to_ms
+
 from tracpro.contacts.models import Contact
 
 from . import rules
-from .tasks import pollrun_start
-from .utils import extract_words, natural_sort_key
+from .tasks import pollrun_start, queue_recategorize_answers
+from .utils import extract_words_many, get_numeric_value, natural_sort_key, summarize_totals
+
+
+# Number of rows to write per query when bulk-creating responses and answers.
+BULK_BATCH_SIZE = 500
+
+# Number of answers to extract words from at once when counting words.
+WORD_COUNT_BATCH_SIZE = 2000
 
 
 class PollQuerySet(models.QuerySet):
@@ -154,7 +167,7 @@ class QuestionManager(models.Manager.from_queryset(QuestionQuerySet)):
 
     def from_temba(self, poll, temba_question, order):
         """Create new or update existing Question from RapidPro data."""
-        question, _ = self.get_or_create(poll=poll, ruleset_uuid=temba_question.uuid)
+        question, created = self.get_or_create(poll=poll, ruleset_uuid=temba_question.uuid)
 
         if question.name == question.rapidpro_name:
             # Name is tracking RapidPro name so we must update both.
@@ -164,16 +177,20 @@ class QuestionManager(models.Manager.from_queryset(QuestionQuerySet)):
             question.rapidpro_name = temba_question.label
 
         # Save the rules used to categorize answers to this question.
-        rules = []
+        question_rules = []
         for rule_set in question.poll.get_flow_definition().rule_sets:
             if rule_set['uuid'] == question.ruleset_uuid:  # Find the first matching rule set.
                 for rule in rule_set['rules'][:-1]:  # The last rule is always "Other".
-                    rules.append({
+                    question_rules.append({
                         'category': rule['category'],
                         'test': rule['test'],
                     })
                 break
-        question.json_rules = json.dumps(rules)
+        question.set_rules(question_rules)
+        rules_hash = rules.get_rules_hash(question_rules)
+        if created:
+            # A new question has no answers to recategorize.
+            question.categorized_rules_hash = rules_hash
 
         # The user can alter or correct the question's type after it is
         # initially set, so we shouldn't override the existing type.
@@ -183,6 +200,11 @@ class QuestionManager(models.Manager.from_queryset(QuestionQuerySet)):
         question.order = order
         question.save()
 
+        if question.categorized_rules_hash != rules_hash:
+            # Answers were categorized with other rules. Queued on every sync
+            # until a task has recategorized them, in case a task is lost.
+            queue_recategorize_answers(poll.org_id, question.pk)
+
         return question
 
 
@@ -220,6 +242,9 @@ class Question(models.Model):
     json_rules = models.TextField(
         blank=True,
         verbose_name=_("RapidPro rules"))
+    categorized_rules_hash = models.CharField(
+        max_length=32, blank=True,
+        help_text=_("Hash of the rules that the answers were last categorized with"))
 
     objects = QuestionManager()
 
@@ -239,16 +264,50 @@ class Question(models.Model):
 
     def categorize(self, value):
         """Return the first category that the value matches."""
-        for rule in self.get_rules():
-            if rules.passes_test(value, rule):
-                return rules.get_category(rule)
+        for rule in self.get_compiled_rules():
+            if rule.passes(value):
+                return rule.category
         return "Other"
 
+    def can_categorize(self):
+        """Return whether answers can be categorized here as RapidPro would.
+
+        Only numeric tests with numeric arguments are implemented.
+        """
+        return all(rule.test is not None for rule in self.get_compiled_rules())
+
+    def categorize_many(self, values):
+        """Return the first category that each of an array of numbers matches.
+
+        Non-numeric values should be NaN. Returns a NumPy array of the
+        categories, the same as calling `categorize` for each value.
+        """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        categories = numpy.empty(values.shape, dtype=object)
+        categories.fill("Other")
+        unmatched = numpy.ones(values.shape, dtype=bool)
+        for rule in self.get_compiled_rules():
+            matched = unmatched & rule.passes_many(values)
+            categories[matched] = rule.category
+            unmatched &= ~matched
+        return categories
+
     def get_rules(self):
         if not hasattr(self, "_rules"):
             self._rules = json.loads(self.json_rules) if self.json_rules else []
         return self._rules
 
+    def set_rules(self, rules):
+        self.json_rules = json.dumps(rules)
+        self._rules = rules
+        if hasattr(self, "_compiled_rules"):
+            del self._compiled_rules
+
+    def get_compiled_rules(self):
+        if not hasattr(self, "_compiled_rules"):
+            self._compiled_rules = [rules.CompiledRule(rule) for rule in self.get_rules()]
+        return self._compiled_rules
+
     def guess_question_type(self):
         """Inspect rules applied to question input to guess data type.
 
@@ -273,6 +332,9 @@ class Question(models.Model):
         This allows us to track changes to the name on RapidPro.
         """
         self.name = "" if self.name == self.rapidpro_name else self.name.strip()
+        if self.pk is None:
+            # A new question has no answers, so none need to be recategorized.
+            self.categorized_rules_hash = rules.get_rules_hash(self.get_rules())
         super(Question, self).save(*args, **kwargs)
         self.name = self.name or self.rapidpro_name
 
@@ -299,7 +361,7 @@ class PollRunQuerySet(models.QuerySet):
         q = Q(region=region)
 
         # Include PollRuns that include this region as a sub-region.
-        q |= Q(region__in=region.get_ancestors(),
+        q |= Q(region__in=region.get_ancestor_ids(),
                pollrun_type=PollRun.TYPE_PROPAGATED)
 
         # Include poll runs that weren't sent to a particular region.
@@ -307,7 +369,7 @@ class PollRunQuerySet(models.QuerySet):
 
         # Include PollRuns that were sent to the region's sub-regions.
         if include_subregions:
-            q |= Q(region__in=region.get_descendants())
+            q |= Q(region__in=region.get_descendant_ids())
 
         return self.filter(q)
 
@@ -397,6 +459,11 @@ class PollRun(models.Model):
         (TYPE_PROPAGATED, _('Propagated to sub-children')),
     )
 
+    # Keyed on the latest response, so only contacts moving between groups
+    # or regions can make a cached breakdown stale.
+    PARTICIPATION_CACHE_KEY = 'pollrun:%d:participation:%s:%d:%d:%d:%d'
+    PARTICIPATION_CACHE_TTL = 60 * 60  # 1 hour
+
     pollrun_type = models.CharField(
         max_length=1, editable=False, choices=TYPE_CHOICES)
 
@@ -442,14 +509,14 @@ class PollRun(models.Model):
             return True
         if self.pollrun_type == self.TYPE_REGIONAL:
             if include_subregions:
-                return region in self.region.get_ancestors()
+                return region.pk in self.region.get_ancestor_ids()
             else:  # pragma: nocover
                 return region == self.region
         if self.pollrun_type == self.TYPE_PROPAGATED:
             if include_subregions:
-                return region in self.region.get_family()
+                return region.pk in self.region.get_family_ids()
             else:
-                return region in self.region.get_descendants()
+                return region.pk in self.region.get_descendant_ids()
 
     def get_responses(self, region=None, include_subregions=True,
                       include_empty=True):
@@ -463,7 +530,7 @@ class PollRun(models.Model):
             contact__is_active=True)  # Filter out inactive contacts
         if region:
             if include_subregions:
-                regions = region.get_descendants(include_self=True)
+                regions = region.get_descendant_ids(include_self=True)
                 responses = responses.filter(contact__region__in=regions)
             else:
                 responses = responses.filter(contact__region=region)
@@ -480,6 +547,30 @@ class PollRun(models.Model):
         results.update({sc['status']: sc['count'] for sc in status_counts})
         return results
 
+    def get_participation_counts(self, group_by, region=None, include_subregions=True):
+        """Returns response counts by status for each contact group or region.
+
+        `group_by` is either 'group' or 'region'. Maps each group or region
+        id (None for contacts without one) to the counts of its responses.
+        Counted in a single query, and cached until the responses change.
+        """
+        responses = self.get_responses(region, include_subregions).order_by()
+        latest = responses.aggregate(updated_on=Max('updated_on'), count=Count('pk'))
+        cache_key = self.PARTICIPATION_CACHE_KEY % (
+            self.pk, group_by, region.pk if region else 0, int(include_subregions),
+            datetime_to_ms(latest['updated_on']) if latest['updated_on'] else 0,
+            latest['count'])
+        counts = cache.get(cache_key)
+        if counts is None:
+            field = 'contact__%s' % group_by
+            counts = {}
+            for row in responses.values(field, 'status').annotate(count=Count('pk')):
+                group_counts = counts.setdefault(
+                    row[field], {status[0]: 0 for status in Response.STATUS_CHOICES})
+                group_counts[row['status']] = row['count']
+            cache.set(cache_key, counts, self.PARTICIPATION_CACHE_TTL)
+        return counts
+
     def is_last_for_region(self, region):
         """Return whether this was the last PollRun conducted in the region.
 
@@ -501,11 +592,9 @@ class ResponseQuerySet(models.QuerySet):
 
     def group_counts(self, *fields):
         """Group responses by the given fields then map to the count of matching responses."""
-        responses = self.order_by(*fields).values(*fields)
-        data = {}
-        for field_values, _responses in groupby(responses, itemgetter(*fields)):
-            data[field_values] = len(list(_responses))
-        return data
+        responses = self.order_by().values(*fields).annotate(count=Count('pk'))
+        key = itemgetter(*fields)
+        return {key(r): r['count'] for r in responses}
 
 
 class Response(models.Model):
@@ -555,12 +644,19 @@ class Response(models.Model):
         contact = Contact.get_or_fetch(org, uuid=run.contact)
 
         # de-activate any existing responses for this contact
-        pollrun.responses.filter(contact=contact).update(is_active=False)
+        existing = pollrun.responses.filter(contact=contact)
+        AnswerSummary.objects.remove_responses(existing)
+        WordCount.objects.remove_responses(existing)
+        existing.update(is_active=False)
 
-        return Response.objects.create(
+        response = Response.objects.create(
             flow_run_id=run.id, pollrun=pollrun, contact=contact,
             created_on=run.created_on, updated_on=run.created_on,
             status=Response.STATUS_EMPTY)
+        created = Response.objects.filter(pk=response.pk)
+        AnswerSummary.objects.add_responses(created)
+        WordCount.objects.add_responses(created)
+        return response
 
     @classmethod
     def from_run(cls, org, run, poll=None):
@@ -569,69 +665,206 @@ class Response(models.Model):
         up-to-date with provided run, then it is updated. If the run doesn't
         match with an existing poll pollrun, it's assumed to be non-regional.
         """
-        response = Response.objects.filter(pollrun__poll__org=org, flow_run_id=run.id)
-        response = response.select_related('pollrun').first()
-        run_updated_on = cls.get_run_updated_on(run)
+        responses, failures = cls.from_runs(org, [run], poll=poll)
+        if failures:
+            _run, error = failures[0]
+            raise error
+        return responses[0]
 
-        # if there is an up-to-date existing response for this run, return it
-        if response and response.updated_on == run_updated_on:
-            return response
+    @classmethod
+    @transaction.atomic
+    def from_runs(cls, org, runs, poll=None):
+        """
+        Batched version of `from_run` for ingesting many flow runs at once.
 
-        if not poll:
-            poll = Poll.objects.active().by_org(org).get(flow_uuid=run.flow)
+        Existing responses and contacts are looked up in bulk, and new
+        responses and answers are written with `bulk_create`. Returns a tuple
+        of the responses (in run order, with `is_new` set on those that were
+        created) and a list of `(run, error)` for runs whose contact could not
+        be saved.
+        """
+        # If the same run is given more than once, the last copy wins.
+        runs = OrderedDict((run.id, run) for run in runs).values()
+        if not runs:
+            return [], []
+
+        existing = Response.objects.filter(pollrun__poll__org=org)
+        existing = existing.filter(flow_run_id__in=[run.id for run in runs])
+        existing = existing.select_related('pollrun').order_by('-pk')
+        existing = {response.flow_run_id: response for response in existing}
+
+        # Skip runs that have an up-to-date response.
+        responses = {}
+        pending = []
+        for run in runs:
+            response = existing.get(run.id)
+            if response and response.updated_on == cls.get_run_updated_on(run):
+                responses[run.id] = response
+            else:
+                pending.append(run)
+
+        polls = cls._get_run_polls(org, pending, poll)
+        contacts, failures = cls._get_run_contacts(org, pending)
+        pending = [run for run in pending if run.contact in contacts]
+
+        stale = []
+        new = []
+        for run in pending:
+            run_updated_on = cls.get_run_updated_on(run)
+            status = cls.get_run_status(run)
+            response = existing.get(run.id)
+            if response:
+                response.updated_on = run_updated_on
+                response.status = status
+                stale.append(response)
+            else:
+                response = Response(
+                    flow_run_id=run.id, contact=contacts[run.contact],
+                    created_on=run.created_on, updated_on=run_updated_on,
+                    status=status)
+                response.is_new = True
+                new.append((run, response))
+            responses[run.id] = response
+
+        if stale:
+            # Clear existing answers which will be replaced.
+            stale_responses = Response.objects.filter(pk__in=[r.pk for r in stale])
+            AnswerSummary.objects.remove_responses(stale_responses)
+            WordCount.objects.remove_responses(stale_responses)
+            Answer.objects.filter(response__in=stale).delete()
+            cls._bulk_update_status(stale)
+
+        if new:
+            cls._bulk_create_universal(polls, new)
+
+        # Convert valuesets to answers.
+        answers = []
+        questions = {}
+        for run in pending:
+            run_poll = polls[run.flow]
+            if run_poll.pk not in questions:
+                questions[run_poll.pk] = list(run_poll.questions.active())
+            valuesets_by_ruleset = {valueset.node: valueset for valueset in run.values}
+            for question in questions[run_poll.pk]:
+                valueset = valuesets_by_ruleset.get(question.ruleset_uuid)
+                if valueset:
+                    answers.append(Answer.objects.build(
+                        response=responses[run.id],
+                        question=question,
+                        value=valueset.value,
+                        category=valueset.category,
+                        submitted_on=valueset.time,
+                    ))
+        Answer.objects.bulk_create(answers, batch_size=BULK_BATCH_SIZE)
+
+        saved = Response.objects.filter(
+            pk__in=[r.pk for r in stale] + [r.pk for _run, r in new])
+        AnswerSummary.objects.add_responses(saved)
+        WordCount.objects.add_responses(saved)
+
+        return [responses[run.id] for run in runs if run.id in responses], failures
 
-        contact = Contact.get_or_fetch(poll.org, uuid=run.contact)
+    @classmethod
+    def _get_run_polls(cls, org, runs, poll=None):
+        """Map the flow UUID of each run to its active Poll."""
+        if poll:
+            return {run.flow: poll for run in runs}
+        flow_uuids = set(run.flow for run in runs)
+        polls = Poll.objects.active().by_org(org).filter(flow_uuid__in=flow_uuids)
+        polls = {p.flow_uuid: p for p in polls.select_related('org')}
+        missing = flow_uuids - set(polls.keys())
+        if missing:
+            raise Poll.DoesNotExist(
+                "No active Poll for {} matching these UUIDs: {}".format(
+                    org.name, ', '.join(missing)))
+        return polls
 
-        # categorize completeness
-        if run.completed:
-            status = Response.STATUS_COMPLETE
-        elif run.values:
-            status = Response.STATUS_PARTIAL
-        else:
-            status = Response.STATUS_EMPTY
+    @classmethod
+    def _get_run_contacts(cls, org, runs):
+        """Map the contact UUID of each run to its Contact.
 
-        if response:
-            # clear existing answers which will be replaced
-            response.answers.all().delete()
+        Contacts that we don't have locally are fetched from RapidPro one at
+        a time. Returns the contact map and a list of `(run, error)` for runs
+        whose contact could not be saved.
+        """
+        uuids = set(run.contact for run in runs)
+        contacts = Contact.objects.filter(org=org, uuid__in=uuids)
+        contacts = {c.uuid: c for c in contacts.select_related('region', 'group')}
+
+        failures = []
+        for run in runs:
+            if run.contact not in contacts:
+                try:
+                    contacts[run.contact] = Contact.get_or_fetch(org, uuid=run.contact)
+                except ValueError as e:
+                    failures.append((run, e))
+        return contacts, failures
 
-            response.updated_on = run_updated_on
-            response.status = status
-            response.save(update_fields=('updated_on', 'status'))
-        else:
-            # if we don't have an existing response, then this poll started in
-            # RapidPro and is non-regional
-            pollrun = PollRun.objects.get_or_create_universal(
-                poll=poll,
-                for_date=run.created_on,
-            )
-
-            # if contact has an older response for this pollrun, retire it
-            Response.objects.filter(pollrun=pollrun, contact=contact).update(is_active=False)
-
-            response = Response.objects.create(
-                flow_run_id=run.id, pollrun=pollrun, contact=contact,
-                created_on=run.created_on, updated_on=run_updated_on,
-                status=status)
-            response.is_new = True
-
-        # organize values by ruleset UUID
-        questions = poll.questions.active()
-        valuesets_by_ruleset = {valueset.node: valueset for valueset in run.values}
-        valuesets_by_question = {q: valuesets_by_ruleset.get(q.ruleset_uuid, None)
-                                 for q in questions}
-
-        # convert valuesets to answers
-        for question, valueset in valuesets_by_question.iteritems():
-            if valueset:
-                Answer.objects.create(
-                    response=response,
-                    question=question,
-                    value=valueset.value,
-                    category=valueset.category,
-                    submitted_on=valueset.time,
-                )
+    @classmethod
+    def _bulk_update_status(cls, responses):
+        """Save the updated_on and status of each response in one query."""
+        pks = [r.pk for r in responses]
+        Response.objects.filter(pk__in=pks).update(
+            updated_on=Case(
+                *[When(pk=r.pk, then=Value(r.updated_on)) for r in responses],
+                output_field=models.DateTimeField()),
+            status=Case(
+                *[When(pk=r.pk, then=Value(r.status)) for r in responses],
+                output_field=models.CharField()),
+        )
 
-        return response
+    @classmethod
+    def _bulk_create_universal(cls, polls, new):
+        """Create responses for runs that started in RapidPro.
+
+        If we don't have an existing response, then the poll started in
+        RapidPro and is non-regional.
+        """
+        pollruns = {}
+        by_pollrun = OrderedDict()
+        for run, response in new:
+            run_poll = polls[run.flow]
+            org_timezone = pytz.timezone(run_poll.org.timezone)
+            key = (run_poll.pk, run.created_on.astimezone(org_timezone).date())
+            if key not in pollruns:
+                pollruns[key] = PollRun.objects.get_or_create_universal(
+                    poll=run_poll, for_date=run.created_on)
+            response.pollrun = pollruns[key]
+            by_pollrun.setdefault(response.pollrun, OrderedDict())
+
+            # The latest run for a contact replaces any earlier ones.
+            latest = by_pollrun[response.pollrun]
+            if response.contact.pk in latest:
+                latest[response.contact.pk].is_active = False
+            latest[response.contact.pk] = response
+
+        # If contact has an older response for this pollrun, retire it.
+        for pollrun, latest in by_pollrun.items():
+            retired = Response.objects.filter(pollrun=pollrun, contact__in=latest.keys())
+            AnswerSummary.objects.remove_responses(retired)
+            WordCount.objects.remove_responses(retired)
+            retired.update(is_active=False)
+
+        responses = [response for _run, response in new]
+        Response.objects.bulk_create(responses, batch_size=BULK_BATCH_SIZE)
+
+        # Bulk-created instances don't have their primary keys set.
+        created = Response.objects.filter(
+            pollrun__in=by_pollrun.keys(),
+            flow_run_id__in=[r.flow_run_id for r in responses])
+        created = {(r.pollrun_id, r.flow_run_id): r.pk for r in created}
+        for response in responses:
+            response.pk = created[(response.pollrun.pk, response.flow_run_id)]
+
+    @classmethod
+    def get_run_status(cls, run):
+        """Categorize the completeness of the run."""
+        if run.completed:
+            return Response.STATUS_COMPLETE
+        elif run.values:
+            return Response.STATUS_PARTIAL
+        else:
+            return Response.STATUS_EMPTY
 
     @classmethod
     def get_run_updated_on(cls, run):
@@ -647,8 +880,8 @@ class Response(models.Model):
 class AnswerQuerySet(models.QuerySet):
 
     def word_counts(self):
-        answers = self.values_list('value', 'response__contact__language')
-        words = [extract_words(*a) for a in answers]
+        answers = list(self.values_list('value', 'response__contact__language'))
+        words = extract_words_many([a[0] for a in answers], [a[1] for a in answers])
         counts = Counter(chain(*words))
         return counts.most_common(50)
 
@@ -660,6 +893,25 @@ class AnswerQuerySet(models.QuerySet):
             data[field_values] = [a['value'] for a in _answers]
         return data
 
+    def numeric_stats(self, *fields):
+        """Group answers by the given fields then map to the answer count and
+        the sum, average and standard deviation of the numeric values.
+
+        Calculated by the database from `numeric_value`. The sum, average and
+        standard deviation are None if none of the answers are numeric.
+        """
+        answers = self.order_by().values(*fields).annotate(
+            answer_count=Count('pk'),
+            numeric_sum=Sum('numeric_value'),
+            numeric_avg=Avg('numeric_value'),
+            numeric_stdev=StdDev('numeric_value'),
+        )
+        key = itemgetter(*fields)
+        return {
+            key(a): (a['answer_count'], a['numeric_sum'], a['numeric_avg'], a['numeric_stdev'])
+            for a in answers
+        }
+
     def category_counts(self):
         categories = self.values_list('category', flat=True)
         counts = Counter(categories)
@@ -679,7 +931,16 @@ class AnswerQuerySet(models.QuerySet):
 
 class AnswerManager(models.Manager.from_queryset(AnswerQuerySet)):
 
+    def build(self, category, **kwargs):
+        """Return an unsaved Answer, e.g., for use with `bulk_create`."""
+        kwargs['numeric_value'] = get_numeric_value(kwargs.get('value'))
+        return self.model(category=self._clean_category(category), **kwargs)
+
     def create(self, category, **kwargs):
+        return super(AnswerManager, self).create(
+            category=self._clean_category(category), **kwargs)
+
+    def _clean_category(self, category):
         # category can be a string or a multi-language dict
         if isinstance(category, dict):
             if 'base' in category:
@@ -690,7 +951,7 @@ class AnswerManager(models.Manager.from_queryset(AnswerQuerySet)):
         if category == 'All Responses':
             category = None
 
-        return super(AnswerManager, self).create(category=category, **kwargs)
+        return category
 
 
 class Answer(models.Model):
@@ -699,8 +960,419 @@ class Answer(models.Model):
     response = models.ForeignKey('polls.Response', related_name='answers')
     question = models.ForeignKey('polls.Question', related_name='answers')
     value = models.CharField(max_length=640, null=True)
+    numeric_value = models.FloatField(
+        null=True, help_text=_("The value as a number, if it is numeric"))
     category = models.CharField(max_length=36, null=True)
     submitted_on = models.DateTimeField(
         help_text=_("When this answer was submitted"))
 
     objects = AnswerManager()
+
+    def save(self, *args, **kwargs):
+        self.numeric_value = get_numeric_value(self.value)
+        super(Answer, self).save(*args, **kwargs)
+
+
+class AnswerSummaryQuerySet(models.QuerySet):
+
+    def summarize_by_pollrun(self):
+        """Summarize answers by pollrun.
+
+        Returns the same data as `utils.summarize_by_pollrun`.
+        """
+        data = ({}, {}, {}, {})
+        for row in self._totals('pollrun'):
+            summary = self._summarize(row)
+            for i, value in enumerate(summary):
+                data[i][row['pollrun']] = value
+        return data
+
+    def summarize_by_region_and_pollrun(self):
+        """Summarize answers by contact region and pollrun.
+
+        Returns the same data as `utils.summarize_by_region_and_pollrun`.
+        """
+        data = {}
+        for row in self._totals('region', 'pollrun'):
+            summary = self._summarize(row)
+            data.setdefault(row['region'], ({}, {}, {}, {}))
+            for i, value in enumerate(summary):
+                data[row['region']][i][row['pollrun']] = value
+        return data
+
+    def summarize_by_question_and_pollrun(self):
+        """Map each question id to `summarize_by_pollrun` data for its answers.
+
+        Summarizes all questions with one query.
+        """
+        data = {}
+        for row in self._totals('question', 'pollrun'):
+            question_data = data.setdefault(row['question'], ({}, {}, {}, {}))
+            for i, value in enumerate(self._summarize(row)):
+                question_data[i][row['pollrun']] = value
+        return data
+
+    def summarize_by_question_region_and_pollrun(self):
+        """Map each question id to `summarize_by_region_and_pollrun` data for its answers.
+
+        Summarizes all questions with one query.
+        """
+        data = {}
+        for row in self._totals('question', 'region', 'pollrun'):
+            question_data = data.setdefault(row['question'], {})
+            region_data = question_data.setdefault(row['region'], ({}, {}, {}, {}))
+            for i, value in enumerate(self._summarize(row)):
+                region_data[i][row['pollrun']] = value
+        return data
+
+    def average_by_question_and_boundary(self):
+        """Map each question id to its average numeric answer in each boundary.
+
+        Boundaries without numeric answers are left out.
+        """
+        totals = self.filter(numeric_count__gt=0).exclude(region__boundary=None).order_by()
+        totals = totals.values_list('question', 'region__boundary').annotate(
+            total_sum=Sum('numeric_sum'), total_count=Sum('numeric_count'))
+        data = defaultdict(dict)
+        for question_id, boundary_id, total_sum, total_count in totals:
+            data[question_id][boundary_id] = total_sum / total_count
+        return data
+
+    def _summarize(self, row):
+        return summarize_totals(
+            row['answer_count'], row['numeric_count'], row['numeric_sum'],
+            row['numeric_sum_squares'], row['response_count'])
+
+    def _totals(self, *fields):
+        totals = self.order_by().values(*fields).annotate(
+            response_count=Sum('response_count'),
+            answer_count=Sum('answer_count'),
+            numeric_count=Sum('numeric_count'),
+            numeric_sum=Sum('numeric_sum'),
+            numeric_sum_squares=Sum('numeric_sum_squares'),
+        )
+        # Every pollrun with responses is included, even without answers.
+        return totals.filter(response_count__gt=0)
+
+
+class RunningTotalsMixin(object):
+    """Manager methods to keep running totals of responses up to date.
+
+    The model defines `KEY_FIELDS` and `TOTAL_FIELDS`, and the manager
+    implements `_get_totals(responses)`, which maps a tuple of key values to
+    a list of the totals for the responses.
+    """
+
+    def add_responses(self, responses):
+        """Add the active responses and their answers to the totals."""
+        self._apply(self._get_totals(responses), sign=1)
+
+    def remove_responses(self, responses):
+        """Remove the active responses and their answers from the totals.
+
+        Must be called before the responses are de-activated or their
+        answers are deleted.
+        """
+        self._apply(self._get_totals(responses), sign=-1)
+
+    @transaction.atomic
+    def rebuild(self, pollruns):
+        """Recalculate the totals for the pollruns from scratch."""
+        self._lock(PollRun.objects.filter(pk__in=pollruns).values_list('pk', flat=True))
+        self.filter(pollrun__in=pollruns).delete()
+        self.add_responses(Response.objects.filter(pollrun__in=pollruns))
+
+    def _lock(self, pollrun_ids):
+        """Lock the pollruns' totals until the current transaction ends.
+
+        Otherwise two processes could both find that a total doesn't exist
+        yet, and the second to create it would fail.
+        """
+        table_key = zlib.crc32(self.model._meta.db_table.encode('utf-8')) & 0x7fffffff
+        with connection.cursor() as cursor:
+            # Always lock in the same order, so processes can't deadlock.
+            for pollrun_id in sorted(set(pollrun_ids)):
+                cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [table_key, pollrun_id])
+
+    @transaction.atomic
+    def _apply(self, totals, sign):
+        """Add (or subtract) the totals to the stored totals."""
+        if not totals:
+            return
+
+        model = self.model
+        self._lock(key[0] for key in totals)
+
+        key_fields = [model._meta.get_field(f) for f in model.KEY_FIELDS]
+        total_fields = [model._meta.get_field(f) for f in model.TOTAL_FIELDS]
+
+        existing = self.filter(**{
+            '{}__in'.format(field.name): set(key[i] for key in totals)
+            for i, field in enumerate(key_fields)})
+        existing = set(existing.values_list(*model.KEY_FIELDS))
+        existing &= set(totals.keys())
+
+        self.bulk_create([
+            model(**dict(
+                zip([f.attname for f in key_fields], key) +
+                zip(model.TOTAL_FIELDS, [sign * t for t in total])))
+            for key, total in totals.items()
+            if key not in existing
+        ], batch_size=BULK_BATCH_SIZE)
+
+        if existing:
+            # Update all existing totals with a single query.
+            rows = [key + tuple(sign * t for t in totals[key]) for key in existing]
+            fields = key_fields + total_fields
+            sql = ('UPDATE {table} AS s SET {updates} '
+                   'FROM (VALUES {values}) AS d ({fields}) '
+                   'WHERE {where}').format(
+                table=model._meta.db_table,
+                updates=', '.join('{0} = s.{0} + d.{0}'.format(f.column) for f in total_fields),
+                values=', '.join(['({})'.format(', '.join(
+                    '%s::float' if isinstance(f, models.FloatField) else '%s'
+                    for f in fields))] * len(rows)),
+                fields=', '.join(f.column for f in fields),
+                where=' AND '.join('s.{0} = d.{0}'.format(f.column) for f in key_fields))
+            with connection.cursor() as cursor:
+                cursor.execute(sql, list(chain(*rows)))
+
+
+class AnswerSummaryManager(RunningTotalsMixin,
+                           models.Manager.from_queryset(AnswerSummaryQuerySet)):
+
+    def _get_totals(self, responses):
+        """Map (pollrun, question, region) to the totals for the responses."""
+        responses = responses.filter(is_active=True, contact__is_active=True).order_by()
+        totals = defaultdict(lambda: [0, 0, 0, 0.0, 0.0])
+
+        # Every question in the poll counts each response.
+        counts = responses.values_list('pollrun', 'pollrun__poll', 'contact__region')
+        counts = list(counts.annotate(Count('pk')))
+        questions = defaultdict(list)
+        poll_ids = set(poll_id for _, poll_id, _, _ in counts)
+        for poll_id, question_id in Question.objects.filter(poll__in=poll_ids).values_list('poll', 'pk'):
+            questions[poll_id].append(question_id)
+        for pollrun_id, poll_id, region_id, count in counts:
+            for question_id in questions[poll_id]:
+                totals[(pollrun_id, question_id, region_id)][0] += count
+
+        answers = Answer.objects.filter(response__in=responses).order_by()
+        answers = answers.values(
+            'response__pollrun', 'question', 'response__contact__region').annotate(
+            answer_count=Count('pk'),
+            numeric_count=Count('numeric_value'),
+            numeric_sum=Sum('numeric_value'),
+            numeric_sum_squares=Sum(F('numeric_value') * F('numeric_value')),
+        )
+        for a in answers:
+            total = totals[(a['response__pollrun'], a['question'], a['response__contact__region'])]
+            total[1] += a['answer_count']
+            total[2] += a['numeric_count']
+            total[3] += a['numeric_sum'] or 0.0
+            total[4] += a['numeric_sum_squares'] or 0.0
+
+        return totals
+
+
+class AnswerSummary(models.Model):
+    """Running totals of the answers to a question for a pollrun.
+
+    Kept per contact region, so that numeric chart data can be read from this
+    small table rather than calculated from every answer. Only active
+    responses from active contacts are counted. Summaries are updated as
+    responses are saved from flow runs, and as contacts change regions or
+    are deactivated; use `AnswerSummary.objects.rebuild()` if they need to
+    be recalculated.
+    """
+    KEY_FIELDS = ('pollrun', 'question', 'region')
+    TOTAL_FIELDS = (
+        'response_count', 'answer_count', 'numeric_count', 'numeric_sum',
+        'numeric_sum_squares')
+
+    pollrun = models.ForeignKey('polls.PollRun', related_name='answer_summaries')
+    question = models.ForeignKey('polls.Question', related_name='answer_summaries')
+    region = models.ForeignKey('groups.Region', related_name='answer_summaries')
+
+    response_count = models.IntegerField(
+        default=0, help_text=_("Number of active responses"))
+    answer_count = models.IntegerField(
+        default=0, help_text=_("Number of answers to the question"))
+    numeric_count = models.IntegerField(
+        default=0, help_text=_("Number of answers with a numeric value"))
+    numeric_sum = models.FloatField(
+        default=0, help_text=_("Sum of the numeric answer values"))
+    numeric_sum_squares = models.FloatField(
+        default=0, help_text=_("Sum of the squares of the numeric answer values"))
+
+    objects = AnswerSummaryManager()
+
+    class Meta:
+        unique_together = (
+            ('pollrun', 'question', 'region'),
+        )
+
+
+class WordCountQuerySet(models.QuerySet):
+
+    def top_words(self, limit=50):
+        """Return the (word, count) pairs with the highest total counts."""
+        counts = self.order_by().values_list('word').annotate(total=Sum('count'))
+        counts = counts.filter(total__gt=0).order_by('-total', 'word')
+        return list(counts[:limit])
+
+
+class WordCountManager(RunningTotalsMixin, models.Manager.from_queryset(WordCountQuerySet)):
+
+    def _get_totals(self, responses):
+        """Map (pollrun, question, region, word) to the count for the responses."""
+        responses = responses.filter(is_active=True, contact__is_active=True).order_by()
+        totals = defaultdict(lambda: [0])
+
+        answers = Answer.objects.filter(
+            response__in=responses, question__question_type=Question.TYPE_OPEN)
+        answers = answers.exclude(value=None).order_by()
+        answers = answers.values_list(
+            'response__pollrun', 'question', 'response__contact__region',
+            'value', 'response__contact__language')
+        answers = answers.iterator()
+        while True:
+            batch = list(islice(answers, WORD_COUNT_BATCH_SIZE))
+            if not batch:
+                break
+            words = extract_words_many([a[3] for a in batch], [a[4] for a in batch])
+            for (pollrun_id, question_id, region_id, _value, _language), answer_words in zip(batch, words):
+                for word in answer_words:
+                    totals[(pollrun_id, question_id, region_id, word)][0] += 1
+
+        return totals
+
+
+class WordCount(models.Model):
+    """Running count of a word in the answers to an open-ended question.
+
+    Kept per pollrun and contact region, like `AnswerSummary`, so that word
+    clouds can be read from the summed counts rather than by extracting the
+    words from every answer. Only active responses from active contacts are
+    counted, and counts follow contacts that change regions. Use
+    `WordCount.objects.rebuild()` if counts need to be recalculated (e.g.,
+    after a question becomes open-ended).
+    """
+    KEY_FIELDS = ('pollrun', 'question', 'region', 'word')
+    TOTAL_FIELDS = ('count',)
+
+    pollrun = models.ForeignKey('polls.PollRun', related_name='word_counts')
+    question = models.ForeignKey('polls.Question', related_name='word_counts')
+    region = models.ForeignKey('groups.Region', related_name='word_counts')
+    word = models.CharField(max_length=640)
+
+    count = models.IntegerField(
+        default=0, help_text=_("Number of times the word appears in active answers"))
+
+    objects = WordCountManager()
+
+    class Meta:
+        unique_together = (
+            ('pollrun', 'question', 'region', 'word'),
+        )
+
+
+class ResponseExportQuerySet(models.QuerySet):
+
+    def fail_expired(self):
+        """Mark exports that their task can no longer finish as failed.
+
+        A task that is killed (e.g., at its hard time limit, or when a worker
+        is restarted) leaves its export pending or running.
+        """
+        expired_on = timezone.now() - ResponseExport.TASK_TIMEOUT
+        exports = self.filter(
+            status__in=(ResponseExport.STATUS_PENDING, ResponseExport.STATUS_RUNNING),
+            created_on__lt=expired_on)
+        return exports.update(status=ResponseExport.STATUS_FAILED)
+
+
+@python_2_unicode_compatible
+class ResponseExport(models.Model):
+    """A CSV file of poll responses, written in the background."""
+
+    # Export tasks expire if they aren't started within ORG_TASK_TIMEOUT, and
+    # are killed a minute after their soft time limit of ORG_TASK_TIMEOUT.
+    TASK_TIMEOUT = settings.ORG_TASK_TIMEOUT * 2 + datetime.timedelta(minutes=1)
+
+    STATUS_PENDING = 'P'
+    STATUS_RUNNING = 'R'
+    STATUS_COMPLETE = 'C'
+    STATUS_FAILED = 'F'
+    STATUS_CHOICES = (
+        (STATUS_PENDING, _("Pending")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_COMPLETE, _("Complete")),
+        (STATUS_FAILED, _("Failed")),
+    )
+
+    org = models.ForeignKey(
+        'orgs.Org', related_name='response_exports', verbose_name=_('org'))
+    poll = models.ForeignKey(
+        'polls.Poll', related_name='response_exports', verbose_name=_("Poll"))
+    region = models.ForeignKey(
+        'groups.Region', null=True, blank=True, related_name='response_exports',
+        help_text=_("Only export responses from contacts in this region"))
+    include_subregions = models.BooleanField(default=True)
+    start_date = models.DateField(
+        null=True, blank=True,
+        help_text=_("Only export pollruns conducted on or after this date"))
+    end_date = models.DateField(
+        null=True, blank=True,
+        help_text=_("Only export pollruns conducted before this date"))
+    compress = models.BooleanField(
+        default=False, help_text=_("Whether to gzip the file"))
+
+    status = models.CharField(
+        max_length=1, choices=STATUS_CHOICES, default=STATUS_PENDING,
+        verbose_name=_("Status"))
+    row_count = models.IntegerField(
+        default=0, help_text=_("Number of responses written so far"))
+    total_count = models.IntegerField(
+        null=True, help_text=_("Number of responses to write"))
+    file = models.FileField(upload_to='exports/responses', null=True)
+
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='response_exports')
+    created_on = models.DateTimeField(auto_now_add=True)
+    completed_on = models.DateTimeField(null=True)
+
+    objects = ResponseExportQuerySet.as_manager()
+
+    def __str__(self):
+        return "%s (%s)" % (self.poll, self.created_on.strftime('%Y-%m-%d %H:%M'))
+
+    def get_filename(self):
+        filename = 'responses-%d.csv' % self.pk
+        return filename + '.gz' if self.compress else filename
+
+    def get_progress(self):
+        """Return the percentage of responses that have been written."""
+        if self.status == self.STATUS_COMPLETE:
+            return 100
+        if not self.total_count:
+            return 0
+        return int(100 * self.row_count / self.total_count)
+
+    def get_responses(self):
+        """Return the non-empty active responses to export, in order."""
+        pollruns = PollRun.objects.filter(poll=self.poll)
+        pollruns = pollruns.by_dates(self.start_date, self.end_date)
+        responses = Response.objects.filter(
+            pollrun__in=pollruns,
+            is_active=True,
+            contact__region__is_active=True,
+            contact__is_active=True)
+        responses = responses.exclude(status=Response.STATUS_EMPTY)
+        if self.region:
+            if self.include_subregions:
+                regions = self.region.get_descendant_ids(include_self=True)
+                responses = responses.filter(contact__region__in=regions)
+            else:
+                responses = responses.filter(contact__region=self.region)
+        return responses.order_by('pollrun__conducted_on', 'updated_on')
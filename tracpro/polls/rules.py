@@ -1,7 +1,10 @@
 from __future__ import unicode_literals
 
 from decimal import Decimal, InvalidOperation
-from functools import wraps
+import hashlib
+import json
+
+import numpy
 
 from django.utils.translation import ugettext_lazy as _
 
@@ -21,11 +24,11 @@ def get_category(rule):
     return rule['category']
 
 
-def get_all_categories(question, answers=None):
+def get_all_categories(question, answers=None, answer_categories=None):
     """Return the names of all possible Answer categories, and Other.
 
     Pass `answers` to include any categories those Answers have that aren't in
-    the rules.
+    the rules, or `answer_categories` if the answers are already in memory.
     """
     categories = []
 
@@ -42,6 +45,9 @@ def get_all_categories(question, answers=None):
         extra = extra.exclude(category=None)
         extra = extra.values_list('category', flat=True).distinct('category')
         categories.extend(list(extra))
+    elif answer_categories is not None:
+        extra = set(answer_categories) - set(categories + ['', None])
+        categories.extend(sorted(extra))
 
     # The last category should be "Other."
     other = str(_("Other"))  # Evaluate to keep the list JSON serializable.
@@ -52,6 +58,11 @@ def get_all_categories(question, answers=None):
     return categories
 
 
+def get_rules_hash(rules):
+    """Return a hash of the rules that changes whenever the rules do."""
+    return hashlib.md5(json.dumps(rules, sort_keys=True)).hexdigest()
+
+
 def passes_test(value, rule):
     """Returns whether the value passes the rule test.
 
@@ -62,52 +73,85 @@ def passes_test(value, rule):
     Currently only numeric types are implemented.
     All other test types will return False.
     """
-    test = rule['test'].copy()
-    test_funcs = {
-        'number': is_number,
-        'between': is_between,
-        'eq': is_equal,
-        'lt': is_less_than,
-        'gt': is_greater_than,
-    }
-    test_func = test_funcs.get(test.pop('type'))
-    return test_func(value, **test) if test_func else False
+    return CompiledRule(rule).passes(value)
 
 
-def numeric_rule(function):
-    """Rule test decorator that returns False if any argument is non-numeric."""
-    @wraps(function)
-    def wrapped(value, *args, **kwargs):
-        try:
-            numeric = Decimal(value)
-            args = [Decimal(a) for a in args]
-            kwargs = {k: Decimal(v) for k, v in kwargs.items()}
-        except (TypeError, InvalidOperation):
-            return False
-        return function(numeric, *args, **kwargs)
-    return wrapped
+class Bound(object):
+    """A numeric rule argument, for comparing with arrays of floats.
 
+    A float array can only hold the float nearest to the argument. A value
+    that equals that float is compared with the argument exactly, so results
+    are the same as comparing each value as a Decimal.
+    """
 
-@numeric_rule
-def is_number(val, **kwargs):
-    return True  # Decorator has ensured that the argument is numeric.
+    def __init__(self, value):
+        self.value = value
+        self.nearest = float(value)
+        nearest = Decimal(self.nearest)
+        self.sign = (nearest > value) - (nearest < value)
 
+    def lt(self, values):
+        """Return whether each value is less than the bound."""
+        return (values < self.nearest) | ((values == self.nearest) & (self.sign < 0))
 
-@numeric_rule
-def is_between(val, min, max, **kwargs):
-    return min <= val <= max
+    def gt(self, values):
+        """Return whether each value is greater than the bound."""
+        return (values > self.nearest) | ((values == self.nearest) & (self.sign > 0))
 
+    def eq(self, values):
+        """Return whether each value equals the bound."""
+        return (values == self.nearest) & (self.sign == 0)
 
-@numeric_rule
-def is_equal(val, test, **kwargs):
-    return val == test
 
+class CompiledRule(object):
+    """A rule with its test arguments parsed once, to check many values.
 
-@numeric_rule
-def is_less_than(val, test, **kwargs):
-    return val < test
+    `passes(value)` returns the same as `passes_test(value, rule)`, and
+    `passes_many(values)` checks each of an array of floats, where NaN is
+    used for non-numeric values.
+    """
+    TESTS = {
+        'number': (
+            lambda val, **kwargs: True,
+            lambda values, **kwargs: ~numpy.isnan(values)),
+        'between': (
+            lambda val, min, max, **kwargs: min <= val <= max,
+            lambda values, min, max, **kwargs: (
+                ~numpy.isnan(values) & ~min.lt(values) & ~max.gt(values))),
+        'eq': (
+            lambda val, test, **kwargs: val == test,
+            lambda values, test, **kwargs: test.eq(values)),
+        'lt': (
+            lambda val, test, **kwargs: val < test,
+            lambda values, test, **kwargs: test.lt(values)),
+        'gt': (
+            lambda val, test, **kwargs: val > test,
+            lambda values, test, **kwargs: test.gt(values)),
+    }
 
+    def __init__(self, rule):
+        test = rule['test'].copy()
+        self.category = get_category(rule) if 'category' in rule else None
+        self.test, self.test_many = self.TESTS.get(test.pop('type'), (None, None))
+        try:
+            self.kwargs = {k: Decimal(v) for k, v in test.items()}
+        except (TypeError, InvalidOperation):
+            # Rules with non-numeric arguments never pass.
+            self.test = self.test_many = None
+        else:
+            self.bounds = {k: Bound(v) for k, v in self.kwargs.items()}
+
+    def passes(self, value):
+        if self.test is None:
+            return False
+        try:
+            numeric = Decimal(value)
+        except (TypeError, InvalidOperation):
+            return False
+        return self.test(numeric, **self.kwargs)
 
-@numeric_rule
-def is_greater_than(val, test, **kwargs):
-    return val > test
+    def passes_many(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        if self.test_many is None:
+            return numpy.zeros(values.shape, dtype=bool)
+        return self.test_many(values, **self.bounds)
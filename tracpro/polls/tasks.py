@@ -1,12 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 
+from collections import Counter, defaultdict
+import json
+
 from django.apps import apps
+from django.conf import settings
 from django.utils import timezone
 
 from celery.utils.log import get_task_logger
 from djcelery_transactions import task
 from django_redis import get_redis_connection
 
+from temba_client.base import TembaPager
 from temba_client.utils import parse_iso8601, format_iso8601
 
 from dash.utils import datetime_to_ms
@@ -19,6 +24,51 @@ logger = get_task_logger(__name__)
 
 LAST_FETCHED_RUN_TIME_KEY = 'org:%d:last_fetched_run_time'
 
+POLL_LAST_FETCHED_RUN_TIME_KEY = 'org:%d:poll:%d:last_fetched_run_time'
+
+POLL_FETCH_CHECKPOINT_KEY = 'org:%d:poll:%d:fetch_checkpoint'
+
+RECATEGORIZE_QUEUED_KEY = 'org:%d:question:%d:recategorize_queued'
+
+# Number of runs to save at once.
+FETCH_RUNS_BATCH_SIZE = 500
+
+# Number of answers to recategorize at once.
+RECATEGORIZE_BATCH_SIZE = 1000
+
+
+def iter_run_pages(client, start_page=1, **kwargs):
+    """Yield (page number, runs) for each page of runs, one request at a time."""
+    pager = TembaPager(start_page=start_page)
+    page = start_page
+    while True:
+        yield page, client.get_runs(pager=pager, **kwargs)
+        if not pager.has_more():
+            break
+        page += 1
+
+
+def save_runs(org, poll, runs):
+    """Create or update responses for the runs, a batch at a time.
+
+    Returns the number of created and updated responses.
+    """
+    from tracpro.polls.models import Response
+
+    created = 0
+    updated = 0
+    for i in range(0, len(runs), FETCH_RUNS_BATCH_SIZE):
+        batch = runs[i:i + FETCH_RUNS_BATCH_SIZE]
+        responses, failures = Response.from_runs(org, batch, poll=poll)
+        for run, e in failures:
+            logger.error("Unable to save run #%d due to error: %s" % (run.id, e.message))
+        for response in responses:
+            if getattr(response, 'is_new', False):
+                created += 1
+            else:
+                updated += 1
+    return created, updated
+
 
 class FetchOrgRuns(OrgTask):
 
@@ -26,45 +76,102 @@ class FetchOrgRuns(OrgTask):
         """
         Fetches new and modified flow runs for the given org and creates/updates
         poll responses.
+
+        Runs are fetched one page at a time and each page is saved as soon as
+        it arrives. Progress is checkpointed per poll so that if the task is
+        killed or times out, the next run resumes where this one stopped.
         """
         from tracpro.orgs_ext.constants import TaskType
-        from tracpro.polls.models import Poll, PollRun, Response
+        from tracpro.polls.charts import clear_chart_data
+        from tracpro.polls.models import Poll
 
         client = org.get_temba_client()
         redis_connection = get_redis_connection()
-        last_time_key = LAST_FETCHED_RUN_TIME_KEY % org.pk
-        last_time = redis_connection.get(last_time_key)
+        last_time = self.get_org_last_time(org, redis_connection)
+        until = timezone.now()
+
+        counts = Counter()
+        for poll in Poll.objects.active().by_org(org):
+            counts.update(self.fetch_poll_runs(
+                org, poll, client, redis_connection, last_time, until))
 
+        logger.info("Fetched %d new and updated runs for org #%d (since=%s)"
+                    % (counts['fetched'], org.id, format_iso8601(last_time) if last_time else 'Never'))
+
+        task_result = dict(
+            time=datetime_to_ms(timezone.now()),
+            counts=dict(
+                fetched=counts['fetched'],
+                created=counts['created'],
+                updated=counts['updated']))
+        org.set_task_result(TaskType.fetch_runs, task_result)
+
+        redis_connection.set(LAST_FETCHED_RUN_TIME_KEY % org.pk, format_iso8601(until))
+
+        if counts['fetched']:
+            clear_chart_data(org)
+
+    def get_org_last_time(self, org, redis_connection):
+        """Return when runs were last fetched for all of the org's polls.
+
+        Used for polls that don't have their own record yet.
+        """
+        from tracpro.polls.models import PollRun, Response
+
+        last_time = redis_connection.get(LAST_FETCHED_RUN_TIME_KEY % org.pk)
         if last_time is not None:
-            last_time = parse_iso8601(last_time)
-        else:
-            newest_runs = Response.objects.filter(pollrun__poll__org=org).order_by('-created_on')
-            newest_runs = newest_runs.exclude(pollrun__pollrun_type=PollRun.TYPE_SPOOFED)
-            newest_run = newest_runs.first()
-            last_time = newest_run.created_on if newest_run else None
+            return parse_iso8601(last_time)
 
-        until = timezone.now()
+        newest_runs = Response.objects.filter(pollrun__poll__org=org).order_by('-created_on')
+        newest_runs = newest_runs.exclude(pollrun__pollrun_type=PollRun.TYPE_SPOOFED)
+        newest_run = newest_runs.first()
+        return newest_run.created_on if newest_run else None
 
-        total_runs = 0
-        for poll in Poll.objects.active().by_org(org):
-            poll_runs = client.get_runs(flows=[poll.flow_uuid], after=last_time, before=until)
-            total_runs += len(poll_runs)
+    def fetch_poll_runs(self, org, poll, client, redis_connection, last_time, until):
+        """Fetch and save the poll's runs, resuming from a checkpoint if any.
 
-            # convert flow runs into poll responses
-            for run in poll_runs:
-                try:
-                    Response.from_run(org, run, poll=poll)
-                except ValueError as e:
-                    logger.error("Unable to save run #%d due to error: %s" % (run.id, e.message))
-                    continue
+        A checkpoint records the time window being fetched and the next page
+        to fetch. It is cleared once every page has been saved.
 
-        logger.info("Fetched %d new and updated runs for org #%d (since=%s)"
-                    % (total_runs, org.id, format_iso8601(last_time) if last_time else 'Never'))
+        Runs aren't resumed by time, because runs don't include the modified
+        time that RapidPro orders them by. Instead, the last saved page is
+        fetched again: runs that are modified after the window was fetched
+        leave it, which moves later runs onto earlier pages. Saving a run
+        again only updates its response.
+        """
+        checkpoint_key = POLL_FETCH_CHECKPOINT_KEY % (org.pk, poll.pk)
+        last_time_key = POLL_LAST_FETCHED_RUN_TIME_KEY % (org.pk, poll.pk)
+
+        checkpoint = redis_connection.get(checkpoint_key)
+        if checkpoint is not None:
+            checkpoint = json.loads(checkpoint)
+            after = parse_iso8601(checkpoint['after']) if checkpoint['after'] else None
+            before = parse_iso8601(checkpoint['before'])
+            start_page = max(checkpoint['page'] - 1, 1)
+            logger.info("Resuming fetch of runs for poll #%d from page %d"
+                        % (poll.pk, start_page))
+        else:
+            poll_last_time = redis_connection.get(last_time_key)
+            after = parse_iso8601(poll_last_time) if poll_last_time is not None else last_time
+            before = until
+            start_page = 1
 
-        task_result = dict(time=datetime_to_ms(timezone.now()), counts=dict(fetched=total_runs))
-        org.set_task_result(TaskType.fetch_runs, task_result)
+        counts = Counter()
+        pages = iter_run_pages(
+            client, start_page=start_page, flows=[poll.flow_uuid], after=after, before=before)
+        for page, runs in pages:
+            created, updated = save_runs(org, poll, runs)
+            counts.update(fetched=len(runs), created=created, updated=updated)
 
-        redis_connection.set(last_time_key, format_iso8601(until))
+            redis_connection.set(checkpoint_key, json.dumps({
+                'after': format_iso8601(after) if after else None,
+                'before': format_iso8601(before),
+                'page': page + 1,
+            }))
+
+        redis_connection.set(last_time_key, format_iso8601(before))
+        redis_connection.delete(checkpoint_key)
+        return counts
 
 
 @task
@@ -73,6 +180,7 @@ def pollrun_start(pollrun_id):
     Starts a newly created pollrun by creating runs in RapidPro and creating
     empty responses for them.
     """
+    from tracpro.polls.charts import clear_chart_data
     from tracpro.polls.models import PollRun, Response
 
     pollrun = PollRun.objects.select_related('poll', 'region').get(pk=pollrun_id)
@@ -84,7 +192,7 @@ def pollrun_start(pollrun_id):
 
     contacts = Contact.objects.active()
     if pollrun.pollrun_type == PollRun.TYPE_PROPAGATED:
-        descendants = pollrun.region.get_descendants(include_self=True)
+        descendants = pollrun.region.get_descendant_ids(include_self=True)
         contacts = contacts.filter(region__in=descendants)
     elif pollrun.pollrun_type == PollRun.TYPE_REGIONAL:
         contacts = contacts.filter(region=pollrun.region)
@@ -93,6 +201,7 @@ def pollrun_start(pollrun_id):
     runs = client.create_runs(pollrun.poll.flow_uuid, contact_uuids, restart_participants=True)
     for run in runs:
         Response.create_empty(org, pollrun, run)
+    clear_chart_data(org)
 
     logger.info("Created %d new runs for new poll pollrun #%d" % (len(runs), pollrun.pk))
 
@@ -103,6 +212,7 @@ def pollrun_restart_participants(pollrun_id, contact_uuids):
     Restarts the given contacts in the given poll pollrun by replacing any
     existing response they have with an empty one.
     """
+    from tracpro.polls.charts import clear_chart_data
     from tracpro.polls.models import PollRun, Response
 
     pollrun = PollRun.objects.select_related('poll', 'region').get(pk=pollrun_id)
@@ -118,10 +228,155 @@ def pollrun_restart_participants(pollrun_id, contact_uuids):
     runs = client.create_runs(pollrun.poll.flow_uuid, contact_uuids, restart_participants=True)
     for run in runs:
         Response.create_empty(org, pollrun, run)
+    clear_chart_data(org)
 
     logger.info("Created %d restart runs for poll pollrun #%d" % (len(runs), pollrun.pk))
 
 
+class ExportOrgResponses(OrgTask):
+    """Writes the file for a ResponseExport.
+
+    Exports are requested by users rather than scheduled, so they aren't
+    rate limited, and several exports for an org may run at once. Claiming
+    the pending export ensures that each one is only written once.
+    """
+
+    def check_rate_limit(self, org):
+        pass
+
+    def lock_acquire(self, org):
+        return True
+
+    def lock_release(self, org):
+        pass
+
+    def org_task(self, org, export_id, **kwargs):
+        from tracpro.polls.exports import write_export
+        from tracpro.polls.models import ResponseExport
+
+        exports = ResponseExport.objects.filter(org=org, pk=export_id)
+        if not exports.filter(status=ResponseExport.STATUS_PENDING).update(
+                status=ResponseExport.STATUS_RUNNING):
+            logger.info("Response export #%d is not pending" % export_id)
+            return
+
+        export = exports.get()
+        try:
+            write_export(export)
+        except Exception:
+            # Includes SoftTimeLimitExceeded. Exports whose task is killed
+            # are failed by `ResponseExport.objects.fail_expired()`.
+            exports.update(status=ResponseExport.STATUS_FAILED)
+            raise
+
+        export.status = ResponseExport.STATUS_COMPLETE
+        export.completed_on = timezone.now()
+        export.save(update_fields=('status', 'completed_on', 'row_count', 'file'))
+
+        logger.info("Exported %d responses for export #%d" % (export.row_count, export.pk))
+
+
+def queue_recategorize_answers(org_id, question_id):
+    """Queue the question's answers to be recategorized, unless already queued.
+
+    The flag expires once a queued task can no longer be running: tasks
+    expire if they aren't started within ORG_TASK_TIMEOUT, and are killed a
+    minute after their soft time limit of ORG_TASK_TIMEOUT.
+    """
+    timeout = (settings.ORG_TASK_TIMEOUT * 2).seconds + 60
+    queued_key = RECATEGORIZE_QUEUED_KEY % (org_id, question_id)
+    if get_redis_connection().set(queued_key, 1, nx=True, ex=timeout):
+        RecategorizeAnswers().delay(org_id, question_id=question_id)
+
+
+class RecategorizeAnswers(OrgTask):
+    """Recategorizes a question's numeric answers after its rules change.
+
+    Queued when a poll sync finds that a question's answers weren't
+    categorized with its current rules in RapidPro. Several questions may
+    change in one sync, so this isn't rate limited or locked per org.
+    """
+
+    def check_rate_limit(self, org):
+        pass
+
+    def lock_acquire(self, org):
+        return True
+
+    def lock_release(self, org):
+        pass
+
+    def org_task(self, org, question_id, **kwargs):
+        try:
+            self.recategorize(org, question_id)
+        finally:
+            get_redis_connection().delete(RECATEGORIZE_QUEUED_KEY % (org.pk, question_id))
+
+    def recategorize(self, org, question_id):
+        """
+        Updates the stored category of each numeric answer to the question,
+        a batch at a time, then clears the org's cached chart data.
+
+        Answers to questions with rules that can't be tested here keep the
+        categories that RapidPro gave them.
+        """
+        from tracpro.orgs_ext.constants import TaskType
+        from tracpro.polls.charts import clear_chart_data
+        from tracpro.polls.models import Answer, Question
+        from tracpro.polls.rules import get_rules_hash
+
+        question = Question.objects.get(poll__org=org, pk=question_id)
+        rules_hash = get_rules_hash(question.get_rules())
+        if not question.can_categorize():
+            logger.info("Not recategorizing answers to question #%d, which has "
+                        "rules that can't be tested" % question.pk)
+            Question.objects.filter(pk=question.pk).update(categorized_rules_hash=rules_hash)
+            return
+
+        answers = Answer.objects.filter(question=question, numeric_value__isnull=False)
+        answers = answers.order_by('pk').values_list('pk', 'value', 'category')
+
+        counts = Counter()
+        last_pk = 0
+        while True:
+            batch = list(answers.filter(pk__gt=last_pk)[:RECATEGORIZE_BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1][0]
+
+            # Categorize the values as RapidPro does, as decimals; the float
+            # numeric values can't hold every rule bound exactly.
+            changed = defaultdict(list)
+            for pk, value, old_category in batch:
+                new_category = question.categorize(value)
+                if old_category != new_category:
+                    changed[new_category].append(pk)
+            for category, category_pks in changed.items():
+                Answer.objects.filter(pk__in=category_pks).update(category=category)
+
+            counts.update(
+                processed=len(batch),
+                changed=sum(len(category_pks) for category_pks in changed.values()))
+            org.set_task_result(TaskType.recategorize_answers, dict(
+                time=datetime_to_ms(timezone.now()),
+                question=question.pk,
+                counts=dict(processed=counts['processed'], changed=counts['changed'])))
+
+        logger.info("Recategorized %d of %d answers to question #%d"
+                    % (counts['changed'], counts['processed'], question.pk))
+
+        Question.objects.filter(pk=question.pk).update(categorized_rules_hash=rules_hash)
+
+        org.set_task_result(TaskType.recategorize_answers, dict(
+            time=datetime_to_ms(timezone.now()),
+            question=question.pk,
+            complete=True,
+            counts=dict(processed=counts['processed'], changed=counts['changed'])))
+
+        if counts['changed']:
+            clear_chart_data(org)
+
+
 class SyncOrgPolls(OrgTask):
 
     def org_task(self, org, **kwargs):
@@ -1,11 +1,14 @@
 from __future__ import unicode_literals
 
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from tracpro.test import factories
 from tracpro.test.cases import TracProTest
 
 from .. import charts
+from .. import maps
 from .. import models
 
 
@@ -98,6 +101,14 @@ class PollChartTest(TracProTest):
             {"text": "sunny", "weight": 2},
         ])
 
+    def test_word_cloud_data__word_counts(self):
+        models.WordCount.objects.rebuild(self.pollruns)
+        answers = models.Answer.objects.filter(question=self.question2)
+        word_counts = models.WordCount.objects.filter(question=self.question2)
+        self.assertEqual(
+            charts.word_cloud_data(answers, word_counts),
+            charts.word_cloud_data(answers))
+
     def test_multiple_pollruns_numeric(self):
         chart_type, data, summary_table = charts.multiple_pollruns(
             self.pollruns, self.responses, self.question3, split_regions=False,
@@ -226,6 +237,20 @@ class PollChartTest(TracProTest):
         self.assertEqual(summary_data['Standard deviation'], 0.0)
         self.assertEqual(summary_data['Response rate average (%)'], 100.0)
 
+    def test_multiple_pollruns_numeric__summaries(self):
+        """Chart data read from answer summaries should match the answers."""
+        models.AnswerSummary.objects.rebuild(self.pollruns)
+        summaries = models.AnswerSummary.objects.all()
+        for split_regions in (False, True):
+            expected = charts.multiple_pollruns(
+                self.pollruns, self.responses, self.question3,
+                split_regions=split_regions, contact_filters={})
+            actual = charts.multiple_pollruns(
+                self.pollruns, self.responses, self.question3,
+                split_regions=split_regions, contact_filters={},
+                summaries=summaries)
+            self.assertEqual(actual, expected)
+
     def test_single_pollrun_multiple_choice(self):
         answers = models.Answer.objects.filter(question=self.question1)
         data = charts.single_pollrun_multiple_choice(answers, self.pollrun)
@@ -257,3 +282,64 @@ class PollChartTest(TracProTest):
         self.assertEqual(summary_data['Mean'], 5)
         self.assertEqual(summary_data['Response rate average (%)'], 100)
         self.assertEqual(summary_data['Standard deviation'], 2.2)
+
+    def test_get_cached_chart_data(self):
+        calculated = []
+
+        def calculate(questions):
+            calculated.extend(questions)
+            return {q.pk: ('bar', [q.pk], None, None) for q in questions}
+
+        questions = [self.question1, self.question3]
+        filters = {'region': None, 'form': {'split_regions': False}}
+        data = charts.get_cached_chart_data(self.org, questions, filters, calculate)
+        self.assertEqual(data, [
+            (self.question1, 'bar', [self.question1.pk], None, None),
+            (self.question3, 'bar', [self.question3.pk], None, None),
+        ])
+        self.assertEqual(calculated, questions)
+
+        # Cached data is reused for the same filters.
+        charts.get_cached_chart_data(self.org, questions, filters, calculate)
+        self.assertEqual(len(calculated), 2)
+
+        # Different filters are cached separately.
+        charts.get_cached_chart_data(
+            self.org, questions, {'region': self.region1.pk}, calculate)
+        self.assertEqual(len(calculated), 4)
+
+        # Clearing the org's chart data recalculates it.
+        charts.clear_chart_data(self.org)
+        charts.get_cached_chart_data(self.org, questions, filters, calculate)
+        self.assertEqual(len(calculated), 6)
+
+    def test_poll_questions(self):
+        """Data for all questions should match the data for each question."""
+        for region in (self.region1, self.region2):
+            region.boundary = factories.Boundary(org=self.org)
+            region.save()
+        models.AnswerSummary.objects.rebuild(self.pollruns)
+        models.WordCount.objects.rebuild(self.pollruns)
+        questions = [self.question1, self.question2, self.question3]
+        totals = [
+            (None, None),
+            (models.AnswerSummary.objects.all(), models.WordCount.objects.all()),
+        ]
+        for summaries, word_counts in totals:
+            for split_regions in (False, True):
+                with CaptureQueriesContext(connection) as queries:
+                    data = charts.poll_questions(
+                        self.pollruns, self.responses, questions, split_regions,
+                        contact_filters={}, summaries=summaries, word_counts=word_counts)
+                # Answers are only fetched if there are no summaries.
+                self.assertEqual(
+                    any('"polls_answer"."value"' in q['sql'] for q in queries),
+                    summaries is None)
+                for question in questions:
+                    chart_type, chart_data, summary_table = charts.multiple_pollruns(
+                        self.pollruns, self.responses, question, split_regions,
+                        contact_filters={}, summaries=summaries, word_counts=word_counts)
+                    map_data = maps.get_map_data(self.responses, question)
+                    self.assertEqual(
+                        data[question.pk],
+                        (chart_type, chart_data, map_data, summary_table))
@@ -8,16 +8,20 @@ import mock
 
 import pytz
 
-from temba_client.types import Run, RunValueSet
+from temba_client.types import Contact as TembaContact, Run, RunValueSet
 
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from django_redis import get_redis_connection
+
 from tracpro.test import factories
 from tracpro.test.cases import TracProTest, TracProDataTest
 
 from ..models import Poll, PollRun, Response
-from .. import models
+from .. import models, tasks, utils
+from ..rules import get_rules_hash
 
 
 class TestPollQuerySet(TracProTest):
@@ -269,6 +273,80 @@ class TestQuestionManager(TracProTest):
         # Question type should not be updated.
         self.assertEqual(question.question_type, models.Question.TYPE_OPEN)
 
+    @mock.patch('tracpro.polls.tasks.RecategorizeAnswers.delay')
+    def test_from_temba__rules_changed(self, mock_delay):
+        """Answers should be recategorized when the question's rules change."""
+        poll = factories.Poll()
+        question = factories.Question(poll=poll, rules=[])
+        ruleset = factories.TembaRuleSet(uuid=question.ruleset_uuid)
+        self.mock_temba_client.get_flow_definition.return_value = factories.TembaFlowDefinition(
+            rule_sets=[{
+                'uuid': question.ruleset_uuid,
+                'rules': [
+                    {'category': {'base': 'Low'}, 'test': {'type': 'lt', 'test': "5"}},
+                    {'category': {'base': 'Other'}, 'test': {'type': 'true'}},
+                ],
+            }])
+
+        models.Question.objects.from_temba(poll, ruleset, order=1)
+        mock_delay.assert_called_once_with(poll.org_id, question_id=question.pk)
+
+        # Another sync doesn't queue a task while one is queued.
+        mock_delay.reset_mock()
+        models.Question.objects.from_temba(poll, ruleset, order=1)
+        self.assertFalse(mock_delay.called)
+
+        # The task is queued again if the queued one was lost.
+        get_redis_connection().delete(tasks.RECATEGORIZE_QUEUED_KEY % (poll.org_id, question.pk))
+        models.Question.objects.from_temba(poll, ruleset, order=1)
+        mock_delay.assert_called_once_with(poll.org_id, question_id=question.pk)
+
+        # Once a task has recategorized the answers, syncing the same rules
+        # again shouldn't recategorize.
+        tasks.RecategorizeAnswers().org_task(poll.org, question_id=question.pk)
+        mock_delay.reset_mock()
+        models.Question.objects.from_temba(poll, ruleset, order=1)
+        self.assertFalse(mock_delay.called)
+
+    def test_from_temba__rules_changed__recategorized(self):
+        """Answers are recategorized by the queued task when the rules change."""
+        poll = factories.Poll()
+        question = factories.Question(poll=poll, rules=[])
+        answer = factories.Answer(question=question, value="3", category="Old")
+        ruleset = factories.TembaRuleSet(uuid=question.ruleset_uuid)
+        self.mock_temba_client.get_flow_definition.return_value = factories.TembaFlowDefinition(
+            rule_sets=[{
+                'uuid': question.ruleset_uuid,
+                'rules': [
+                    {'category': {'base': 'Low'}, 'test': {'type': 'lt', 'test': "5"}},
+                    {'category': {'base': 'Other'}, 'test': {'type': 'true'}},
+                ],
+            }])
+
+        question = models.Question.objects.from_temba(poll, ruleset, order=1)
+        answer.refresh_from_db()
+        self.assertEqual(answer.category, "Low")
+        question.refresh_from_db()
+        self.assertEqual(
+            question.categorized_rules_hash, get_rules_hash(question.get_rules()))
+
+    @mock.patch('tracpro.polls.tasks.RecategorizeAnswers.delay')
+    def test_from_temba__new_not_recategorized(self, mock_delay):
+        """A new question has no answers to recategorize."""
+        poll = factories.Poll()
+        ruleset = factories.TembaRuleSet()
+        self.mock_temba_client.get_flow_definition.return_value = factories.TembaFlowDefinition(
+            rule_sets=[{
+                'uuid': ruleset.uuid,
+                'rules': [
+                    {'category': {'base': 'Low'}, 'test': {'type': 'lt', 'test': "5"}},
+                    {'category': {'base': 'Other'}, 'test': {'type': 'true'}},
+                ],
+            }])
+
+        models.Question.objects.from_temba(poll, ruleset, order=1)
+        self.assertFalse(mock_delay.called)
+
     def test_from_temba__another_org(self):
         """Both uuid and Poll must match in order to update existing."""
         poll = factories.Poll()
@@ -321,6 +399,30 @@ class TestQuestion(TracProTest):
         self.assertEqual(question.categorize(5), 'cats')
         self.assertEqual(question.categorize("foo"), 'Other')
 
+    def test_categorize_many(self):
+        rules = [
+            {
+                'category': {'base': 'dogs'},
+                'test': {'type': 'between', 'min': "0.3", 'max': 3},
+            },
+            {
+                'category': {'base': 'fish'},
+                'test': {'type': 'lt', 'test': "0.3"},
+            },
+            {
+                'category': {'base': 'cats'},
+                'test': {'type': 'number'},
+            },
+        ]
+        question = factories.Question(json_rules=json.dumps(rules))
+        values = [2, 5, 0.3, 0.30000000000000004, -1, float('nan')]
+        self.assertEqual(
+            list(question.categorize_many(values)),
+            ['dogs', 'cats', 'fish', 'dogs', 'fish', 'Other'])
+        self.assertEqual(
+            [question.categorize(v) for v in values[:-1]],
+            ['dogs', 'cats', 'fish', 'dogs', 'fish'])
+
     def test_guess_question_type_numeric(self):
         """Guess NUMERIC if rule types are all numeric."""
         question = factories.Question(json_rules=json.dumps([
@@ -474,6 +576,38 @@ class PollRunTest(TracProDataTest):
             Response.STATUS_COMPLETE: 1,
         })
 
+    def test_get_participation_counts(self):
+        date1 = datetime.datetime(2014, 1, 1, 7, tzinfo=pytz.UTC)
+        pollrun = factories.UniversalPollRun(
+            poll=self.poll1, conducted_on=date1)
+        factories.Response(
+            pollrun=pollrun, contact=self.contact1,
+            created_on=date1, updated_on=date1, status=Response.STATUS_EMPTY)
+        factories.Response(
+            pollrun=pollrun, contact=self.contact2,
+            created_on=date1, updated_on=date1, status=Response.STATUS_COMPLETE)
+        factories.Response(
+            pollrun=pollrun, contact=self.contact4,
+            created_on=date1, updated_on=date1, status=Response.STATUS_PARTIAL)
+
+        self.assertDictEqual(pollrun.get_participation_counts('group'), {
+            self.group1.pk: {'E': 1, 'P': 0, 'C': 1},
+            self.group2.pk: {'E': 0, 'P': 1, 'C': 0},
+        })
+        self.assertDictEqual(pollrun.get_participation_counts('region', self.region1), {
+            self.region1.pk: {'E': 1, 'P': 0, 'C': 1},
+        })
+
+        # a newer response changes the cached counts
+        date2 = datetime.datetime(2014, 1, 2, 7, tzinfo=pytz.UTC)
+        factories.Response(
+            pollrun=pollrun, contact=self.contact3,
+            created_on=date2, updated_on=date2, status=Response.STATUS_COMPLETE)
+        self.assertDictEqual(pollrun.get_participation_counts('group'), {
+            self.group1.pk: {'E': 1, 'P': 0, 'C': 1},
+            self.group2.pk: {'E': 0, 'P': 1, 'C': 1},
+        })
+
     def test_is_last_for_region(self):
         pollrun1 = factories.RegionalPollRun(
             poll=self.poll1, region=self.region1, conducted_on=timezone.now())
@@ -702,6 +836,252 @@ class TestResponse(TracProDataTest):
         # same run if we call again
         self.assertEqual(Response.from_run(self.unicef, run), response5)
 
+    def test_from_runs(self):
+        """Runs saved as a batch should match those saved one at a time."""
+        def _run(run_id, contact, completed, values, hour=3):
+            return Run.create(
+                id=run_id,
+                flow='F-001',  # flow UUID for poll #1
+                contact=contact,
+                completed=completed,
+                values=[
+                    RunValueSet.create(
+                        category="1 - 50",
+                        node=node,
+                        text=value,
+                        value=value,
+                        label="Label",
+                        time=datetime.datetime(2014, 1, 2, 3, 4, 5, 6, pytz.UTC),
+                    ) for node, value in values
+                ],
+                steps=[],  # not used
+                created_on=datetime.datetime(2013, 1, 2, hour, 4, 5, 6, pytz.UTC),
+            )
+
+        # an existing response which is out of date
+        stale = Response.from_run(self.unicef, _run(1234, 'C-001', False, []))
+
+        runs = [
+            _run(1234, 'C-001', True, [('RS-001', "6"), ('RS-002', "sunny")]),
+            _run(2345, 'C-002', False, [('RS-001', "7")]),
+            _run(3456, 'C-003', False, [], hour=1),
+            _run(4567, 'C-003', False, [], hour=2),  # replaces 3456
+        ]
+        responses, failures = Response.from_runs(self.unicef, runs, poll=self.poll1)
+
+        self.assertEqual(failures, [])
+        self.assertEqual([r.flow_run_id for r in responses], [1234, 2345, 3456, 4567])
+        self.assertEqual(responses[0].pk, stale.pk)
+        self.assertFalse(hasattr(responses[0], 'is_new'))
+        self.assertTrue(all(r.is_new for r in responses[1:]))
+
+        stale = Response.objects.get(pk=stale.pk)
+        self.assertEqual(stale.status, Response.STATUS_COMPLETE)
+        self.assertEqual(
+            stale.updated_on,
+            datetime.datetime(2014, 1, 2, 3, 4, 5, 6, pytz.UTC))
+        self.assertEqual(
+            sorted(stale.answers.values_list('value', flat=True)), ["6", "sunny"])
+
+        response2 = Response.objects.get(flow_run_id=2345)
+        self.assertEqual(response2.contact, self.contact2)
+        self.assertEqual(response2.status, Response.STATUS_PARTIAL)
+        self.assertEqual(list(response2.answers.values_list('value', flat=True)), ["7"])
+
+        self.assertFalse(Response.objects.get(flow_run_id=3456).is_active)
+        self.assertTrue(Response.objects.get(flow_run_id=4567).is_active)
+
+        # all responses are up-to-date if we call again
+        responses, failures = Response.from_runs(self.unicef, runs, poll=self.poll1)
+        self.assertEqual(len(responses), 4)
+        self.assertFalse(any(hasattr(r, 'is_new') for r in responses))
+
+    def test_from_runs__answer_summaries(self):
+        """Answer summaries are kept up-to-date as runs are saved."""
+        def _run(run_id, contact, value, day):
+            return Run.create(
+                id=run_id, flow='F-001', contact=contact, completed=True,
+                values=[RunValueSet.create(
+                    category="1 - 50", node='RS-001', text=value, value=value,
+                    label="Number of sheep",
+                    time=datetime.datetime(2014, 1, day, 12, tzinfo=pytz.UTC))],
+                steps=[], created_on=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))
+
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "4", day=2),
+            _run(2, 'C-002', "6", day=2),
+            _run(3, 'C-004', "nope", day=2),
+        ], poll=self.poll1)
+        # Update a run, and replace a contact's earlier run.
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "5", day=3),
+            _run(4, 'C-004', "10", day=3),
+        ], poll=self.poll1)
+
+        summary = models.AnswerSummary.objects.get(
+            question=self.poll1_question1, region=self.region1)
+        self.assertEqual(summary.response_count, 2)
+        self.assertEqual(summary.answer_count, 2)
+        self.assertEqual(summary.numeric_count, 2)
+        self.assertEqual(summary.numeric_sum, 11)
+        self.assertEqual(summary.numeric_sum_squares, 61)
+
+        summary = models.AnswerSummary.objects.get(
+            question=self.poll1_question1, region=self.region2)
+        self.assertEqual(summary.response_count, 1)
+        self.assertEqual(summary.answer_count, 1)
+        self.assertEqual(summary.numeric_count, 1)
+        self.assertEqual(summary.numeric_sum, 10)
+
+        # Questions without answers still count responses.
+        summary = models.AnswerSummary.objects.get(
+            question=self.poll1_question2, region=self.region1)
+        self.assertEqual(summary.response_count, 2)
+        self.assertEqual(summary.answer_count, 0)
+
+        # The same totals are calculated from scratch.
+        totals = list(models.AnswerSummary.objects.order_by('pk').values_list(
+            'question', 'region', *models.AnswerSummary.TOTAL_FIELDS))
+        models.AnswerSummary.objects.rebuild(PollRun.objects.all())
+        self.assertEqual(
+            sorted(models.AnswerSummary.objects.values_list(
+                'question', 'region', *models.AnswerSummary.TOTAL_FIELDS)),
+            sorted(totals))
+
+    def test_answer_summaries__contact_changes(self):
+        """Answer summaries follow contacts that change region or are deactivated."""
+        def _run(run_id, contact, value):
+            return Run.create(
+                id=run_id, flow='F-001', contact=contact, completed=True,
+                values=[RunValueSet.create(
+                    category="1 - 50", node='RS-001', text=value, value=value,
+                    label="Number of sheep",
+                    time=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))],
+                steps=[], created_on=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))
+
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "4"),
+            _run(2, 'C-002', "6"),
+            _run(3, 'C-004', "10"),
+        ], poll=self.poll1)
+
+        self.contact1.region = self.region2
+        self.contact1.save()
+        self.contact2.is_active = False
+        self.contact2.save()
+
+        # Summaries match the data calculated from the answers.
+        responses = Response.objects.filter(is_active=True, contact__is_active=True)
+        answers = models.Answer.objects.filter(
+            response__in=responses, question=self.poll1_question1)
+        summaries = models.AnswerSummary.objects.filter(question=self.poll1_question1)
+        self.assertEqual(
+            summaries.summarize_by_region_and_pollrun(),
+            utils.summarize_by_region_and_pollrun(answers, responses))
+        self.assertEqual(
+            list(summaries.filter(response_count__gt=0).values_list('region', flat=True)),
+            [self.region2.pk])
+
+    def test_answer_summaries__locked(self):
+        """Summaries are only changed while their pollrun is locked."""
+        pollrun = factories.UniversalPollRun(poll=self.poll1)
+        response = factories.Response(pollrun=pollrun, contact=self.contact1)
+        with CaptureQueriesContext(connection) as queries:
+            models.AnswerSummary.objects.add_responses(Response.objects.filter(pk=response.pk))
+        locks = [q['sql'] for q in queries if 'pg_advisory_xact_lock' in q['sql']]
+        self.assertEqual(len(locks), 1)
+        self.assertIn(', {})'.format(pollrun.pk), locks[0])
+
+    def test_from_runs__word_counts(self):
+        """Word counts for open-ended questions are kept up-to-date as runs are saved."""
+        def _run(run_id, contact, value, day):
+            return Run.create(
+                id=run_id, flow='F-001', contact=contact, completed=True,
+                values=[RunValueSet.create(
+                    category="All Responses", node='RS-002', text=value, value=value,
+                    label="How is the weather?",
+                    time=datetime.datetime(2014, 1, day, 12, tzinfo=pytz.UTC))],
+                steps=[], created_on=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))
+
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "rainy rainy", day=2),
+            _run(2, 'C-002', "sunny", day=2),
+            _run(3, 'C-004', "rainy", day=2),
+        ], poll=self.poll1)
+        # Update a run.
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "sunny", day=3),
+        ], poll=self.poll1)
+
+        word_counts = models.WordCount.objects.filter(question=self.poll1_question2)
+        self.assertEqual(word_counts.top_words(), [("sunny", 2), ("rainy", 1)])
+        self.assertEqual(
+            word_counts.filter(region=self.region1).top_words(), [("sunny", 2)])
+        self.assertFalse(models.WordCount.objects.filter(question=self.poll1_question1).exists())
+
+        # The same counts are calculated from scratch.
+        models.WordCount.objects.rebuild(PollRun.objects.all())
+        self.assertEqual(word_counts.top_words(), [("sunny", 2), ("rainy", 1)])
+
+    def test_word_counts__contact_changes(self):
+        """Word counts follow contacts that change region or are deactivated."""
+        def _run(run_id, contact, value):
+            return Run.create(
+                id=run_id, flow='F-001', contact=contact, completed=True,
+                values=[RunValueSet.create(
+                    category="All Responses", node='RS-002', text=value, value=value,
+                    label="How is the weather?",
+                    time=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))],
+                steps=[], created_on=datetime.datetime(2014, 1, 2, 12, tzinfo=pytz.UTC))
+
+        Response.from_runs(self.unicef, [
+            _run(1, 'C-001', "rainy rainy"),
+            _run(2, 'C-002', "sunny"),
+            _run(3, 'C-004', "rainy"),
+        ], poll=self.poll1)
+
+        self.contact1.region = self.region2
+        self.contact1.save()
+        self.contact2.is_active = False
+        self.contact2.save()
+
+        # Counts match the words counted from the answers, for each region.
+        word_counts = models.WordCount.objects.filter(question=self.poll1_question2)
+        for region in (self.region1, self.region2):
+            answers = models.Answer.objects.filter(
+                question=self.poll1_question2, response__is_active=True,
+                response__contact__is_active=True, response__contact__region=region)
+            self.assertEqual(
+                word_counts.filter(region=region).top_words(), answers.word_counts())
+        self.assertEqual(
+            word_counts.filter(region=self.region2).top_words(), [("rainy", 3)])
+
+    def test_word_counts__locked(self):
+        """Word counts are only changed while their pollrun is locked."""
+        pollrun = factories.UniversalPollRun(poll=self.poll1)
+        response = factories.Response(pollrun=pollrun, contact=self.contact1)
+        factories.Answer(response=response, question=self.poll1_question2, value="sunny")
+        with CaptureQueriesContext(connection) as queries:
+            models.WordCount.objects.add_responses(Response.objects.filter(pk=response.pk))
+        locks = [q['sql'] for q in queries if 'pg_advisory_xact_lock' in q['sql']]
+        self.assertEqual(len(locks), 1)
+        self.assertIn(', {})'.format(pollrun.pk), locks[0])
+
+    def test_from_runs__unknown_contact(self):
+        """Runs for contacts that can't be saved are reported as failures."""
+        self.mock_temba_client.get_contact.return_value = TembaContact.create(
+            uuid='C-999', name="Unknown", urns=['tel:999'], groups=['G-999'],
+            fields={}, language='eng', modified_on=timezone.now())
+        run = Run.create(
+            id=1234, flow='F-001', contact='C-999', completed=False,
+            values=[], steps=[], created_on=timezone.now())
+
+        responses, failures = Response.from_runs(self.unicef, [run], poll=self.poll1)
+        self.assertEqual(responses, [])
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0], run)
+        self.assertIsInstance(failures[0][1], ValueError)
+
 
 class TestAnswer(TracProDataTest):
 
@@ -719,11 +1099,13 @@ class TestAnswer(TracProDataTest):
         self.assertEqual(answer1.question, self.poll1_question1)
         self.assertEqual(answer1.category, "1 - 5")
         self.assertEqual(answer1.value, "4.00000")
+        self.assertEqual(answer1.numeric_value, 4.0)
 
         answer2 = factories.Answer(
             response=response, question=self.poll1_question1,
             value="rain", category=dict(base="Rain", rwa="Imvura"))
         self.assertEqual(answer2.category, "Rain")
+        self.assertIsNone(answer2.numeric_value)
 
         answer3 = factories.Answer(
             response=response, question=self.poll1_question1,
@@ -90,7 +90,8 @@ class CheckRuleTestBase(object):
 
     def call(self, test):
         val, kwargs = test
-        return self.rule(val, **kwargs)
+        rule = {'test': dict(kwargs, type=self.test_type)}
+        return rules.passes_test(val, rule)
 
     def test_false(self):
         unexpected_successes = []
@@ -114,7 +115,7 @@ class CheckRuleTestBase(object):
 
 
 class TestIsNumber(CheckRuleTestBase, TracProTest):
-    rule = staticmethod(rules.is_number)
+    test_type = 'number'
     true_tests = [
         ("1.234", {}),
         ("1", {}),
@@ -133,7 +134,7 @@ class TestIsNumber(CheckRuleTestBase, TracProTest):
 
 
 class TestIsBetween(CheckRuleTestBase, TracProTest):
-    rule = staticmethod(rules.is_between)
+    test_type = 'between'
     true_tests = [
         ("1", {'min': "1", 'max': "2"}),
         ("1.5", {'min': "1", 'max': "2"}),
@@ -152,7 +153,7 @@ class TestIsBetween(CheckRuleTestBase, TracProTest):
 
 
 class TestIsEqual(CheckRuleTestBase, TracProTest):
-    rule = staticmethod(rules.is_equal)
+    test_type = 'eq'
     true_tests = [
         ("1.0", {'test': "1"}),
         ("1", {'test': "1.0"}),
@@ -166,7 +167,7 @@ class TestIsEqual(CheckRuleTestBase, TracProTest):
 
 
 class TestIsLessThan(CheckRuleTestBase, TracProTest):
-    rule = staticmethod(rules.is_less_than)
+    test_type = 'lt'
     true_tests = [
         ("1", {'test': "1.5"}),
         ("1.5", {'test': "2"}),
@@ -182,7 +183,7 @@ class TestIsLessThan(CheckRuleTestBase, TracProTest):
 
 
 class TestIsGreaterThan(CheckRuleTestBase, TracProTest):
-    rule = staticmethod(rules.is_greater_than)
+    test_type = 'gt'
     true_tests = [
         ("1.5", {'test': "1"}),
         ("2", {'test': "1.5"}),
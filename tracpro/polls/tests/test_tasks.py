@@ -0,0 +1,309 @@
+from __future__ import absolute_import, unicode_literals
+
+import datetime
+import gzip
+import json
+import shutil
+import tempfile
+
+import mock
+
+import pytz
+
+from celery.exceptions import SoftTimeLimitExceeded
+
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from django_redis import get_redis_connection
+
+from temba_client.types import Run
+from temba_client.utils import parse_iso8601
+
+from tracpro.test.cases import TracProDataTest
+
+from tracpro.orgs_ext.constants import TaskType
+
+from ..models import Answer, Response, ResponseExport
+from .. import exports, rules, tasks
+from . import factories
+
+
+class TestFetchOrgRuns(TracProDataTest):
+
+    def setUp(self):
+        super(TestFetchOrgRuns, self).setUp()
+        self.redis = get_redis_connection()
+        self.checkpoint_key = tasks.POLL_FETCH_CHECKPOINT_KEY % (self.unicef.pk, self.poll1.pk)
+        self.last_time_key = tasks.POLL_LAST_FETCHED_RUN_TIME_KEY % (self.unicef.pk, self.poll1.pk)
+        self.until = datetime.datetime(2015, 1, 2, tzinfo=pytz.UTC)
+
+    def create_run(self, run_id, contact):
+        return Run.create(
+            id=run_id, flow='F-001', contact=contact, completed=False,
+            values=[], steps=[],
+            created_on=datetime.datetime(2014, 1, 2, tzinfo=pytz.UTC))
+
+    def mock_pages(self, *pages):
+        """Return each page of runs in turn, updating the pager as RapidPro would."""
+        pages = list(pages)
+
+        def get_runs(pager, **kwargs):
+            runs = pages.pop(0)
+            pager.next_url = 'next' if pages else None
+            return runs
+        self.mock_temba_client.get_runs.side_effect = get_runs
+
+    def test_fetch_poll_runs(self):
+        """Each page is saved as it arrives and the poll's last time is recorded."""
+        self.mock_pages(
+            [self.create_run(1, 'C-001'), self.create_run(2, 'C-002')],
+            [self.create_run(3, 'C-003')],
+        )
+        counts = tasks.FetchOrgRuns().fetch_poll_runs(
+            self.unicef, self.poll1, self.mock_temba_client, self.redis, None, self.until)
+
+        self.assertEqual(counts['fetched'], 3)
+        self.assertEqual(counts['created'], 3)
+        self.assertEqual(Response.objects.count(), 3)
+        self.assertEqual(self.mock_temba_client.get_runs.call_count, 2)
+        self.assertIsNone(self.redis.get(self.checkpoint_key))
+        self.assertEqual(parse_iso8601(self.redis.get(self.last_time_key)), self.until)
+
+    def test_fetch_poll_runs__resume(self):
+        """A saved checkpoint is resumed from the last saved page in the same window."""
+        self.redis.set(self.checkpoint_key, json.dumps({
+            'after': '2014-01-01T00:00:00.000000Z',
+            'before': '2014-06-01T00:00:00.000000Z',
+            'page': 3,
+        }))
+        self.mock_pages([self.create_run(3, 'C-003')])
+        tasks.FetchOrgRuns().fetch_poll_runs(
+            self.unicef, self.poll1, self.mock_temba_client, self.redis, None, self.until)
+
+        kwargs = self.mock_temba_client.get_runs.call_args[1]
+        self.assertEqual(kwargs['before'], datetime.datetime(2014, 6, 1, tzinfo=pytz.UTC))
+        self.assertEqual(kwargs['after'], datetime.datetime(2014, 1, 1, tzinfo=pytz.UTC))
+        self.assertEqual(kwargs['pager'].start_page, 2)
+        self.assertEqual(Response.objects.get().flow_run_id, 3)
+        self.assertIsNone(self.redis.get(self.checkpoint_key))
+        self.assertEqual(
+            parse_iso8601(self.redis.get(self.last_time_key)),
+            datetime.datetime(2014, 6, 1, tzinfo=pytz.UTC))
+
+    def test_fetch_poll_runs__interrupted(self):
+        """If saving a page fails, the checkpoint points at that page."""
+        pages = [[self.create_run(1, 'C-001')], Exception("Timed out")]
+
+        def get_runs(pager, **kwargs):
+            page = pages.pop(0)
+            if isinstance(page, Exception):
+                raise page
+            pager.next_url = 'next'
+            return page
+        self.mock_temba_client.get_runs.side_effect = get_runs
+
+        with self.assertRaises(Exception):
+            tasks.FetchOrgRuns().fetch_poll_runs(
+                self.unicef, self.poll1, self.mock_temba_client, self.redis, None, self.until)
+
+        checkpoint = json.loads(self.redis.get(self.checkpoint_key))
+        self.assertEqual(checkpoint['page'], 2)
+        self.assertIsNone(self.redis.get(self.last_time_key))
+
+
+class TestExportOrgResponses(TracProDataTest):
+
+    def setUp(self):
+        super(TestExportOrgResponses, self).setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+
+        date1 = datetime.datetime(2014, 1, 1, 7, tzinfo=pytz.UTC)
+        date2 = datetime.datetime(2014, 1, 2, 7, tzinfo=pytz.UTC)
+        pollrun1 = factories.UniversalPollRun(poll=self.poll1, conducted_on=date1)
+        pollrun2 = factories.UniversalPollRun(poll=self.poll1, conducted_on=date2)
+        self.response_ids = []
+        for pollrun, contact, value in ((pollrun1, self.contact1, "5"),
+                                        (pollrun2, self.contact4, "7")):
+            response = factories.Response(
+                pollrun=pollrun, contact=contact, created_on=pollrun.conducted_on,
+                updated_on=pollrun.conducted_on, status=Response.STATUS_COMPLETE)
+            factories.Answer(
+                response=response, question=self.poll1_question1,
+                value=value, category="1 - 10", submitted_on=pollrun.conducted_on)
+            self.response_ids.append(response.pk)
+
+    def create_export(self, **kwargs):
+        return ResponseExport.objects.create(
+            org=self.unicef, poll=self.poll1, created_by=self.admin, **kwargs)
+
+    def run_export(self, export):
+        with override_settings(MEDIA_ROOT=self.media_root):
+            tasks.ExportOrgResponses().org_task(self.unicef, export_id=export.pk)
+        return ResponseExport.objects.get(pk=export.pk)
+
+    def test_export(self):
+        export = self.run_export(self.create_export())
+        self.assertEqual(export.status, ResponseExport.STATUS_COMPLETE)
+        self.assertEqual(export.total_count, 2)
+        self.assertEqual(export.row_count, 2)
+        self.assertEqual(export.get_progress(), 100)
+        self.assertIsNotNone(export.completed_on)
+
+        with open(export.file.path) as f:
+            rows = f.read().decode('utf-8').splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertTrue(rows[1].endswith(",5,"))
+        self.assertTrue(rows[2].endswith(",7,"))
+
+    def test_export__filtered_and_compressed(self):
+        export = self.run_export(self.create_export(
+            region=self.region2, start_date=datetime.date(2014, 1, 2), compress=True))
+        self.assertEqual(export.status, ResponseExport.STATUS_COMPLETE)
+        self.assertEqual(export.row_count, 1)
+        self.assertTrue(export.file.name.endswith('.csv.gz'))
+
+        with gzip.open(export.file.path) as f:
+            rows = f.read().decode('utf-8').splitlines()
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(rows[1].endswith(",7,"))
+
+    def test_export__response_deleted(self):
+        """Responses deleted while the export is written are left out."""
+        responses = mock.Mock(**{'values_list.return_value': self.response_ids})
+        Response.objects.filter(pk=self.response_ids[0]).delete()
+        rows = list(exports.iter_response_rows(responses, [self.poll1_question1]))
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[1][-1], "7")
+
+    def test_export__not_pending(self):
+        """An export that has already been claimed isn't written again."""
+        export = self.run_export(self.create_export(status=ResponseExport.STATUS_RUNNING))
+        self.assertEqual(export.status, ResponseExport.STATUS_RUNNING)
+        self.assertFalse(export.file)
+
+    @mock.patch('tracpro.polls.exports.write_export')
+    def test_export__time_limit(self, mock_write_export):
+        """An export that runs out of time is failed."""
+        mock_write_export.side_effect = SoftTimeLimitExceeded()
+        export = self.create_export()
+        with self.assertRaises(SoftTimeLimitExceeded):
+            self.run_export(export)
+        export = ResponseExport.objects.get(pk=export.pk)
+        self.assertEqual(export.status, ResponseExport.STATUS_FAILED)
+
+    def test_fail_expired(self):
+        """Exports that their killed task left unfinished are failed."""
+        running = self.create_export(status=ResponseExport.STATUS_RUNNING)
+        pending = self.create_export()
+        complete = self.create_export(status=ResponseExport.STATUS_COMPLETE)
+        recent = self.create_export(status=ResponseExport.STATUS_RUNNING)
+        expired_on = timezone.now() - ResponseExport.TASK_TIMEOUT - datetime.timedelta(minutes=1)
+        ResponseExport.objects.exclude(pk=recent.pk).update(created_on=expired_on)
+
+        self.assertEqual(ResponseExport.objects.fail_expired(), 2)
+        statuses = dict(ResponseExport.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {
+            running.pk: ResponseExport.STATUS_FAILED,
+            pending.pk: ResponseExport.STATUS_FAILED,
+            complete.pk: ResponseExport.STATUS_COMPLETE,
+            recent.pk: ResponseExport.STATUS_RUNNING,
+        })
+
+
+class TestRecategorizeAnswers(TracProDataTest):
+
+    def setUp(self):
+        super(TestRecategorizeAnswers, self).setUp()
+        self.question = self.poll1_question1
+        self.question.json_rules = json.dumps([
+            {'category': {'base': 'Low'}, 'test': {'type': 'lt', 'test': "5"}},
+            {'category': {'base': 'High'}, 'test': {'type': 'number'}},
+        ])
+        self.question.save()
+
+        pollrun = factories.UniversalPollRun(poll=self.poll1)
+        self.answers = {}
+        for contact, value in ((self.contact1, "3"), (self.contact2, "7"),
+                               (self.contact3, "8"), (self.contact4, "abc")):
+            response = factories.Response(pollrun=pollrun, contact=contact)
+            self.answers[value] = factories.Answer(
+                response=response, question=self.question, value=value,
+                category="1 - 10")
+
+    @mock.patch.object(tasks, 'RECATEGORIZE_BATCH_SIZE', 2)
+    @mock.patch('tracpro.polls.charts.clear_chart_data')
+    def test_recategorize(self, mock_clear_chart_data):
+        tasks.RecategorizeAnswers().org_task(self.unicef, question_id=self.question.pk)
+
+        categories = dict(Answer.objects.values_list('value', 'category'))
+        self.assertEqual(categories, {
+            "3": "Low",
+            "7": "High",
+            "8": "High",
+            "abc": "1 - 10",  # Non-numeric answers are left alone.
+        })
+
+        result = self.unicef.get_task_result(TaskType.recategorize_answers)
+        self.assertEqual(result['question'], self.question.pk)
+        self.assertTrue(result['complete'])
+        self.assertEqual(result['counts'], {'processed': 3, 'changed': 3})
+        mock_clear_chart_data.assert_called_once_with(self.unicef)
+
+        self.question.refresh_from_db()
+        self.assertEqual(
+            self.question.categorized_rules_hash,
+            rules.get_rules_hash(self.question.get_rules()))
+
+    @mock.patch('tracpro.polls.charts.clear_chart_data')
+    def test_recategorize__unchanged(self, mock_clear_chart_data):
+        Answer.objects.filter(pk=self.answers["3"].pk).update(category="Low")
+        Answer.objects.filter(pk__in=[self.answers["7"].pk, self.answers["8"].pk]).update(category="High")
+
+        tasks.RecategorizeAnswers().org_task(self.unicef, question_id=self.question.pk)
+
+        result = self.unicef.get_task_result(TaskType.recategorize_answers)
+        self.assertEqual(result['counts'], {'processed': 3, 'changed': 0})
+        self.assertFalse(mock_clear_chart_data.called)
+
+    @mock.patch('tracpro.polls.charts.clear_chart_data')
+    def test_recategorize__decimal_bound(self, mock_clear_chart_data):
+        """Values on a bound that a float can't hold match the rule, as in RapidPro."""
+        self.question.json_rules = json.dumps([
+            {'category': {'base': 'Low'}, 'test': {'type': 'between', 'min': "1", 'max': "2.2"}},
+            {'category': {'base': 'High'}, 'test': {'type': 'gt', 'test': "2.2"}},
+        ])
+        self.question.save()
+        Answer.objects.filter(pk=self.answers["3"].pk).update(value="2.2", numeric_value=2.2)
+
+        tasks.RecategorizeAnswers().org_task(self.unicef, question_id=self.question.pk)
+
+        self.assertEqual(Answer.objects.get(pk=self.answers["3"].pk).category, "Low")
+        self.assertEqual(Answer.objects.get(pk=self.answers["7"].pk).category, "High")
+
+    @mock.patch('tracpro.polls.charts.clear_chart_data')
+    def test_recategorize__unsupported_rules(self, mock_clear_chart_data):
+        """Categories from rules that can't be tested here are kept."""
+        self.question.json_rules = json.dumps([
+            {'category': {'base': 'Yes'}, 'test': {'type': 'contains_any', 'test': {'base': "yes y"}}},
+            {'category': {'base': 'Low'}, 'test': {'type': 'lt', 'test': "5"}},
+        ])
+        self.question.save()
+        Answer.objects.filter(pk=self.answers["7"].pk).update(category="Yes")
+
+        tasks.RecategorizeAnswers().org_task(self.unicef, question_id=self.question.pk)
+
+        categories = dict(Answer.objects.values_list('value', 'category'))
+        self.assertEqual(categories, {
+            "3": "1 - 10",
+            "7": "Yes",
+            "8": "1 - 10",
+            "abc": "1 - 10",
+        })
+        self.assertFalse(mock_clear_chart_data.called)
+
+        self.question.refresh_from_db()
+        self.assertEqual(
+            self.question.categorized_rules_hash,
+            rules.get_rules_hash(self.question.get_rules()))
@@ -19,6 +19,21 @@ class TestExtractWords(TracProTest):
             utils.extract_words("قلم رصاص", "ara"),
             ['قلم', 'رصاص'])
 
+    def test_extract_words_many(self):
+        self.assertEqual(
+            utils.extract_words_many(
+                ["I think it's good", "I think it's good", "Good good"],
+                ["eng", "kin", None]),
+            [['think', 'good'], ['think', "it's", 'good'], ['good', 'good']])
+
+    def test_get_stop_words(self):
+        stop_words = utils.get_stop_words("eng")
+        self.assertIsInstance(stop_words, frozenset)
+        self.assertIn("it's", stop_words)
+        self.assertIs(utils.get_stop_words("eng"), stop_words)
+        self.assertEqual(utils.get_stop_words("kin"), frozenset())
+        self.assertEqual(utils.get_stop_words(None), frozenset())
+
 
 class TestNaturalSortKey(TracProTest):
 
@@ -26,3 +41,29 @@ class TestNaturalSortKey(TracProTest):
         categories = ['11-20', '1-10', '<100', None, 'Other', '21-999', '21-99']
         categories.sort(key=utils.natural_sort_key)
         self.assertEqual(categories, [None, '1-10', '11-20', '21-99', '21-999', '<100', 'Other'])
+
+
+class TestNumericStats(TracProTest):
+
+    def test_numeric_stats(self):
+        stats = utils.numeric_stats(
+            ['a', 'a', 'b', 'b', 'c', 'a'],
+            [4.0, 3.0, None, 8.0, None, 8.0])
+        self.assertEqual(set(stats), set(['a', 'b', 'c']))
+        self.assertEqual(stats['a'][:3], (3, 15.0, 5.0))
+        self.assertAlmostEqual(stats['a'][3], 2.160246899)
+        self.assertEqual(stats['b'], (2, 8.0, 8.0, 0.0))
+        self.assertEqual(stats['c'], (1, None, None, None))
+
+    def test_numeric_stats__empty(self):
+        self.assertEqual(utils.numeric_stats([], []), {})
+
+    def test_summarize_stats_by_pollrun(self):
+        """Summaries of in-memory stats match the rounding of the database stats."""
+        stats = utils.numeric_stats([1, 1, 2], [4.0, 3.0, None])
+        self.assertEqual(
+            utils.summarize_stats_by_pollrun(stats, {1: 2, 2: 4, 3: 1}),
+            ({1: 7.0, 2: 0, 3: 0},
+             {1: 3.5, 2: 0, 3: 0},
+             {1: 0.5, 2: 0, 3: 0},
+             {1: 100.0, 2: 25.0, 3: 0.0}))
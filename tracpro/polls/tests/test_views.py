@@ -80,6 +80,8 @@ class ResponseCRUDLTest(TracProDataTest):
         response = self.url_get('unicef', url)
         self.assertContains(response, "Number of sheep", status_code=200)
         self.assertContains(response, "How is the weather?")
+        self.assertContains(response, "5.0000")
+        self.assertContains(response, "Sunny")
 
         responses = list(response.context['object_list'])
         self.assertEqual(len(responses), 2)
@@ -101,6 +103,24 @@ class ResponseCRUDLTest(TracProDataTest):
         response = self.url_get('unicef', url)
         self.assertTrue(response.context['can_restart'])
 
+    def test_by_pollrun_csv(self):
+        url = reverse('polls.response_by_pollrun', args=[self.pollrun1.pk])
+
+        # log in as admin
+        self.login(self.admin)
+
+        response = self.url_get('unicef', url, {'_format': 'csv'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+
+        rows = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(
+            rows[0], "Date,Name,URN,Region,Group,Number of sheep,How is the weather?")
+        # newest non-empty first, with a blank for the missing answer
+        self.assertTrue(rows[1].endswith(",6.0000,"))
+        self.assertTrue(rows[2].endswith(",5.0000,Sunny"))
+
     def test_by_contact(self):
         # log in as admin
         self.login(self.admin)
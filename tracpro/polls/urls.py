@@ -1,7 +1,8 @@
 from __future__ import absolute_import, unicode_literals
 
-from .views import PollCRUDL, PollRunCRUDL, ResponseCRUDL
+from .views import PollCRUDL, PollRunCRUDL, ResponseCRUDL, ResponseExportCRUDL
 
 urlpatterns = PollCRUDL().as_urlpatterns()
 urlpatterns += PollRunCRUDL().as_urlpatterns()
 urlpatterns += ResponseCRUDL().as_urlpatterns()
+urlpatterns += ResponseExportCRUDL().as_urlpatterns()
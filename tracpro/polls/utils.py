@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from decimal import InvalidOperation
+import math
 import re
 
 import numpy
@@ -8,24 +9,50 @@ import pycountry
 import stop_words
 
 
+# Characters that separate words.
+WORD_SEPARATORS = re.compile(r"[^\w'-]", flags=re.UNICODE)
+
+# Stop words for each language code, loaded once per process.
+_stop_words = {}
+
+
+def get_stop_words(language):
+    """Return the frozenset of words to ignore for the language (an ISO 639-2 code)."""
+    if language not in _stop_words:
+        ignore_words = frozenset()
+        if language:
+            code = pycountry.languages.get(bibliographic=language).alpha2
+            try:
+                ignore_words = frozenset(stop_words.get_stop_words(code))
+            except stop_words.StopWordError:
+                pass
+        _stop_words[language] = ignore_words
+    return _stop_words[language]
+
+
 def extract_words(text, language):
     """
     Extracts significant words from the given text (i.e. words we want to
     include in a word cloud)
     """
-    ignore_words = []
-    if language:
-        code = pycountry.languages.get(bibliographic=language).alpha2
-        try:
-            ignore_words = stop_words.get_stop_words(code)
-        except stop_words.StopWordError:
-            pass
-
-    words = re.split(r"[^\w'-]", text.lower(), flags=re.UNICODE)
-    ignore_words = ignore_words
+    ignore_words = get_stop_words(language)
+    words = WORD_SEPARATORS.split(text.lower())
     return [w for w in words if w not in ignore_words and len(w) > 1]
 
 
+def extract_words_many(texts, languages):
+    """Same as `extract_words` for each text, with the language of each text.
+
+    Returns a list of the words in each text.
+    """
+    split = WORD_SEPARATORS.split
+    words = []
+    for text, language in zip(texts, languages):
+        ignore_words = get_stop_words(language)
+        words.append([w for w in split(text.lower()) if w not in ignore_words and len(w) > 1])
+    return words
+
+
 def _convert(text):
     """If text is numeric, convert to an integer. Otherwise, force lowercase."""
     return int(text) if text.isdigit() else text.lower()
@@ -38,21 +65,34 @@ def natural_sort_key(text):
     return [_convert(t) for t in alphanumeric_parts if t]
 
 
+def get_numeric_value(value):
+    """Return the value parsed as a float, or None if it is not numeric."""
+    try:
+        return float(value)
+    except (TypeError, ValueError, InvalidOperation):
+        return None
+
+
 def get_numeric_values(values):
     """Return all values that can be parsed as a float."""
-    numeric = []
-    for val in values:
-        try:
-            numeric.append(float(val))
-        except (TypeError, ValueError, InvalidOperation):
-            pass
-    return numeric
+    numeric = (get_numeric_value(val) for val in values)
+    return [val for val in numeric if val is not None]
 
 
 def summarize_by_pollrun(answers, responses):
-    answer_values = answers.group_values('response__pollrun')
-    response_counts = responses.group_counts('pollrun')
+    return summarize_stats_by_pollrun(
+        answers.numeric_stats('response__pollrun'),
+        responses.group_counts('pollrun'))
+
 
+def summarize_by_region_and_pollrun(answers, responses):
+    return summarize_stats_by_region_and_pollrun(
+        answers.numeric_stats('response__contact__region', 'response__pollrun'),
+        responses.group_counts('contact__region', 'pollrun'))
+
+
+def summarize_stats_by_pollrun(answer_stats, response_counts):
+    """Same as `summarize_by_pollrun`, from stats and counts grouped by pollrun."""
     answer_sums = {}
     answer_avgs = {}
     answer_stdevs = {}
@@ -61,39 +101,102 @@ def summarize_by_pollrun(answers, responses):
     # Note: Each pollrun has response(s), even if it has no answer(s) -
     # so iterating over the response pollruns will cover all pollruns.
     for pollrun_id, response_count in response_counts.items():
-        values = answer_values.get(pollrun_id, [])
+        stats = answer_stats.get(pollrun_id)
         (answer_sums[pollrun_id],
          answer_avgs[pollrun_id],
          answer_stdevs[pollrun_id],
-         response_rates[pollrun_id]) = _summarize(values, response_count)
+         response_rates[pollrun_id]) = _summarize(stats, response_count)
 
     return answer_sums, answer_avgs, answer_stdevs, response_rates
 
 
-def summarize_by_region_and_pollrun(answers, responses):
-    answer_values = answers.group_values(
-        'response__contact__region', 'response__pollrun')
-    response_counts = responses.group_counts(
-        'contact__region', 'pollrun')
-
+def summarize_stats_by_region_and_pollrun(answer_stats, response_counts):
+    """Same as `summarize_by_region_and_pollrun`, from stats and counts
+    grouped by region and pollrun.
+    """
     data = {}
     for (region_id, pollrun_id), response_count in response_counts.items():
         data.setdefault(region_id, ({}, {}, {}, {}))
-        values = answer_values.get((region_id, pollrun_id), [])
+        stats = answer_stats.get((region_id, pollrun_id))
         (data[region_id][0][pollrun_id],
          data[region_id][1][pollrun_id],
          data[region_id][2][pollrun_id],
-         data[region_id][3][pollrun_id]) = _summarize(values, response_count)
+         data[region_id][3][pollrun_id]) = _summarize(stats, response_count)
     return data
 
 
-def _summarize(values, response_count):
-    numeric_values = get_numeric_values(values)
+def numeric_stats(keys, numeric_values):
+    """Same as `AnswerQuerySet.numeric_stats`, for answers already in memory.
+
+    Takes the group key and numeric value (or None) of each answer. Every
+    group is reduced at once: each key is mapped to an integer code, then
+    the counts, sums and squared deviations of all groups are totalled with
+    `numpy.bincount`.
+    """
+    codes = {}
+    group_codes = numpy.fromiter(
+        (codes.setdefault(key, len(codes)) for key in keys), dtype=numpy.intp)
+    if not codes:
+        # bincount() doesn't accept a minlength of 0 before NumPy 1.14.
+        return {}
+    values = numpy.fromiter(
+        (numpy.nan if v is None else v for v in numeric_values), dtype=numpy.float64)
+    is_numeric = ~numpy.isnan(values)
+    values[~is_numeric] = 0
+
+    num_groups = len(codes)
+    answer_counts = numpy.bincount(group_codes, minlength=num_groups)
+    numeric_counts = numpy.bincount(group_codes, weights=is_numeric, minlength=num_groups)
+    numeric_sums = numpy.bincount(group_codes, weights=values, minlength=num_groups)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        numeric_avgs = numeric_sums / numeric_counts
+        deviations = numpy.where(is_numeric, values - numeric_avgs[group_codes], 0)
+        numeric_stdevs = numpy.sqrt(numpy.bincount(
+            group_codes, weights=deviations ** 2, minlength=num_groups) / numeric_counts)
+
+    stats = {}
+    for key, code in codes.items():
+        if numeric_counts[code]:
+            stats[key] = (
+                int(answer_counts[code]),
+                float(numeric_sums[code]),
+                float(numeric_avgs[code]),
+                float(numeric_stdevs[code]))
+        else:
+            stats[key] = (int(answer_counts[code]), None, None, None)
+    return stats
+
+
+def _summarize(stats, response_count):
+    """Round the answer stats from `AnswerQuerySet.numeric_stats` for display."""
+    answer_count, numeric_sum, numeric_avg, numeric_stdev = stats or (0, None, None, None)
+
+    answer_sum = round(numeric_sum or 0, 1)
+    answer_avg = round(numeric_avg or 0, 1)
+    answer_stdev = round(numeric_stdev or 0, 1)
+    response_rate = round(100.0 * answer_count / response_count, 1)
+
+    return answer_sum, answer_avg, answer_stdev, response_rate
 
-    answer_sum = round(numpy.sum(numeric_values), 1)
-    answer_avg = round(numpy.mean(numeric_values) if numeric_values else 0, 1)
-    answer_stdev = round(numpy.std(numeric_values) if numeric_values else 0, 1)
-    response_rate = round(100.0 * len(values) / response_count, 1)
+
+def summarize_totals(answer_count, numeric_count, numeric_sum,
+                     numeric_sum_squares, response_count):
+    """Like `_summarize`, but from precomputed totals of the answer values.
+
+    The standard deviation is calculated from the sum of squares, which loses
+    precision when the values are large compared to their spread, so it can
+    differ slightly from the one that the database calculates. Rounding error
+    that makes the variance negative is treated as 0.
+    """
+    answer_sum = round(numeric_sum, 1)
+    if numeric_count:
+        mean = numeric_sum / numeric_count
+        variance = max(numeric_sum_squares / numeric_count - mean ** 2, 0)
+        answer_avg = round(mean, 1)
+        answer_stdev = round(math.sqrt(variance), 1)
+    else:
+        answer_avg = answer_stdev = 0
+    response_rate = round(100.0 * answer_count / response_count, 1)
 
     return answer_sum, answer_avg, answer_stdev, response_rate
 
@@ -2,8 +2,6 @@ from __future__ import absolute_import, unicode_literals
 
 from collections import OrderedDict
 
-import unicodecsv
-
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from dash.utils import get_obj_cacheable
 
@@ -11,18 +9,62 @@ from django.conf import settings
 from django.contrib import messages
 from django.core.urlresolvers import reverse
 from django.http import (
-    HttpResponse, HttpResponseBadRequest, JsonResponse)
+    FileResponse, Http404, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect
 from django.utils.translation import ugettext_lazy as _
 
 from smartmin import views as smartmin
-from smartmin.templatetags.smartmin import format_datetime
 
 from tracpro.contacts.models import Contact
 from tracpro.groups.models import Group, Region
 
-from . import charts, forms, maps, tasks
-from .models import Poll, Question, PollRun, Response
+from . import charts, exports, forms, maps, tasks
+from .models import (
+    Answer, AnswerSummary, Poll, Question, PollRun, Response, ResponseExport, WordCount)
+
+
+def get_answer_summaries(request, filter_form, **filters):
+    """Return AnswerSummaries matching the responses shown on a chart page.
+
+    Returns None if responses are filtered by contact data fields, which
+    aren't tracked by the summaries.
+    """
+    return _get_region_totals(AnswerSummary, request, filter_form, **filters)
+
+
+def get_word_counts(request, filter_form, **filters):
+    """Return WordCounts matching the responses shown on a chart page.
+
+    Returns None if responses are filtered by contact data fields, which
+    aren't tracked by the word counts.
+    """
+    return _get_region_totals(WordCount, request, filter_form, **filters)
+
+
+def _get_region_totals(model, request, filter_form, **filters):
+    if any(filter_form.cleaned_data.get(name) for name, _ in filter_form.contact_fields):
+        return None
+    totals = model.objects.filter(region__is_active=True, **filters)
+    if request.region:
+        totals = totals.filter(region__in=request.data_regions)
+    return totals
+
+
+def get_chart_filters(request, filter_form):
+    """Return everything besides the question that chart page data depends on.
+
+    Used to key the cached chart data.
+    """
+    if request.region:
+        data_region_ids = sorted(region.pk for region in request.data_regions)
+    else:
+        data_region_ids = None
+    return {
+        'form': filter_form.cleaned_data,
+        'region': request.region.pk if request.region else None,
+        'include_subregions': request.include_subregions,
+        'data_regions': data_region_ids,
+    }
 
 
 class PollCRUDL(smartmin.SmartCRUDL):
@@ -83,6 +125,20 @@ class PollCRUDL(smartmin.SmartCRUDL):
             responses = responses.filter(pollrun__in=pollruns)
             return responses
 
+        def get_summaries(self, pollruns):
+            """Precomputed answer totals for the pollruns, if applicable.
+
+            Summaries are kept per contact region, so they can't be used when
+            responses are filtered by contact data fields.
+            """
+            return get_answer_summaries(
+                self.request, self.filter_form, pollrun__in=pollruns)
+
+        def get_word_counts(self, pollruns):
+            """Precomputed word counts for the pollruns, if applicable."""
+            return get_word_counts(
+                self.request, self.filter_form, pollrun__in=pollruns)
+
         def get_question_data(self):
             # Do not display any data if invalid data was submitted.
             if not self.filter_form.is_valid():
@@ -90,6 +146,8 @@ class PollCRUDL(smartmin.SmartCRUDL):
 
             pollruns = self.get_pollruns()
             responses = self.get_responses(pollruns)
+            summaries = self.get_summaries(pollruns)
+            word_counts = self.get_word_counts(pollruns)
             split_regions = self.filter_form.cleaned_data['split_regions']
             # Get the contact fields so we can pass them to the pollrun url
             contact_filters = {}
@@ -97,19 +155,14 @@ class PollCRUDL(smartmin.SmartCRUDL):
                 if fieldname.startswith('contact'):
                     contact_filters[fieldname] = self.filter_form.cleaned_data[fieldname]
 
-            data = []
-            for question in self.object.questions.active():
-                chart_type, chart_data, summary_table = charts.multiple_pollruns(
-                    pollruns, responses, question, split_regions, contact_filters)
-                map_data = maps.get_map_data(responses, question)
-                data.append((
-                    question,
-                    chart_type,
-                    chart_data,
-                    map_data,
-                    summary_table,
-                ))
-            return data
+            def calculate(questions):
+                return charts.poll_questions(
+                    pollruns, responses, questions, split_regions, contact_filters,
+                    summaries, word_counts)
+
+            return charts.get_cached_chart_data(
+                self.request.org, self.object.questions.active(),
+                get_chart_filters(self.request, self.filter_form), calculate)
 
     class Update(PollMixin, OrgObjPermsMixin, smartmin.SmartUpdateView):
         form_class = forms.PollForm
@@ -128,6 +181,10 @@ class PollCRUDL(smartmin.SmartCRUDL):
         def form_valid(self, form, formset):
             self.object = form.save()
             formset.save()
+            if any('question_type' in f.changed_data for f in formset.forms):
+                # Words are only counted for open-ended questions.
+                WordCount.objects.rebuild(self.object.pollruns.all())
+            charts.clear_chart_data(self.object.org)
             messages.success(self.request, self.derive_success_message())
             return redirect(self.get_success_url())
 
@@ -294,18 +351,25 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
 
             if filter_form.is_valid():
                 responses = self.get_responses(filter_form, self.object)
-                question_data = []
-                for question in self.object.poll.questions.active():
-                    chart_type, chart_data, summary_table = charts.single_pollrun(
-                        self.object, responses, question)
-                    map_data = maps.get_map_data(responses, question)
-                    question_data.append((
-                        question,
-                        chart_type,
-                        chart_data,
-                        map_data,
-                        summary_table,
-                    ))
+                summaries = get_answer_summaries(
+                    self.request, filter_form, pollrun=self.object)
+                word_counts = get_word_counts(
+                    self.request, filter_form, pollrun=self.object)
+
+                def calculate(questions):
+                    data = {}
+                    for question in questions:
+                        chart_type, chart_data, summary_table = charts.single_pollrun(
+                            self.object, responses, question, summaries, word_counts)
+                        map_data = maps.get_map_data(responses, question)
+                        data[question.pk] = (chart_type, chart_data, map_data, summary_table)
+                    return data
+
+                filters = get_chart_filters(self.request, filter_form)
+                filters['pollrun'] = self.object.pk
+                question_data = charts.get_cached_chart_data(
+                    self.request.org, self.object.poll.questions.active(),
+                    filters, calculate)
             else:
                 question_data = None
 
@@ -335,9 +399,6 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
 
         def get_context_data(self, **kwargs):
             context = super(PollRunCRUDL.Participation, self).get_context_data(**kwargs)
-            responses = self.object.get_responses(
-                self.request.region,
-                self.request.include_subregions)
             group_by = self.request.GET.get('group-by', 'reporter')
             if group_by == "reporter":
                 group_by_reporter_group = True
@@ -349,41 +410,29 @@ class PollRunCRUDL(smartmin.SmartCRUDL):
                 else:
                     groups_or_regions = Region.objects.filter(org=self.request.org)
 
+            # Response counts for every group or region, from a single query
+            counts = self.object.get_participation_counts(
+                'group' if group_by_reporter_group else 'region',
+                self.request.region,
+                self.request.include_subregions)
+
             # initialize an ordered dict of group to response counts
             per_group_counts = OrderedDict()
             no_group_counts = {'E': 0, 'P': 0, 'C': 0}
             overall_counts = {'E': 0, 'P': 0, 'C': 0}
 
-            # Calculate all reporter group or region activity per group or region
+            # Collect all reporter group or region activity per group or region
             for group_or_region in groups_or_regions:
-                if group_by_reporter_group:
-                    responses_group = responses.filter(contact__group=group_or_region)
-                else:
-                    responses_group = responses.filter(contact__region=group_or_region)
-                if responses_group:
-                    per_group_counts[group_or_region] = {
-                        "E": responses_group.filter(status=Response.STATUS_EMPTY).count(),
-                        "P": responses_group.filter(status=Response.STATUS_PARTIAL).count(),
-                        "C": responses_group.filter(status=Response.STATUS_COMPLETE).count()
-                    }
-                    overall_counts['E'] = overall_counts['E'] + per_group_counts[group_or_region]['E']
-                    overall_counts['P'] = overall_counts['P'] + per_group_counts[group_or_region]['P']
-                    overall_counts['C'] = overall_counts['C'] + per_group_counts[group_or_region]['C']
-
-            # Calculate all no-group or no-region activity
-            if group_by_reporter_group:
-                responses_no_group = responses.filter(contact__group__isnull=True)
-            else:
-                responses_no_group = responses.filter(contact__region__isnull=True)
-            if responses_no_group:
-                no_group_counts = {
-                    "E": responses_no_group.filter(status=Response.STATUS_EMPTY).count(),
-                    "P": responses_no_group.filter(status=Response.STATUS_PARTIAL).count(),
-                    "C": responses_no_group.filter(status=Response.STATUS_COMPLETE).count()
-                }
-                overall_counts['E'] = overall_counts['E'] + no_group_counts['E']
-                overall_counts['P'] = overall_counts['P'] + no_group_counts['P']
-                overall_counts['C'] = overall_counts['C'] + no_group_counts['C']
+                if group_or_region.pk in counts:
+                    per_group_counts[group_or_region] = dict(counts[group_or_region.pk])
+                    for status in ('E', 'P', 'C'):
+                        overall_counts[status] += per_group_counts[group_or_region][status]
+
+            # Collect all no-group or no-region activity
+            if None in counts:
+                no_group_counts = dict(counts[None])
+                for status in ('E', 'P', 'C'):
+                    overall_counts[status] += no_group_counts[status]
 
             def calc_completion(counts):
                 total = counts['E'] + counts['P'] + counts['C']
@@ -515,10 +564,11 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
 
         def derive_queryset(self, **kwargs):
             # only show partial and complete responses
-            return self.derive_pollrun().get_responses(
+            responses = self.derive_pollrun().get_responses(
                 region=self.request.region,
                 include_subregions=self.request.include_subregions,
                 include_empty=False)
+            return responses.select_related('contact__region', 'contact__group')
 
         def get_paginate_by(self, queryset):
             if self.csv:
@@ -540,7 +590,7 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
                 return obj.contact.group
             elif field.startswith('question_'):
                 question = self.derive_questions()[field]
-                answer = obj.answers.filter(question=question).first()
+                answer = self.page_answers.get((obj.pk, question.pk))
                 if answer:
                     if question.question_type == Question.TYPE_RECORDING:
                         return '<a class="answer answer-audio" href="%s" data-answer-id="%d">Play</a>' % (
@@ -568,6 +618,8 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
             context['pollrun'] = pollrun
 
             if not self.csv:
+                self.page_answers = self.get_page_answers(context['object_list'])
+
                 # can only restart regional polls and if they're the last pollrun
                 can_restart = self.request.region and pollrun.is_last_for_region(
                     self.request.region)
@@ -588,33 +640,25 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
                 ])
             return context
 
+        def get_page_answers(self, responses):
+            """Map (response, question) to the answer, for the responses on the page."""
+            answers = Answer.objects.filter(
+                response__in=[r.pk for r in responses],
+                question__in=self.derive_questions().values())
+            page_answers = {}
+            for answer in answers.order_by('pk'):
+                page_answers.setdefault((answer.response_id, answer.question_id), answer)
+            return page_answers
+
         def render_to_response(self, context, **response_kwargs):
             if self.csv:
-                response = HttpResponse(content_type='text/csv', status=200)
+                # Stream the rows as they are built, rather than building the
+                # whole file in memory.
+                rows = exports.iter_response_rows(
+                    context['object_list'], self.derive_questions().values())
+                response = StreamingHttpResponse(
+                    exports.iter_csv(rows), content_type='text/csv', status=200)
                 response['Content-Disposition'] = 'attachment; filename="responses.csv"'
-                writer = unicodecsv.writer(response)
-
-                questions = self.derive_questions().values()
-
-                resp_headers = ['Date']
-                contact_headers = ['Name', 'URN', 'Region', 'Group']
-                question_headers = [q.name for q in questions]
-                writer.writerow(resp_headers + contact_headers + question_headers)
-
-                for resp in context['object_list']:
-                    resp_cols = [format_datetime(resp.updated_on)]
-                    contact_cols = [
-                        resp.contact.name, resp.contact.urn,
-                        resp.contact.region, resp.contact.group]
-                    answer_cols = []
-
-                    answers_by_question_id = {a.question_id: a for a in resp.answers.all()}
-                    for question in questions:
-                        answer = answers_by_question_id.get(question.pk, None)
-                        answer_cols.append(answer.value if answer else '')
-
-                    writer.writerow(resp_cols + contact_cols + answer_cols)
-
                 return response
             return super(ResponseCRUDL.ByPollrun, self).render_to_response(
                 context, **response_kwargs)
@@ -676,3 +720,84 @@ class ResponseCRUDL(smartmin.SmartCRUDL):
             context = super(ResponseCRUDL.ByContact, self).get_context_data(**kwargs)
             context['contact'] = self.derive_contact()
             return context
+
+
+class ResponseExportCRUDL(smartmin.SmartCRUDL):
+    model = ResponseExport
+    actions = ('create', 'list', 'download')
+
+    class ResponseExportMixin(object):
+
+        def derive_queryset(self, **kwargs):
+            exports = ResponseExport.objects.filter(org=self.request.org)
+            if not self.request.user.is_admin_for(self.request.org):
+                exports = exports.filter(created_by=self.request.user)
+            return exports.select_related('poll', 'region')
+
+    class Create(OrgPermsMixin, smartmin.SmartCreateView):
+        form_class = forms.ResponseExportForm
+        success_url = '@polls.responseexport_list'
+
+        def get_form_kwargs(self):
+            kwargs = super(ResponseExportCRUDL.Create, self).get_form_kwargs()
+            kwargs['org'] = self.request.org
+            return kwargs
+
+        def get_initial(self):
+            initial = super(ResponseExportCRUDL.Create, self).get_initial()
+            initial['poll'] = self.request.GET.get('poll')
+            return initial
+
+        def pre_save(self, obj):
+            obj = super(ResponseExportCRUDL.Create, self).pre_save(obj)
+            obj.org = self.request.org
+            obj.created_by = self.request.user
+            # Export the responses for the region that is being viewed.
+            obj.region = self.request.region
+            obj.include_subregions = self.request.include_subregions
+            return obj
+
+        def post_save(self, obj):
+            obj = super(ResponseExportCRUDL.Create, self).post_save(obj)
+            tasks.ExportOrgResponses().delay(obj.org.pk, export_id=obj.pk)
+            return obj
+
+    class List(ResponseExportMixin, OrgPermsMixin, smartmin.SmartListView):
+        fields = ('created_on', 'poll', 'region', 'status', 'progress', 'file')
+        default_order = ('-created_on',)
+
+        def derive_queryset(self, **kwargs):
+            # Show exports whose task was killed as failed, so that they can
+            # be requested again.
+            ResponseExport.objects.filter(org=self.request.org).fail_expired()
+            return super(ResponseExportCRUDL.List, self).derive_queryset(**kwargs)
+
+        def get_status(self, obj):
+            return obj.get_status_display()
+
+        def get_progress(self, obj):
+            return "%d%%" % obj.get_progress()
+
+        def get_region(self, obj):
+            return obj.region or _("All Regions")
+
+        def get_file(self, obj):
+            if obj.status == ResponseExport.STATUS_COMPLETE:
+                return '<a href="%s">%s</a>' % (
+                    reverse('polls.responseexport_download', args=[obj.pk]),
+                    _("Download"))
+            return '--'
+
+    class Download(ResponseExportMixin, OrgObjPermsMixin, smartmin.SmartReadView):
+
+        def get_queryset(self):
+            return self.derive_queryset()
+
+        def render_to_response(self, context, **response_kwargs):
+            if self.object.status != ResponseExport.STATUS_COMPLETE:
+                raise Http404("Export is not complete.")
+            filename = self.object.get_filename()
+            content_type = 'application/gzip' if self.object.compress else 'text/csv'
+            response = FileResponse(self.object.file, content_type=content_type)
+            response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+            return response
@@ -1,12 +1,27 @@
 from __future__ import absolute_import, unicode_literals
 
+from itertools import chain
+
 from dash.utils import get_obj_cacheable
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 
-from tracpro.groups.models import Region
+from tracpro.groups.models import Region, REGION_TREE_VERSION_KEY
+from tracpro.orgs_ext.utils import clear_cache_version, get_cache_version
+
+
+# Region access is cached per org and user, under the versions of the org's
+# region tree, the org's administrators and the user's regions.
+USER_REGION_ACCESS_KEY = 'org:%d:user:%d:region_access:%s:%s:%s'
+
+USER_REGION_ACCESS_TTL = 60 * 60 * 24  # 1 day
+
+ORG_REGION_ACCESS_VERSION_KEY = 'org:%d:region_access_version'
+
+USER_REGION_ACCESS_VERSION_KEY = 'user:%d:region_access_version'
 
 
 # === Monkey patching for the User class === #
@@ -59,26 +74,70 @@ def _user_get_full_name(user):
     return super(User, user).get_full_name()
 
 
-def _user_get_direct_regions(user, org):
-    """Return org regions user has direct permission for."""
+def _user_get_region_access(user, org):
+    """Return the user's access to the org's regions.
+
+    A dict with whether the user is an org admin, the ids of the regions the
+    user has direct permission for, and all active regions the user can
+    access (in tree order). Cached across requests until the org's regions
+    or admins, or the user's regions, change.
+    """
     def calculate():
-        # org admins have implicit access to all regions
-        if user.is_admin_for(org):
-            return Region.get_all(org)
-        else:
-            return user.regions.filter(is_active=True)
-    attr_name = '_regions_{}'.format(org.pk)  # cache per org
+        cache_key = USER_REGION_ACCESS_KEY % (
+            org.pk, user.pk,
+            get_cache_version(REGION_TREE_VERSION_KEY % org.pk),
+            get_cache_version(ORG_REGION_ACCESS_VERSION_KEY % org.pk),
+            get_cache_version(USER_REGION_ACCESS_VERSION_KEY % user.pk))
+        access = cache.get(cache_key)
+        if access is None:
+            is_admin = org.administrators.filter(pk=user.pk).exists()
+            if is_admin:
+                # org admins have implicit access to all regions
+                direct_regions = Region.get_all(org)
+            else:
+                direct_regions = user.regions.filter(org=org, is_active=True)
+            direct_region_ids = list(direct_regions.values_list('pk', flat=True))
+
+            tree = Region.get_tree(org.pk)
+            region_ids = set(chain.from_iterable(
+                tree.get_descendant_ids(pk, include_self=True) for pk in direct_region_ids))
+            regions = list(Region.objects.filter(pk__in=region_ids, is_active=True))
+
+            access = {
+                'is_admin': is_admin,
+                'direct_region_ids': direct_region_ids,
+                'regions': regions,
+            }
+            cache.set(cache_key, access, USER_REGION_ACCESS_TTL)
+        return access
+    attr_name = '_region_access_{}'.format(org.pk)  # cache per org
     return get_obj_cacheable(user, attr_name, calculate)
 
 
+def clear_region_access_cache(org=None, user=None):
+    """Invalidate the cached region access of all users of the org, or of the user."""
+    if org is not None:
+        clear_cache_version(ORG_REGION_ACCESS_VERSION_KEY % org.pk)
+    if user is not None:
+        clear_cache_version(USER_REGION_ACCESS_VERSION_KEY % user.pk)
+        for attr in list(user.__dict__):
+            if attr.startswith('_region_access_'):
+                delattr(user, attr)
+
+
+def _user_get_direct_regions(user, org):
+    """Return org regions user has direct permission for."""
+    return Region.objects.filter(pk__in=user.get_region_access(org)['direct_region_ids'])
+
+
 def _user_get_all_regions(user, org):
     """Return org regions user has direct or implied (by hierarchy) permission for."""
-    def calculate():
-        regions = user.get_direct_regions(org).get_descendants(include_self=True)
-        regions = regions.filter(is_active=True)
-        return regions
-    attr_name = '_regions_with_descendants_{}'.format(org.pk)  # cache per org
-    return get_obj_cacheable(user, attr_name, calculate)
+    return Region.objects.filter(pk__in=user.get_all_region_ids(org))
+
+
+def _user_get_all_region_ids(user, org):
+    """Return ids of org regions user has direct or implied permission for."""
+    return [region.pk for region in user.get_region_access(org)['regions']]
 
 
 def _user_update_regions(user, regions):
@@ -87,11 +146,7 @@ def _user_update_regions(user, regions):
     """
     user.regions.clear()
     user.regions.add(*regions)
-
-    for org_name in set(region.org.name for region in regions):
-        for attr in ('_regions_with_descendants_{}', '_regions_{}'):
-            if hasattr(user, attr.format(org_name)):
-                delattr(user, attr.format(org_name))
+    clear_region_access_cache(user=user)
 
 
 def _user_has_region_access(user, region):
@@ -102,7 +157,7 @@ def _user_has_region_access(user, region):
     if user.is_superuser or user.is_admin_for(region.org):
         return True
     else:
-        pks = region.get_ancestors(include_self=True).values_list('pk')
+        pks = region.get_ancestor_ids(include_self=True)
         return user.regions.filter(pk__in=pks).exists()
 
 
@@ -110,7 +165,7 @@ def _user_is_admin_for(user, org):
     """
     Whether this user is an administrator for the given org
     """
-    return org.administrators.filter(pk=user.pk).exists()
+    return user.get_region_access(org)['is_admin']
 
 
 def _user_unicode(user):
@@ -129,6 +184,8 @@ User.add_to_class('has_profile', _user_has_profile)
 User.add_to_class('get_full_name', _user_get_full_name)
 User.add_to_class('get_direct_regions', _user_get_direct_regions)
 User.add_to_class('get_all_regions', _user_get_all_regions)
+User.add_to_class('get_all_region_ids', _user_get_all_region_ids)
+User.add_to_class('get_region_access', _user_get_region_access)
 User.add_to_class('update_regions', _user_update_regions)
 User.add_to_class('has_region_access', _user_has_region_access)
 User.add_to_class('is_admin_for', _user_is_admin_for)
@@ -49,3 +49,27 @@ class UserPatchTest(TracProDataTest):
         self.user1.profile.full_name = None
         self.user1.profile.save()
         self.assertEqual(str(self.user1), "sam@unicef.org")
+
+    def test_get_region_access(self):
+        access = self.user1.get_region_access(self.unicef)
+        self.assertFalse(access['is_admin'])
+        self.assertEqual(access['direct_region_ids'], [self.region1.pk])
+        self.assertEqual(access['regions'], [self.region1])
+
+        # Access is shared across requests (i.e. other instances of the user).
+        user1 = User.objects.get(pk=self.user1.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user1.get_all_region_ids(self.unicef), [self.region1.pk])
+
+    def test_get_region_access__cleared(self):
+        self.assertEqual(self.user1.get_all_region_ids(self.unicef), [self.region1.pk])
+
+        self.region2.users.add(self.user1)
+        user1 = User.objects.get(pk=self.user1.pk)
+        self.assertEqual(
+            set(user1.get_all_region_ids(self.unicef)), set([self.region1.pk, self.region2.pk]))
+
+        self.unicef.administrators.add(user1)
+        user1 = User.objects.get(pk=self.user1.pk)
+        self.assertTrue(user1.is_admin_for(self.unicef))
+        self.assertEqual(len(user1.get_all_region_ids(self.unicef)), 3)
@@ -325,6 +325,7 @@ GROUP_PERMISSIONS = {
         'polls.poll.*',
         'polls.pollrun.*',
         'polls.response.*',
+        'polls.responseexport.*',
         'profiles.profile.*',
         'trackers.tracker.*',
         'trackers.alert.*',
@@ -348,6 +349,9 @@ GROUP_PERMISSIONS = {
         'polls.pollrun_by_poll',
         'polls.response_by_contact',
         'polls.response_by_pollrun',
+        'polls.responseexport_create',
+        'polls.responseexport_list',
+        'polls.responseexport_download',
         'profiles.profile_user_read',
     ),
     "Viewers": (),
@@ -388,6 +392,7 @@ PERMISSIONS = {
     'polls.poll': ('read', 'update', 'list', 'select'),
     'polls.pollrun': ('create', 'restart', 'read', 'participation', 'list', 'by_poll', 'latest'),
     'polls.response': ('by_pollrun', 'by_contact'),
+    'polls.responseexport': ('create', 'list', 'download'),
     # can't create profiles.user.* permissions because we don't own User
     'profiles.profile': ('user_create', 'user_read', 'user_update', 'user_list'),
     'trackers.tracker': ('create', 'update', 'list'),
@@ -123,8 +123,46 @@ $(function() {
     }
   });
 
-  /* Retrieve boundary data from the server, and create the map. */
-  $.getJSON("/boundary/", function(data) {
+  /* Levels of detail of boundary geometries, from coarsest to finest. */
+  var DETAILS = ['low', 'medium', 'high'];
+
+  /* Retrieve boundary data at a level of detail from the server, once. */
+  var boundaryRequests = {};
+  var getBoundaries = function(detail) {
+    if (!boundaryRequests[detail]) {
+      boundaryRequests[detail] = $.getJSON("/boundary/", {detail: detail});
+    }
+    return boundaryRequests[detail];
+  }
+
+  /* Redraw the map's boundaries with more detailed geometries. */
+  var refineBoundaries = function(map, detail) {
+    map.detail = detail;
+    getBoundaries(detail).done(function(data) {
+      map.boundaries.eachLayer(function(boundary) {
+        var info = $.extend(true, {data: boundary.data}, data['results'][boundary.boundaryId]);
+        boundary.clearLayers();
+        boundary.addData(info);
+        boundary.setStyle({fillColor: boundary.fillColor});
+      });
+    });
+  }
+
+  /* Load more detailed boundaries as the user zooms in. */
+  var onZoom = function(e) {
+    var map = e.target;
+    if (map.options.minZoom === undefined) {
+      return;  // The map hasn't been shown yet.
+    }
+    var zoomedIn = map.getZoom() - map.options.minZoom;
+    var detail = DETAILS[Math.min(zoomedIn, DETAILS.length - 1)];
+    if (DETAILS.indexOf(detail) > DETAILS.indexOf(map.detail)) {
+      refineBoundaries(map, detail);
+    }
+  }
+
+  /* Retrieve coarse boundary data from the server, and create the map. */
+  getBoundaries(DETAILS[0]).done(function(data) {
     var allBoundaries = data['results'];
 
     $('.map').each(function() {
@@ -141,6 +179,11 @@ $(function() {
         var info = $.extend(true, {data: data}, boundaryData);
         var boundary = new Boundary(info);
         boundary.setStyle({fillColor: fillColor});
+
+        // Keep what is needed to redraw the boundary in more detail.
+        boundary.boundaryId = boundaryId;
+        boundary.data = data;
+        boundary.fillColor = fillColor;
         boundaries.push(boundary);
       });
 
@@ -163,6 +206,9 @@ $(function() {
       map.addControl(map.boundaries);
       map.setMaxBounds(map.boundaries.getBounds());
 
+      map.detail = DETAILS[0];
+      map.on('zoomend', onZoom);
+
       mapDiv.data('map', map);
     });
   });
@@ -1,15 +1,19 @@
 from __future__ import absolute_import, unicode_literals
 
 import datetime
+from celery.utils.log import get_task_logger
 from dash.utils.sync import ChangeType, sync_push_contact
 from django.conf import settings
 from django.core.mail import send_mail
 from djcelery_transactions import task
 
-from tracpro.contacts.models import Contact
+from tracpro.contacts.models import Contact, ContactSyncContext
 from tracpro.orgs_ext.tasks import OrgTask
 
 
+logger = get_task_logger(__name__)
+
+
 class CreateSnapshots(OrgTask):
     def org_task(self, org, **kwargs):
         for tracker in org.trackers.all():
@@ -20,10 +24,12 @@ class ApplyGroupRules(OrgTask):
     def org_task(self, org, **kwargs):
         Contact.objects.sync(org)
 
-        for tracker in org.trackers.all():
-            updated_contacts = tracker.apply_group_rules()
-            for contact in updated_contacts:
-                sync_push_contact(org, contact, ChangeType.updated, contact.as_temba().groups)
+        # Evaluate alerts for all of the contacts whose groups changed at once.
+        with ContactSyncContext(org):
+            for tracker in org.trackers.all():
+                updated_contacts = tracker.apply_group_rules()
+                for contact in updated_contacts:
+                    sync_push_contact(org, contact, ChangeType.updated, contact.as_temba().groups)
 
 
 class SendAlertThresholdEmails(OrgTask):
@@ -139,5 +145,7 @@ class ReportEmails(OrgTask):
 
 
 @task
-def create_occurrence_trigger_the_alert_action(contact):
-    print "We should check if group membership has changed, and we have an alert related to this particular change."
+def create_occurrence_trigger_the_alert_action(org_id, contact_ids):
+    """Evaluate the org's alerts for a batch of contacts whose group membership changed."""
+    logger.info("We should check if we have an alert related to the group membership "
+                "change of %d contacts in org #%d." % (len(contact_ids), org_id))